@@ -0,0 +1,284 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from journalmk import journalmk as jmk
+
+
+def get_minimal_pdf():
+    # the converted notes are checked for a cross-reference table, hence
+    # the stub pdf needs a valid one
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+               b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>"]
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = list()
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode()
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n" \
+              f"startxref\n{xref}\n%%EOF\n".encode()
+
+    return bytes(output)
+
+
+minimal_pdf = get_minimal_pdf()
+
+timestamp_formats = ["%Y-%m-%d-Note-%H-%M", "%Y_%m_%d %H_%M Office Lens",
+                     "Note--%Y-%m-%d--%H-%M"]
+
+topics = ["Writing", "Housebuilding", "Projects", "Reading", "Travel"]
+
+
+# latexmk is replaced by a script, which writes the stub pdf of the last
+# argument, the tex file
+stub_latexmk = """#!{python}
+import os
+import sys
+
+name = os.path.splitext(os.path.basename(sys.argv[-1]))[0]
+with open(name + ".pdf", "wb") as file:
+    file.write({pdf!r})
+"""
+
+
+def stub_convert(note, pdf):
+    shutil.copyfile(note, pdf)
+    return 0, ""
+
+
+def install_stub_latexmk(bin_dir):
+    os.mkdir(bin_dir)
+    latexmk = os.path.join(bin_dir, "latexmk")
+    with open(latexmk, "w") as file:
+        file.write(stub_latexmk.format(python=sys.executable, pdf=minimal_pdf))
+    os.chmod(latexmk, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+
+def make_directory_tree(root, depth, fan_out):
+    dirs = [root]
+    level = [root]
+    for d in range(depth):
+        next_level = list()
+        for parent in level:
+            for i in range(fan_out):
+                path = os.path.join(parent, f"dir_{d}_{i}")
+                os.mkdir(path)
+                next_level.append(path)
+        dirs.extend(next_level)
+        level = next_level
+
+    return dirs
+
+
+def make_home_directory(root, args, rng):
+    dirs = make_directory_tree(root, args.depth, args.fan_out)
+    notes_parents = rng.sample(dirs, min(len(dirs), args.notes_dirs))
+
+    start = datetime.datetime(2010, 1, 1)
+    span = int((datetime.datetime(2023, 1, 1) - start).total_seconds() / 60)
+    for i, parent in enumerate(notes_parents):
+        notes_dir = os.path.join(parent, "_notes")
+        os.mkdir(notes_dir)
+        if rng.random() < args.metadata_ratio:
+            metadata = dict(part=rng.choice(topics),
+                            chapter=f"Chapter {rng.randint(1, 5)}")
+            if rng.random() < 0.5:
+                metadata.update(section=f"Section {rng.randint(1, 3)}")
+            with open(os.path.join(notes_dir, jmk.metadata_filename),
+                      "w") as file:
+                json.dump(metadata, file)
+
+        # an excluded directory with content, which should not be walked
+        git_dir = os.path.join(parent, ".git")
+        if not os.path.exists(git_dir):
+            os.mkdir(git_dir)
+            for k in range(args.noise_files):
+                open(os.path.join(git_dir, f"object_{k}"), "w").close()
+
+    for i in range(args.notes):
+        notes_dir = os.path.join(rng.choice(notes_parents), "_notes")
+        ts = start + datetime.timedelta(minutes=rng.randrange(span))
+        fo = timestamp_formats[:args.formats][i % args.formats]
+        if rng.random() < args.unparsable_ratio:
+            name = f"some_note_{i}.xopp"
+        else:
+            name = ts.strftime(fo) + ".xopp"
+            if os.path.exists(os.path.join(notes_dir, name)):
+                name = f"some_note_{i}.xopp"
+        with open(os.path.join(notes_dir, name), "wb") as file:
+            file.write(minimal_pdf)
+
+    # directories modified in the last seconds are not trusted by the scan
+    # index, hence the tree is dated back
+    past = time.time() - 3600
+    for dir_path, dir_names, file_names in os.walk(root):
+        os.utime(dir_path, (past, past))
+
+
+class Timer:
+
+    def __init__(self, args, results, stream):
+        self.args = args
+        self.results = results
+        self.stream = stream
+
+    def __call__(self, phase, journal_type, function, *f_args):
+        start = time.perf_counter()
+        result = function(*f_args)
+        seconds = time.perf_counter() - start
+        self.results.append(dict(
+            benchmark="phases",
+            phase=phase,
+            journal_type=journal_type,
+            seconds=seconds,
+            notes=self.args.notes,
+            notes_dirs=self.args.notes_dirs,
+            depth=self.args.depth,
+            fan_out=self.args.fan_out,
+            formats=self.args.formats,
+            metadata_ratio=self.args.metadata_ratio,
+            python=platform.python_version(),
+            time=datetime.datetime.now().isoformat()))
+        print(f"{phase:>26} {journal_type:>14} {seconds:10.4f} s",
+              file=self.stream)
+
+        return result
+
+
+def run_benchmark(args):
+    rng = random.Random(args.seed)
+    results = list()
+    timer = Timer(args, results, sys.stdout)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.join(tmp_dir, "home")
+        build_dir = os.path.join(tmp_dir, "build")
+        os.mkdir(root)
+        os.mkdir(build_dir)
+        make_home_directory(root, args, rng)
+
+        path = os.environ["PATH"]
+        install_stub_latexmk(os.path.join(tmp_dir, "bin"))
+        cwd = os.getcwd()
+        os.chdir(build_dir)
+        stdout = sys.stdout
+        try:
+            formats = timestamp_formats[:args.formats]
+            pdf_commands = {"xopp": " ".join(
+                [sys.executable, os.path.abspath(__file__), "--stub-worker"])}
+            # the start of the interpreter would dominate a stub command
+            if shutil.which("cp") is not None:
+                stub_command = ["cp", "{xopp}", "{pdf}"]
+            else:
+                stub_command = [sys.executable, os.path.abspath(__file__),
+                                "--stub-convert", "{xopp}", "{pdf}"]
+            command_pdf_commands = {"xopp": " ".join(stub_command)}
+            conf = jmk.prepare_conf(dict(journal_type=None))
+            period = (None, None)
+
+            # the messages of journalmk are not part of the benchmark
+            sys.stdout = open(os.devnull, "w")
+            for journal_type in args.journal_types:
+                index = jmk.new_scan_index(None)
+                note_dirs = timer("find_directories", journal_type,
+                                  jmk.find_directories, root, ["_notes"],
+                                  [], index, ["**/.git"])
+                note_dirs = timer("find_notes", journal_type,
+                                  jmk.find_notes, note_dirs, pdf_commands,
+                                  [], period, formats, index)
+                note_dirs = timer("find_directories_indexed", journal_type,
+                                  jmk.find_directories, root, ["_notes"],
+                                  [], index, ["**/.git"])
+                note_dirs = timer("find_notes_indexed", journal_type,
+                                  jmk.find_notes, note_dirs, pdf_commands,
+                                  [], period, formats, index)
+                shutil.rmtree("tmp", ignore_errors=True)
+                timer("make_pdf_notes_command", journal_type,
+                      jmk.make_pdf_notes, note_dirs, command_pdf_commands,
+                      dict(), args.jobs)
+                shutil.rmtree("tmp", ignore_errors=True)
+                timer("make_pdf_notes", journal_type,
+                      jmk.make_pdf_notes, note_dirs, pdf_commands, dict(),
+                      args.jobs, None, 1, pdf_commands)
+                timer("make_pdf_notes_noop", journal_type,
+                      jmk.make_pdf_notes, note_dirs, pdf_commands, dict(),
+                      args.jobs, None, 1, pdf_commands)
+                document_tree = timer("get_document_tree", journal_type,
+                                      jmk.get_document_tree, note_dirs,
+                                      journal_type, jmk.formats,
+                                      jmk.formats)
+                timer("write_tex_file", journal_type,
+                      jmk.write_tex_file, document_tree)
+                conf.update(journal_type=journal_type)
+                err_processes, documents, journal = timer(
+                    "render_journal", journal_type, jmk.render_journal,
+                    document_tree, conf, args.jobs)
+                timer("compile_documents", journal_type,
+                      jmk.compile_documents, documents, journal, args.jobs)
+                timer("compile_documents_noop", journal_type,
+                      jmk.compile_documents, documents, journal, args.jobs)
+                if args.native and jmk.pypdf is not None:
+                    timer("write_pdf_file", journal_type,
+                          jmk.write_pdf_file, document_tree)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            os.chdir(cwd)
+            os.environ["PATH"] = path
+
+    with open(args.output, "a") as file:
+        for result in results:
+            file.write(json.dumps(result) + "\n")
+    print(f"Results appended to {args.output}")
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the phases of journalmk on a synthetic home "
+                    "directory, with stub converters and a stub latexmk")
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--notes-dirs", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fan-out", type=int, default=4)
+    parser.add_argument("--formats", type=int, default=2,
+                        choices=range(1, len(timestamp_formats) + 1))
+    parser.add_argument("--unparsable-ratio", type=float, default=0.05)
+    parser.add_argument("--metadata-ratio", type=float, default=0.5)
+    parser.add_argument("--noise-files", type=int, default=20)
+    parser.add_argument("--journal-types", nargs="+",
+                        default=["chronological", "topological"])
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--native", action="store_true",
+                        help="also time the native pdf backend")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_output.jsonl",
+                        help="JSON lines file the results are appended to")
+    parser.add_argument("--stub-worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--stub-convert", nargs=2, help=argparse.SUPPRESS)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    if arguments.stub_worker:
+        jmk.serve_converter_worker(stub_convert)
+    elif arguments.stub_convert is not None:
+        stub_convert(*arguments.stub_convert)
+    else:
+        run_benchmark(arguments)
@@ -1,5 +1,5 @@
-from journalmk import make
+from journalmk import run
 
 
-def main():
-    make()
+def main(argv=None):
+    run(argv)
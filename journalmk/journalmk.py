@@ -1,16 +1,56 @@
+import argparse
+import bisect
+import concurrent.futures
+import contextlib
+import copy
+import ctypes
+import ctypes.util
 import datetime
+import functools
 import hashlib
 import json
 import operator
 import os
 import pathlib
 import platform
+import queue
+import re
+import select
+import signal
+import struct
 import subprocess
+import sys
 import shutil
+import tempfile
 import textwrap
+import threading
+import time
+import tracemalloc
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import pypdf
+    import pypdf.generic
+except ImportError:
+    pypdf = None
 
 metadata_filename = "journalmk.json"
 
+scan_index_filename = os.path.join("tmp", "scan_index.json")
+
+profile_filename = os.path.join("tmp", "profile.jsonl")
+
 document_preamble = r"""
 \documentclass{scrreprt}
 
@@ -85,57 +125,463 @@ document_end_str = r"""
 \end{document}
 """
 
+# the page numbers of a part document would only count the pages of the
+# part, the merged journal numbers its pages by page labels instead
+part_document_begin_str = r"""
+\newwrite\jmkpages
+\immediate\openout\jmkpages=\jobname.pages
+\mtcsetpagenumbers{parttoc}{off}
+\mtcsetpagenumbers{minitoc}{off}
+\renewcommand*{\chapterpagestyle}{empty}
+\pagestyle{empty}
+\begin{document}
+
+\doparttoc[n]
+\dominitoc
+\faketableofcontents
+"""
+
+part_document_mark_str = r"""
+\clearpage
+\immediate\write\jmkpages{{{kind} \thepage}}
+"""
+
+part_document_end_str = r"""
+\clearpage
+\immediate\write\jmkpages{\the\numexpr\value{page}-1\relax}
+\immediate\closeout\jmkpages
+\end{document}
+"""
+
+front_document_begin_str = r"""
+\begin{document}
+\maketitle
+\pagenumbering{roman}
+\setcounter{page}{2}
+
+\chapter*{\contentsname}
+"""
+
+front_document_toc_str = r"""\contentsline{{{kind}}}{{{title}}}{{{page}}}{{{anchor}}}
+"""
+
+toc_kinds = ["part", "chapter", "section", "subsection"]
+
+parts_directory = os.path.join("tmp", "parts")
+
+preamble_format_name = os.path.join("tmp", "preamble")
+
+# the latexmk options selecting the tex engine
+tex_engines = dict(pdflatex="-pdf", lualatex="-pdflua", xelatex="-pdfxe")
+
+# mylatexformat dumps the preamble until this mark, the packages after it
+# (i.e. hyperref) are loaded on each run
+end_of_dump_str = r"""\csname endofdump\endcsname
+"""
+
+hyperref_regex = re.compile(r"^\\usepackage(?:\[[^]]*\])?\{hyperref\}",
+                            re.MULTILINE)
+
+page_counts_filename = os.path.join("tmp", "page_counts.json")
+
+failed_notes_filename = os.path.join("tmp", "failed_notes.json")
+
+usage_filename = os.path.join("tmp", "usage.json")
+
+profiles_directory = os.path.join("tmp", "profiles")
+
+placeholder_filename = os.path.join("tmp", "placeholder.pdf")
+
+startxref_regex = re.compile(rb"startxref\s+(\d+)\s+%%EOF")
+
+xref_regex = re.compile(rb"\s*(?:xref|\d+\s+\d+\s+obj)")
+
+conversion_stats_filename = os.path.join("tmp", "conversion_stats.json")
+
+# the conversion statistics follow the recent conversions of each extension
+conversion_stats_window = 100
+
+# size limit of the user-wide conversion cache in MiB
+default_cache_size_limit = 1024
+
+tmp_entry_regex = re.compile(
+    r"([0-9a-f]{30})\.(pdf|opt\.pdf|opt\.pdf\.fingerprint)")
+
+pdf_optimizer_commands = dict(
+    qpdf="qpdf --object-streams=generate --recompress-flate "
+         "--compression-level=9 --optimize-images {pdf} {optpdf}",
+    ghostscript="gs -sDEVICE=pdfwrite -dCompatibilityLevel=1.5 -dQUIET "
+                "-dDetectDuplicateImages=true "
+                "-dDownsampleColorImages=true "
+                "-dColorImageResolution={resolution} "
+                "-dDownsampleGrayImages=true "
+                "-dGrayImageResolution={resolution} "
+                "-dDownsampleMonoImages=true "
+                "-dMonoImageResolution={resolution} "
+                "-o {optpdf} {pdf}")
+
+volume_subtitle_str = r"""
+\subtitle{{{subtitle}}}
+"""
+
+index_document_begin_str = r"""
+\begin{document}
+\maketitle
+"""
+
+index_volume_str = r"""
+\section*{{\href{{{file}}}{{{volume}}}}}
+{parts}
+"""
+
 
 def print_jmk(*args):
+    lines = list()
     for i, line in enumerate(print_jmk.wrapper.wrap(text=" ".join(args))):
         if i > 0:
-            print("          ", line)
+            lines.append("           " + line)
         else:
-            print("Journalmk:", line)
+            lines.append("Journalmk: " + line)
+
+    with print_jmk.lock:
+        print("\n".join(lines), flush=True)
 
 
 print_jmk.wrapper = textwrap.TextWrapper(width=69)
+print_jmk.lock = threading.Lock()
+
+
+def print_output(output):
+    if not output:
+        return
+
+    with print_jmk.lock:
+        print(output.decode(errors="replace").rstrip("\n"), flush=True)
+
+
+def new_scan_index(signature):
+    return dict(signature=signature,
+                directories=dict(),
+                notes_directories=dict())
+
+
+def load_scan_index(signature, build_dir=""):
+    filename = os.path.join(build_dir, scan_index_filename)
+    try:
+        with open(filename) as file:
+            index = json.load(file)
+    except (FileNotFoundError, ValueError):
+        index = None
+
+    if index is None or index.get("signature") != signature:
+        print_jmk(f"Create new scan index {filename}")
+        return new_scan_index(signature)
+
+    print_jmk(f"Load scan index {filename}")
+    return index
+
+
+def save_scan_index(index, build_dir=""):
+    filename = os.path.join(build_dir, scan_index_filename)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    index_tmp_filename = filename + ".part"
+    with open(index_tmp_filename, "w") as file:
+        json.dump(index, file, separators=(",", ":"))
+    os.replace(index_tmp_filename, filename)
+
+
+def get_scan_index_signature(conf, root, exclude_directories, note_endings):
+    return dict(version=1,
+                root_directory=root,
+                notes_directory_names=conf["notes_directory_names"],
+                exclude_directories=exclude_directories,
+                note_endings=sorted(note_endings),
+                exclude_note_endings=sorted(conf["exclude_note_endings"]),
+                datetime_filename_formats=conf["datetime_filename_formats"])
+
+
+def is_racy_mtime(mtime_ns, scan_time_ns):
+    # modifications within the mtime resolution of the file system could
+    # go unnoticed, hence recently modified directories are not trusted
+    return mtime_ns >= scan_time_ns - 2 * 10 ** 9
+
+
+def translate_glob_component(component):
+    regex = ""
+    i = 0
+    while i < len(component):
+        char = component[i]
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[" and "]" in component[i + 2:]:
+            j = component.index("]", i + 2)
+            chars = component[i + 1:j]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex += "[" + chars.replace("\\", "\\\\") + "]"
+            i = j
+        else:
+            regex += re.escape(char)
+        i += 1
+
+    return regex
+
+
+def translate_directory_pattern(pattern):
+    pattern = pattern.replace(os.sep, "/")
+    components = pattern.split("/")
+    while components and components[-1] in ("**", ""):
+        components.pop()
+
+    if os.path.isabs(pattern):
+        regex = re.escape(components.pop(0))
+    else:
+        regex = ".*"
+
+    for component in components:
+        if component == "**":
+            regex += "(?:/[^/]+)*"
+        else:
+            regex += "/" + translate_glob_component(component)
+
+    return regex
+
+
+def compile_exclude_matcher(exclude_directories, exclude_patterns=()):
+    regexes = list()
+    for path in exclude_directories:
+        path = os.path.normpath(path).replace(os.sep, "/").rstrip("/")
+        regexes.append(re.escape(path))
+    for pattern in exclude_patterns:
+        regexes.append(translate_directory_pattern(pattern))
+
+    if not regexes:
+        return None
+
+    # a single regex matching all excluded directories and their contents
+    regex = r"\A(?:" + "|".join(regexes) + r")(?:/.*)?\Z"
+
+    return re.compile(regex, re.DOTALL)
+
+
+def is_excluded_directory(matcher, dir_path):
+    if matcher is None:
+        return False
+
+    return matcher.match(dir_path.replace(os.sep, "/")) is not None
+
+
+def scan_directory(dir_path, stat_result, index, new_index, scan_time_ns):
+    mtime_ns = stat_result.st_mtime_ns
+    entry = index["directories"].get(dir_path)
+    dir_entries = None
+    if entry is None or entry["mtime"] != mtime_ns:
+        subdirs = list()
+        dir_entries = list()
+        try:
+            with os.scandir(dir_path) as it:
+                for dir_entry in it:
+                    dir_entries.append(dir_entry)
+                    if dir_entry.is_dir():
+                        subdirs.append([dir_entry.name,
+                                        dir_entry.is_symlink()])
+        except OSError as e:
+            # unreadable or vanished directories are skipped, like os.walk
+            print_jmk(f"Failed to scan directory {dir_path}: {e}")
+            return None, None
+        if is_racy_mtime(mtime_ns, scan_time_ns):
+            mtime_ns = None
+        entry = dict(mtime=mtime_ns, subdirs=subdirs)
+
+    new_index["directories"][dir_path] = entry
+
+    return entry["subdirs"], dir_entries
 
 
-def find_directories(root, notes_dir_names, exclude_directories):
+def find_directories(root, notes_dir_names, exclude_directories, index=None,
+                     exclude_patterns=()):
 
     if not os.path.isdir(root):
         raise ValueError(f"'{root}' is not a directory")
 
+    if index is None:
+        index = new_scan_index(None)
+    new_index = new_scan_index(index["signature"])
+    scan_time_ns = time.time_ns()
+    matcher = compile_exclude_matcher(exclude_directories, exclude_patterns)
+
     note_dirs = dict()
 
     print_jmk(f"Search notes under root directory {root}")
-    for (dir_path, dir_names, file_names) in os.walk(root):
-        if any([dir_path.startswith(edp) for edp in exclude_directories]):
+    if is_excluded_directory(matcher, root):
+        return note_dirs
+
+    # excluded directories are pruned before descending into them and the
+    # stat results of the directory entries are reused
+    dir_paths = [(root, os.stat(root))]
+    while dir_paths:
+        dir_path, stat_result = dir_paths.pop()
+        subdirs, dir_entries = scan_directory(dir_path,
+                                              stat_result,
+                                              index,
+                                              new_index,
+                                              scan_time_ns)
+        if subdirs is None:
+            note_dirs.pop(dir_path, None)
             continue
 
-        elif notes_dir_names is None:
-            for dir_name in dir_names:
-                notes_path = os.path.join(dir_path, dir_name)
-                note_dirs.update({notes_path: dict()})
+        if dir_path in note_dirs:
+            note_dirs[dir_path].update(mtime=stat_result.st_mtime_ns,
+                                       dir_entries=dir_entries)
 
-        else:
-            for notes_dir_name in notes_dir_names:
-                if notes_dir_name in dir_names:
-                    notes_path = os.path.join(dir_path, notes_dir_name)
-                    note_dirs.update({notes_path: dict()})
+        dir_entries = {de.name: de for de in dir_entries or list()}
+        subdirs = [(dir_name, is_link, os.path.join(dir_path, dir_name))
+                   for dir_name, is_link in subdirs]
+        subdirs = [(dir_name, is_link, subdir_path)
+                   for dir_name, is_link, subdir_path in subdirs
+                   if not is_excluded_directory(matcher, subdir_path)]
+
+        for dir_name, is_link, subdir_path in subdirs:
+            if notes_dir_names is None or dir_name in notes_dir_names:
+                note_dirs.update({subdir_path: dict()})
+
+        for dir_name, is_link, subdir_path in reversed(subdirs):
+            if is_link:
+                continue
+            try:
+                if dir_name in dir_entries:
+                    subdir_stat = dir_entries[dir_name].stat()
+                else:
+                    subdir_stat = os.stat(subdir_path)
+            except OSError as e:
+                print_jmk(f"Failed to scan directory {subdir_path}: {e}")
+                note_dirs.pop(subdir_path, None)
+                continue
+            dir_paths.append((subdir_path, subdir_stat))
+
+    index["directories"] = new_index["directories"]
 
     return note_dirs
 
 
-def parse_timestamp(note_path, period, dt_formats):
+# regular expressions of the numeric strptime directives, as used by strptime
+datetime_directive_regexes = dict(
+    d=r"(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])",
+    f=r"(?P<f>[0-9]{1,6})",
+    H=r"(?P<H>2[0-3]|[0-1]\d|\d)",
+    m=r"(?P<m>1[0-2]|0[1-9]|[1-9])",
+    M=r"(?P<M>[0-5]\d|\d)",
+    S=r"(?P<S>6[0-1]|[0-5]\d|\d)",
+    y=r"(?P<y>\d\d)",
+    Y=r"(?P<Y>\d\d\d\d)")
+
+
+@functools.lru_cache(maxsize=None)
+def compile_datetime_format(dt_format):
+    regex = ""
+    directives = set()
+    i = 0
+    while i < len(dt_format):
+        char = dt_format[i]
+        if char == "%":
+            directive = dt_format[i + 1:i + 2]
+            if directive == "%":
+                regex += "%"
+            elif directive in datetime_directive_regexes \
+                    and directive not in directives:
+                regex += datetime_directive_regexes[directive]
+                directives.add(directive)
+            else:
+                # left to strptime
+                return None
+            i += 2
+        elif char.isspace():
+            regex += r"\s+"
+            while i < len(dt_format) and dt_format[i].isspace():
+                i += 1
+        else:
+            regex += re.escape(char)
+            i += 1
 
-    stem = pathlib.Path(note_path).stem
-    for fo in dt_formats:
+    return re.compile(regex, re.IGNORECASE)
+
+
+def parse_datetime(stem, dt_format):
+    regex = compile_datetime_format(dt_format)
+    if regex is None:
         try:
-            ts = datetime.datetime.strptime(stem, fo)
-            break
+            return datetime.datetime.strptime(stem, dt_format)
         except ValueError:
-            ts = None
+            return None
+
+    found = regex.match(stem)
+    if found is None or found.end() != len(stem):
+        return None
+
+    fields = found.groupdict()
+    if "Y" in fields:
+        year = int(fields["Y"])
+    elif "y" in fields:
+        year = int(fields["y"])
+        year += 2000 if year <= 68 else 1900
+    else:
+        year = 1900
+    fraction = fields.get("f", None)
+    fraction = int(fraction + "0" * (6 - len(fraction))) if fraction else 0
+
+    try:
+        return datetime.datetime(year,
+                                 int(fields.get("m", 1)),
+                                 int(fields.get("d", 1)),
+                                 int(fields.get("H", 0)),
+                                 int(fields.get("M", 0)),
+                                 int(fields.get("S", 0)),
+                                 fraction)
+    except ValueError:
+        return None
+
+
+def parse_filename_timestamp(stem, dt_formats, hint=None):
+    # the format which matched the previous note is tried first, but the
+    # first matching format of dt_formats still takes precedence
+    if hint is not None and hint < len(dt_formats):
+        ts = parse_datetime(stem, dt_formats[hint])
+        if ts is not None:
+            for i in range(hint):
+                ts_i = parse_datetime(stem, dt_formats[i])
+                if ts_i is not None:
+                    return ts_i, i
+            return ts, hint
+
+    for i, fo in enumerate(dt_formats):
+        if i == hint:
+            continue
+        ts = parse_datetime(stem, fo)
+        if ts is not None:
+            return ts, i
+
+    return None, None
+
+
+def get_timestamp(note_path, dt_formats, dir_entry=None, hint=None):
+
+    stem = pathlib.Path(note_path).stem
+    ts, format_index = parse_filename_timestamp(stem, dt_formats, hint)
 
     if ts is None:
         print_jmk(f"Failed to parse timestamp from filename {note_path}")
-        ts = datetime.datetime.fromtimestamp(os.path.getctime(note_path))
+        if dir_entry is None:
+            ctime = os.path.getctime(note_path)
+        else:
+            ctime = dir_entry.stat().st_ctime
+        ts = datetime.datetime.fromtimestamp(ctime)
+
+    return ts, format_index
+
+
+def is_in_period(ts, period):
 
     if period[0] is not None:
         is_greater = ts >= period[0]
@@ -147,36 +593,123 @@ def parse_timestamp(note_path, period, dt_formats):
     else:
         is_less = True
 
-    return ts, is_greater and is_less
+    return is_greater and is_less
+
+
+def parse_timestamp(note_path, period, dt_formats):
+
+    ts, format_index = get_timestamp(note_path, dt_formats)
 
+    return ts, is_in_period(ts, period)
 
-def find_notes(note_dirs, note_endings, exclude_note_endings, period, dt_formats):
+
+def scan_notes_directory(note_dir, note_endings, exclude_note_endings,
+                         dt_formats, index, scan_time_ns, mtime_ns=None,
+                         dir_entries=None):
+    if mtime_ns is None:
+        mtime_ns = os.stat(note_dir).st_mtime_ns
+    entry = index["notes_directories"].get(note_dir)
+    if entry is not None and entry["mtime"] == mtime_ns:
+        return entry
+    hint = entry.get("format", None) if entry is not None else None
+
+    if dir_entries is None:
+        with os.scandir(note_dir) as it:
+            dir_entries = list(it)
+
+    note_endings = tuple(note_endings)
+    exclude_note_endings = tuple(exclude_note_endings)
+    notes = list()
+    for dir_entry in dir_entries:
+        note = dir_entry.name
+        if not dir_entry.is_file():
+            continue
+        if not note.endswith(note_endings):
+            continue
+        if note.endswith(exclude_note_endings):
+            continue
+        ts, format_index = get_timestamp(dir_entry.path,
+                                         dt_formats,
+                                         dir_entry,
+                                         hint)
+        if format_index is not None:
+            hint = format_index
+        notes.append((ts.isoformat(), note))
+
+    notes.sort()
+    if is_racy_mtime(mtime_ns, scan_time_ns):
+        mtime_ns = None
+
+    return dict(mtime=mtime_ns,
+                format=hint,
+                timestamps=[ts for ts, note in notes],
+                notes=[note for ts, note in notes])
+
+
+def load_metadata(note_dir, entry):
+    metadata_path = os.path.join(note_dir, metadata_filename)
+    try:
+        mtime_ns = os.stat(metadata_path).st_mtime_ns
+    except FileNotFoundError:
+        entry.update(metadata=None, metadata_mtime=None)
+        return None
+
+    if "metadata" not in entry or entry["metadata_mtime"] != mtime_ns:
+        with open(metadata_path) as mdf:
+            entry.update(metadata=json.load(mdf), metadata_mtime=mtime_ns)
+
+    return entry["metadata"]
+
+
+def find_notes(note_dirs, note_endings, exclude_note_endings, period,
+               dt_formats, index=None, build_dir=""):
+
+    if index is None:
+        index = new_scan_index(None)
+    notes_directories = dict()
+    scan_time_ns = time.time_ns()
+
+    # the notes of a directory are sorted by their timestamps, hence the
+    # notes in the period are found by bisection
+    start = period[0].isoformat() if period[0] is not None else None
+    end = period[1].isoformat() if period[1] is not None else None
 
     for note_dir in note_dirs:
+        entry = scan_notes_directory(note_dir,
+                                     note_endings,
+                                     exclude_note_endings,
+                                     dt_formats,
+                                     index,
+                                     scan_time_ns,
+                                     note_dirs[note_dir].pop("mtime", None),
+                                     note_dirs[note_dir].pop("dir_entries",
+                                                             None))
+        notes_directories[note_dir] = entry
+
+        timestamps = entry["timestamps"]
+        first = 0 if start is None else bisect.bisect_left(timestamps, start)
+        last = len(timestamps) if end is None \
+            else bisect.bisect_right(timestamps, end)
+
         notes = list()
         notes_tmp = list()
         notes_ts = list()
-        for note in os.listdir(note_dir):
+        for ts, note in zip(timestamps[first:last], entry["notes"][first:last]):
             note_path = os.path.join(note_dir, note)
-            if not os.path.isfile(note_path):
-                continue
-            if not any([note.endswith(ne) for ne in note_endings]):
-                continue
-            if any([note.endswith(ene) for ene in exclude_note_endings]):
-                continue
-            ts, is_in_period = parse_timestamp(note_path, period, dt_formats)
-            if is_in_period:
-                note_hash = hashlib.sha224(note_path.encode()).hexdigest()[:30]
-                note_tmp_path = os.path.join("tmp", note_hash + ".pdf")
-                note_tmp_path = os.path.abspath(note_tmp_path)
+            note_hash = hashlib.sha224(note_path.encode()).hexdigest()[:30]
+            note_tmp_path = os.path.join(build_dir, "tmp", note_hash + ".pdf")
+            note_tmp_path = os.path.abspath(note_tmp_path)
 
-                notes.append(note_path)
-                notes_tmp.append(note_tmp_path)
-                notes_ts.append(ts)
+            notes.append(note_path)
+            notes_tmp.append(note_tmp_path)
+            notes_ts.append(datetime.datetime.fromisoformat(ts))
 
         note_dirs[note_dir].update(notes=notes)
         note_dirs[note_dir].update(pdfs=notes_tmp)
         note_dirs[note_dir].update(timestamps=notes_ts)
+        note_dirs[note_dir].update(metadata=load_metadata(note_dir, entry))
+
+    index["notes_directories"] = notes_directories
 
     return note_dirs
 
@@ -184,6 +717,8 @@ def find_notes(note_dirs, note_endings, exclude_note_endings, period, dt_formats
 def parse_metadata(note_dirs):
 
     for note_dir in note_dirs:
+        if "metadata" in note_dirs[note_dir]:
+            continue
         note_dirs[note_dir].update(metadata=None)
         if metadata_filename in os.listdir(note_dir):
             with open(os.path.join(note_dir, metadata_filename)) as mdf:
@@ -192,66 +727,1205 @@ def parse_metadata(note_dirs):
     return note_dirs
 
 
-def make_pdf_note(note, pdf, pdf_commands, inplace_pdf_commands):
+@functools.lru_cache(maxsize=None)
+def compile_note_endings(note_endings):
+    # the search finds the leftmost, hence the longest matching note ending
+    return re.compile("(?:" + "|".join(map(re.escape, note_endings)) + r")\Z")
+
+
+def get_pdf_command(note, pdf_commands):
+    notes_ending = compile_note_endings(tuple(pdf_commands)).search(note)[0]
+
+    return notes_ending, pdf_commands[notes_ending]
+
+
+# the ioctl request of Linux to share the data of two files (a reflink)
+FICLONE = 0x40049409
+
+
+def reflink_file(src, dst):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(dst)
+        return False
+
+    return True
+
+
+def convert_copy(note, pdf):
+    # a hard link shares the modification time with the note, hence the pdf
+    # is up to date without touching the note
+    if os.path.lexists(pdf):
+        os.remove(pdf)
+    if not reflink_file(note, pdf):
+        link_file(note, pdf)
+
+
+def get_jpeg_image(data):
+    color_spaces = {1: "/DeviceGray", 3: "/DeviceRGB", 4: "/DeviceCMYK"}
+
+    # the size and the color components are taken from the start of frame
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            raise ValueError("Invalid JPEG marker")
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        length, = struct.unpack(">H", data[i + 2:i + 4])
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            bits, height, width, components = struct.unpack(
+                ">BHHB", data[i + 4:i + 10])
+            if components not in color_spaces:
+                raise ValueError(f"Unsupported number of JPEG color "
+                                 f"components {components}")
+            image_dict = f"/ColorSpace {color_spaces[components]} " \
+                         f"/BitsPerComponent {bits} /Filter /DCTDecode"
+            return width, height, image_dict, data
+        i += 2 + length
+
+    raise ValueError("No JPEG frame found")
+
+
+def get_png_image(data):
+    header = None
+    palette = None
+    idat = list()
+    i = 8
+    while i + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[i:i + 8])
+        chunk = data[i + 8:i + 8 + length]
+        if chunk_type == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif chunk_type == b"PLTE":
+            palette = chunk
+        elif chunk_type == b"IDAT":
+            idat.append(chunk)
+        elif chunk_type == b"IEND":
+            break
+        i += 12 + length
+
+    if header is None:
+        raise ValueError("No PNG header found")
+    width, height, bits, color_type, _, _, interlace = header
+    if interlace or color_type not in (0, 2, 3) or \
+            color_type == 3 and palette is None:
+        raise ValueError("Only non-interlaced PNG images without alpha "
+                         "channel are supported")
+
+    # the compressed PNG data is used as is, with the PNG predictors
+    if color_type == 3:
+        color_space = f"[/Indexed /DeviceRGB {len(palette) // 3 - 1} " \
+                      f"<{palette.hex()}>]"
+    else:
+        color_space = "/DeviceRGB" if color_type == 2 else "/DeviceGray"
+    colors = 3 if color_type == 2 else 1
+    image_dict = f"/ColorSpace {color_space} /BitsPerComponent {bits} " \
+                 f"/Filter /FlateDecode /DecodeParms << /Predictor 15 " \
+                 f"/Colors {colors} /BitsPerComponent {bits} " \
+                 f"/Columns {width} >>"
+
+    return width, height, image_dict, b"".join(idat)
+
+
+def write_image_pdf(pdf, width, height, image_dict, image_data):
+    # the longer side of the page is as long as the one of an A4 page
+    scale = 842 / max(width, height)
+    page_width = round(width * scale, 2)
+    page_height = round(height * scale, 2)
+
+    content = f"q {page_width} 0 0 {page_height} 0 0 cm /Im0 Do Q".encode()
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R "
+        f"/MediaBox [0 0 {page_width} {page_height}] "
+        f"/Resources << /XObject << /Im0 4 0 R >> >> "
+        f"/Contents 5 0 R >>".encode(),
+        f"<< /Type /XObject /Subtype /Image /Width {width} "
+        f"/Height {height} {image_dict} /Length {len(image_data)} >>\n"
+        f"stream\n".encode() + image_data + b"\nendstream",
+        f"<< /Length {len(content)} >>\nstream\n".encode() + content +
+        b"\nendstream"]
+
+    write_pdf_objects(pdf, objects)
+
+
+def write_pdf_objects(pdf, objects):
+    # the first object is the catalog
+    output = bytearray(b"%PDF-1.5\n")
+    offsets = list()
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode()
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n" \
+              f"startxref\n{xref}\n%%EOF\n".encode()
+
+    pdf_tmp = pdf + ".part"
+    with open(pdf_tmp, "wb") as file:
+        file.write(output)
+    os.replace(pdf_tmp, pdf)
+
+
+def write_placeholder_pdf(pdf):
+    content = b"BT /F1 24 Tf 72 421 Td (The note could not be converted) " \
+              b"Tj ET"
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+        b"/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        f"<< /Length {len(content)} >>\nstream\n".encode() + content +
+        b"\nendstream"]
+
+    write_pdf_objects(pdf, objects)
+
+
+def check_pdf(pdf):
+    # a fast structural check, only the start, the end and the start of the
+    # cross-reference table of the pdf are read
+    try:
+        with open(pdf, "rb") as file:
+            head = file.read(1024)
+            size = file.seek(0, os.SEEK_END)
+            file.seek(max(0, size - 1024))
+            tail = file.read()
+            if b"%PDF-" not in head:
+                return "no pdf header"
+            matches = startxref_regex.findall(tail)
+            if not matches:
+                return "no startxref and %%EOF at the end, the pdf may be " \
+                       "truncated"
+            offset = int(matches[-1])
+            if offset >= size:
+                return f"startxref {offset} is beyond the end of the pdf"
+            file.seek(offset)
+            if not xref_regex.match(file.read(64)):
+                return f"no cross-reference table at startxref {offset}"
+    except OSError as error:
+        return str(error)
+
+    return None
+
+
+def convert_image(note, pdf):
+    with open(note, "rb") as file:
+        data = file.read()
+
+    if data.startswith(b"\xff\xd8"):
+        image = get_jpeg_image(data)
+    elif data.startswith(b"\x89PNG\r\n\x1a\n"):
+        image = get_png_image(data)
+    else:
+        raise ValueError("Only JPEG and PNG images are supported")
+
+    write_image_pdf(pdf, *image)
+
+
+builtin_command_prefix = "builtin:"
+
+builtin_converters = dict(copy=convert_copy, image=convert_image)
 
-    notes_ending = [ne for ne in pdf_commands if note.endswith(ne)][0]
-    pdf_command = pdf_commands[notes_ending]
 
-    if not os.path.exists("tmp"):
-        os.mkdir("tmp")
+def get_builtin_converter(pdf_command):
+    if not pdf_command.startswith(builtin_command_prefix):
+        return None
+
+    name = pdf_command[len(builtin_command_prefix):]
+    if name not in builtin_converters:
+        raise ValueError(f"Unknown builtin converter '{pdf_command}', "
+                         f"available are " +
+                         ", ".join(builtin_command_prefix + name
+                                   for name in builtin_converters))
+
+    return builtin_converters[name]
+
+
+def run_builtin_converter(converter, pdf_command, note, pdf):
+    print_jmk(f"Convert note {note} with {pdf_command}")
+
+    start = time.perf_counter()
+    returncode = 0
+    output = None
+    try:
+        converter(note, pdf)
+    except (OSError, ValueError, struct.error) as error:
+        print_jmk(f"Conversion of note {note} failed: {error}")
+        returncode = 1
+        output = str(error).encode()
+
+    completed_process = subprocess.CompletedProcess([pdf_command, note, pdf],
+                                                    returncode,
+                                                    output)
+    completed_process.seconds = time.perf_counter() - start
+    completed_process.max_rss = None
+
+    return completed_process
+
+
+class ConverterSlots:
+
+    def __init__(self, concurrency, profiles_dir):
+        if concurrency < 1:
+            raise ValueError(f"The concurrency of a converter must be "
+                             f"positive, got {concurrency}")
+        self.profiles_dir = profiles_dir
+        self.free_slots = queue.Queue()
+        for slot in range(concurrency):
+            self.free_slots.put(slot)
+
+    @contextlib.contextmanager
+    def acquire(self):
+        # each running conversion gets a profile directory of its own, which
+        # is kept for the following conversions in the same slot
+        slot = self.free_slots.get()
+        try:
+            yield os.path.join(self.profiles_dir, str(slot))
+        finally:
+            self.free_slots.put(slot)
+
+
+def get_converter_slots(pdf_commands, inplace_pdf_commands, concurrency=None,
+                        jobs=1, build_dir=""):
+    if concurrency is None:
+        concurrency = dict()
+
+    # in-place converters, like LibreOffice, often can not run concurrently
+    # without a profile directory per conversion, hence they run one by one
+    # unless a concurrency is given
+    profiles_dir = os.path.abspath(os.path.join(build_dir,
+                                                profiles_directory))
+    return {ending: ConverterSlots(
+                concurrency.get(ending,
+                                1 if ending in inplace_pdf_commands else jobs),
+                os.path.join(profiles_dir, ending))
+            for ending in pdf_commands}
+
+
+@contextlib.contextmanager
+def converter_slot(slots, notes_ending):
+    if slots is None or notes_ending not in slots:
+        yield None
+        return
+
+    with slots[notes_ending].acquire() as profile_dir:
+        yield profile_dir
+
+
+def substitute_profile_placeholders(cmd_part, profile_dir):
+    if profile_dir is None or not ("{profiledir}" in cmd_part
+                                   or "{profileurl}" in cmd_part):
+        return cmd_part
+
+    os.makedirs(profile_dir, exist_ok=True)
+    cmd_part = cmd_part.replace("{profiledir}", profile_dir)
+    return cmd_part.replace("{profileurl}", pathlib.Path(profile_dir).as_uri())
+
+
+def make_pdf_note(note, pdf, pdf_commands, inplace_pdf_commands,
+                  capture_output=False, workers=None, timeout=None,
+                  slots=None):
+
+    notes_ending, pdf_command = get_pdf_command(note, pdf_commands)
+
+    outdir = os.path.dirname(pdf)
+    os.makedirs(outdir, exist_ok=True)
+
+    converter = get_builtin_converter(pdf_command)
+    if converter is not None:
+        return run_builtin_converter(converter, pdf_command, note, pdf)
+
+    # the old pdf may be a hard link to the note, which must not be
+    # overwritten by the conversion command
+    if os.path.lexists(pdf):
+        os.remove(pdf)
+
+    if workers is not None and notes_ending in workers:
+        return workers[notes_ending].convert(note, pdf, timeout)
 
     note_path = pathlib.Path(note)
     is_inplace_command = note_path.suffix[1:] in inplace_pdf_commands
 
-    command_tmp = pdf_command.split(" ")
-    command = list()
-    for cmd_part in command_tmp:
-        if "{" + notes_ending + "}" == cmd_part:
-            command.append(note)
-        elif not is_inplace_command and "{pdf}" == cmd_part:
-            command.append(pdf)
-        elif is_inplace_command and "{outdir}" == cmd_part:
-            command.append(os.getcwd())
-        else:
-            command.append(cmd_part)
+    with converter_slot(slots, notes_ending) as profile_dir:
+        if is_inplace_command:
+            # each in-place conversion writes into a scratch directory of
+            # its own, hence notes with the same stem do not collide
+            outdir = os.path.abspath(tempfile.mkdtemp(prefix="job-",
+                                                      dir=outdir))
+
+        command_tmp = pdf_command.split(" ")
+        command = list()
+        for cmd_part in command_tmp:
+            if "{" + notes_ending + "}" == cmd_part:
+                command.append(note)
+            elif not is_inplace_command and "{pdf}" == cmd_part:
+                command.append(pdf)
+            elif is_inplace_command and "{outdir}" == cmd_part:
+                command.append(outdir)
+            else:
+                command.append(substitute_profile_placeholders(cmd_part,
+                                                               profile_dir))
+
+        if not is_inplace_command:
+            return run_command(command, capture_output, timeout=timeout)
+
+        try:
+            command_output = run_command(command, capture_output,
+                                         cwd=outdir, timeout=timeout)
+            src_file = os.path.join(outdir, note_path.stem + ".pdf")
+            if os.path.isfile(src_file):
+                shutil.move(src_file, pdf)
+        finally:
+            shutil.rmtree(outdir, ignore_errors=True)
 
-    if is_inplace_command:
-        command_output = run_command(command)
-        src_file = os.path.join(os.getcwd(), note_path.stem + ".pdf")
-        shutil.move(src_file, pdf)
         return command_output
+
+
+class ConverterWorker:
+
+    def __init__(self, command):
+        self.command = command.split(" ")
+        self.process = None
+        self.job_id = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        print_jmk("Start converter worker '" + " ".join(self.command) + "'")
+        self.process = subprocess.Popen(self.command,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        text=True,
+                                        bufsize=1)
+
+    def read_result(self, job_id):
+        output = list()
+        for line in self.process.stdout:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                result = None
+            if isinstance(result, dict) and result.get("id") == job_id:
+                if output:
+                    result["output"] = "".join(output) + \
+                                       result.get("output", "")
+                return result
+            # anything else printed by the worker is kept as its output
+            output.append(line)
+
+        return dict(returncode=None, output="".join(output))
+
+    def convert(self, note, pdf, timeout=None):
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+
+            start = time.perf_counter()
+            self.job_id += 1
+            job = dict(id=self.job_id, note=note, pdf=pdf)
+            args = self.command + [note, pdf]
+            print_jmk("Convert note " + note + " with worker '" +
+                      " ".join(self.command) + "'")
+            # a hanging worker is killed and started again for the next note
+            timer = None
+            if timeout is not None:
+                timer = threading.Timer(timeout, self.process.kill)
+                timer.start()
+            try:
+                self.process.stdin.write(json.dumps(job) + "\n")
+                self.process.stdin.flush()
+                result = self.read_result(self.job_id)
+            except OSError:
+                result = dict(returncode=None, output="")
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+            if result["returncode"] is None:
+                returncode = self.process.wait()
+                print_jmk("Converter worker '" + " ".join(self.command) +
+                          f"' stopped with return code {returncode}")
+                self.process = None
+                result["returncode"] = returncode or 1
+
+            if result.get("output", ""):
+                print_output(result["output"].encode())
+
+            completed_process = subprocess.CompletedProcess(
+                args, result["returncode"], result.get("output", None))
+            completed_process.seconds = time.perf_counter() - start
+            completed_process.max_rss = None
+
+            return completed_process
+
+    def close(self):
+        if self.process is None:
+            return
+
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+
+class ConverterWorkerPool:
+
+    def __init__(self, command, size=1):
+        if size < 1:
+            raise ValueError(f"The number of converter workers must be "
+                             f"positive, got {size}")
+        self.workers = [ConverterWorker(command) for _ in range(size)]
+        # the workers are started on their first note, the last used worker
+        # is taken first, hence only as many workers run as jobs need them
+        self.idle_workers = queue.LifoQueue()
+        for worker in reversed(self.workers):
+            self.idle_workers.put(worker)
+
+    def convert(self, note, pdf, timeout=None):
+        worker = self.idle_workers.get()
+        try:
+            return worker.convert(note, pdf, timeout)
+        finally:
+            self.idle_workers.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+def serve_converter_worker(convert, stdin=None, stdout=None):
+    stdin = sys.stdin if stdin is None else stdin
+    stdout = sys.stdout if stdout is None else stdout
+
+    for line in stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        try:
+            returncode, output = convert(job["note"], job["pdf"])
+        except Exception as e:
+            returncode, output = 1, f"{type(e).__name__}: {e}\n"
+        stdout.write(json.dumps(dict(id=job["id"],
+                                     returncode=returncode,
+                                     output=output)) + "\n")
+        stdout.flush()
+
+
+def get_exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+
+def get_max_rss(rusage):
+    # ru_maxrss is given in kilobytes, except for macOS
+    if platform.system() == "Darwin":
+        return rusage.ru_maxrss
+
+    return rusage.ru_maxrss * 1024
+
+
+def kill_process_group(process):
+    if hasattr(os, "killpg"):
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
     else:
-        return run_command(command)
+        process.kill()
+
+
+class SessionProcesses:
+
+    def __init__(self):
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def add(self, process):
+        with self.lock:
+            if self.stopped:
+                kill_process_group(process)
+            else:
+                self.processes.add(process)
+
+    def remove(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def reset(self):
+        with self.lock:
+            self.stopped = False
 
+    def stop(self):
+        # commands started from now on are killed at once, hence the
+        # remaining notes of a batch are not converted
+        with self.lock:
+            self.stopped = True
+            for process in self.processes:
+                kill_process_group(process)
 
-def run_command(command):
+
+# commands with a timeout run in a session of their own and do not get the
+# interrupt of the terminal, hence they are killed on a KeyboardInterrupt
+session_processes = SessionProcesses()
+
+
+def run_command(command, capture_output=False, cwd=None, timeout=None):
     print_jmk("Run command '" + " ".join(command) + "'")
-    return subprocess.run(command)
+
+    start = time.perf_counter()
+    max_rss = None
+    output = None
+    timed_out = threading.Event()
+    with subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE if capture_output else None,
+            stderr=subprocess.STDOUT if capture_output else None,
+            cwd=cwd,
+            # on a timeout, the children of the command are killed as well
+            start_new_session=timeout is not None) as process:
+        timer = None
+        if timeout is not None:
+            session_processes.add(process)
+            timer = threading.Timer(timeout,
+                                    lambda: (timed_out.set(),
+                                             kill_process_group(process)))
+            timer.start()
+        try:
+            if capture_output:
+                output = process.stdout.read()
+            if hasattr(os, "wait4"):
+                # unlike subprocess.run, this provides the resource usage
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = get_exit_code(status)
+                max_rss = get_max_rss(rusage)
+            else:
+                process.wait()
+        except BaseException:
+            if timeout is not None:
+                kill_process_group(process)
+            else:
+                process.kill()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+                session_processes.remove(process)
+
+    completed_process = subprocess.CompletedProcess(command,
+                                                    process.returncode,
+                                                    output)
+    completed_process.seconds = time.perf_counter() - start
+    completed_process.max_rss = max_rss
+    completed_process.timed_out = timed_out.is_set()
+
+    if timed_out.is_set():
+        print_jmk("Command '" + " ".join(command) +
+                  f"' killed after the timeout of {timeout} s")
+
+    if capture_output:
+        print_jmk("Output of command '" + " ".join(command) + "'")
+        print_output(output)
+
+    return completed_process
+
+
+def is_pdf_note_outdated(note, note_tmp):
+    if not os.path.exists(note_tmp):
+        return True
+
+    return os.path.getmtime(note_tmp) < os.path.getmtime(note)
+
+
+def get_cache_directory(conf, build_dir=""):
+    if "cache_directory" not in conf:
+        cache_home = os.environ.get("XDG_CACHE_HOME",
+                                    os.path.join("~", ".cache"))
+        cache_dir = os.path.join(cache_home, "journalmk")
+    elif conf["cache_directory"] is None:
+        return None
+    else:
+        cache_dir = os.path.join(*conf["cache_directory"])
+
+    return os.path.abspath(os.path.join(build_dir,
+                                        os.path.expanduser(cache_dir)))
+
+
+@contextlib.contextmanager
+def cache_lock(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "lock"), "a+") as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    file.seek(0)
+                    msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def get_note_digest(note, pdf_command, is_inplace_command):
+    digest = hashlib.sha224()
+    digest.update(pdf_command.encode())
+    digest.update(b"inplace" if is_inplace_command else b"direct")
+    with open(note, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def get_cached_pdf_path(cache_dir, digest):
+    return os.path.join(cache_dir, "pdfs", digest[:2], digest + ".pdf")
+
+
+def link_file(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def lookup_cached_pdf_note(note, pdf, pdf_commands, inplace_pdf_commands,
+                           cache_dir):
+
+    notes_ending, pdf_command = get_pdf_command(note, pdf_commands)
+    is_inplace_command = notes_ending in inplace_pdf_commands
+    digest = get_note_digest(note, pdf_command, is_inplace_command)
+    cached_pdf = get_cached_pdf_path(cache_dir, digest)
+
+    os.makedirs(os.path.dirname(pdf), exist_ok=True)
+    with cache_lock(cache_dir):
+        if os.path.isfile(cached_pdf):
+            print_jmk(f"Use cached pdf {cached_pdf} for note {note}")
+            link_file(cached_pdf, pdf)
+            os.utime(pdf)
+            return cached_pdf, True
+
+    # the old pdf may be a hard link into the cache, which must not be
+    # overwritten by the conversion command
+    if os.path.lexists(pdf):
+        os.remove(pdf)
+
+    return cached_pdf, False
+
+
+def store_cached_pdf_note(pdf, cached_pdf, cache_dir):
+    with cache_lock(cache_dir):
+        os.makedirs(os.path.dirname(cached_pdf), exist_ok=True)
+        cached_pdf_tmp = cached_pdf + ".part"
+        link_file(pdf, cached_pdf_tmp)
+        os.replace(cached_pdf_tmp, cached_pdf)
+
+
+def make_cached_pdf_note(note, pdf, pdf_commands, inplace_pdf_commands,
+                         cache_dir, capture_output=False, workers=None,
+                         timeout=None, slots=None):
+
+    # builtin conversions are cheaper than the cache lookup, moreover their
+    # pdf may be a hard link to the note, which must not be touched
+    if get_builtin_converter(get_pdf_command(note, pdf_commands)[1]):
+        return make_pdf_note(note, pdf, pdf_commands, inplace_pdf_commands,
+                             capture_output, workers, timeout, slots)
+
+    cached_pdf, is_cached = lookup_cached_pdf_note(note,
+                                                   pdf,
+                                                   pdf_commands,
+                                                   inplace_pdf_commands,
+                                                   cache_dir)
+    if is_cached:
+        return subprocess.CompletedProcess(["cache", cached_pdf], 0)
+
+    completed_process = make_pdf_note(note,
+                                      pdf,
+                                      pdf_commands,
+                                      inplace_pdf_commands,
+                                      capture_output,
+                                      workers,
+                                      timeout,
+                                      slots)
+
+    if completed_process.returncode == 0 and check_pdf(pdf) is None:
+        store_cached_pdf_note(pdf, cached_pdf, cache_dir)
+
+    return completed_process
 
 
-def make_pdf_notes(note_dirs, pdf_commands, inplace_pdf_commands):
+def make_pdf_note_batch(notes, pdfs, pdf_commands, capture_output=False,
+                        timeout=None, slots=None):
+
+    notes_ending, pdf_command = get_pdf_command(notes[0], pdf_commands)
+
+    os.makedirs(os.path.dirname(pdfs[0]), exist_ok=True)
+    outdir = os.path.abspath(tempfile.mkdtemp(prefix="batch-",
+                                              dir=os.path.dirname(pdfs[0])))
+
+    try:
+        with converter_slot(slots, notes_ending) as profile_dir:
+            command = list()
+            for cmd_part in pdf_command.split(" "):
+                if "{" + notes_ending + "}" == cmd_part:
+                    command.extend(notes)
+                elif "{outdir}" == cmd_part:
+                    command.append(outdir)
+                else:
+                    command.append(substitute_profile_placeholders(
+                        cmd_part, profile_dir))
+
+            command_output = run_command(command, capture_output, cwd=outdir,
+                                         timeout=timeout)
+        for note, pdf in zip(notes, pdfs):
+            src_file = os.path.join(outdir, pathlib.Path(note).stem + ".pdf")
+            if os.path.isfile(src_file):
+                shutil.move(src_file, pdf)
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+    return command_output
+
+
+def make_pdf_notes_batch(notes, pdfs, pdf_commands, inplace_pdf_commands,
+                         cache_dir=None, capture_output=False, timeout=None,
+                         slots=None):
+
+    results = list()
+    cached_pdfs = list()
+    if cache_dir is not None:
+        pending = list()
+        for note, pdf in zip(notes, pdfs):
+            cached_pdf, is_cached = lookup_cached_pdf_note(
+                note, pdf, pdf_commands, inplace_pdf_commands, cache_dir)
+            if is_cached:
+                results.append((pdf, subprocess.CompletedProcess(
+                    ["cache", cached_pdf], 0)))
+            else:
+                pending.append((note, pdf))
+                cached_pdfs.append(cached_pdf)
+        notes = [note for note, pdf in pending]
+        pdfs = [pdf for note, pdf in pending]
+
+    if not notes:
+        return results
+
+    # the timeout is given per note
+    if timeout is not None:
+        timeout *= len(notes)
+    completed_process = make_pdf_note_batch(notes,
+                                            pdfs,
+                                            pdf_commands,
+                                            capture_output,
+                                            timeout,
+                                            slots)
+    for i, pdf in enumerate(pdfs):
+        if cache_dir is not None and completed_process.returncode == 0 \
+                and check_pdf(pdf) is None:
+            store_cached_pdf_note(pdf, cached_pdfs[i], cache_dir)
+        results.append((pdf, completed_process))
+
+    return results
+
+
+def get_pdf_note_batches(pdf_jobs, pdf_commands, inplace_pdf_commands,
+                         batch_size):
+    # in-place commands write <stem>.pdf, hence the stems of the notes of
+    # one batch have to be unique
+    batches = list()
+    open_batches = dict()
+    for note, note_tmp in pdf_jobs:
+        notes_ending, pdf_command = get_pdf_command(note, pdf_commands)
+        if notes_ending not in inplace_pdf_commands or batch_size == 1 or \
+                get_builtin_converter(pdf_command) is not None:
+            batches.append([(note, note_tmp)])
+            continue
+
+        stem = pathlib.Path(note).stem
+        ending_batches = open_batches.setdefault(notes_ending, list())
+        for batch, stems in ending_batches:
+            if stem not in stems and \
+                    (batch_size is None or len(batch) < batch_size):
+                batch.append((note, note_tmp))
+                stems.add(stem)
+                break
+        else:
+            batch = [(note, note_tmp)]
+            ending_batches.append((batch, {stem}))
+            batches.append(batch)
+
+    return batches
+
+
+def get_timeout(note, pdf_commands, timeouts=None):
+    if timeouts is None:
+        return None
+
+    return timeouts.get(get_pdf_command(note, pdf_commands)[0], None)
+
+
+def convert_pdf_notes(batch, pdf_commands, inplace_pdf_commands, cache_dir,
+                      capture_output, workers=None, timeouts=None, slots=None):
+
+    timeout = get_timeout(batch[0][0], pdf_commands, timeouts)
+    if len(batch) > 1:
+        return make_pdf_notes_batch([note for note, note_tmp in batch],
+                                    [note_tmp for note, note_tmp in batch],
+                                    pdf_commands,
+                                    inplace_pdf_commands,
+                                    cache_dir,
+                                    capture_output,
+                                    timeout,
+                                    slots)
+
+    note, note_tmp = batch[0]
+    if cache_dir is None:
+        completed_process = make_pdf_note(note,
+                                          note_tmp,
+                                          pdf_commands,
+                                          inplace_pdf_commands,
+                                          capture_output,
+                                          workers,
+                                          timeout,
+                                          slots)
+    else:
+        completed_process = make_cached_pdf_note(note,
+                                                 note_tmp,
+                                                 pdf_commands,
+                                                 inplace_pdf_commands,
+                                                 cache_dir,
+                                                 capture_output,
+                                                 workers,
+                                                 timeout,
+                                                 slots)
+
+    return [(note_tmp, completed_process)]
+
+
+def get_conversion_records(batch, results, seconds, pdf_commands):
+    records = list()
+    notes = {note_tmp: note for note, note_tmp in batch}
+    for note_tmp, completed_process in results:
+        note = notes[note_tmp]
+        is_cached = completed_process.args[0] == "cache"
+        records.append(dict(
+            note=note,
+            extension=get_pdf_command(note, pdf_commands)[0],
+            seconds=seconds / len(results),
+            max_rss=getattr(completed_process, "max_rss", None),
+            returncode=completed_process.returncode,
+            cached=is_cached,
+            batch_size=len(batch)))
+
+    return records
+
+
+def convert_pdf_notes_timed(batch, *args):
+    start = time.perf_counter()
+    results = convert_pdf_notes(batch, *args)
+
+    return results, time.perf_counter() - start
+
+
+def load_failed_notes(build_dir=""):
+    try:
+        with open(os.path.join(build_dir, failed_notes_filename)) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return dict()
+
+
+def save_failed_notes(failed_notes, build_dir=""):
+    filename = os.path.join(build_dir, failed_notes_filename)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    failed_notes_tmp_filename = filename + ".part"
+    with open(failed_notes_tmp_filename, "w") as file:
+        json.dump(failed_notes, file, indent=1)
+    os.replace(failed_notes_tmp_filename, filename)
+
+
+def clear_failed_notes(build_dir=""):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(build_dir, failed_notes_filename))
+        print_jmk("Try to convert the failed notes again")
+
+
+def get_failed_note_signature(note, pdf_commands):
+    return dict(mtime=os.stat(note).st_mtime_ns,
+                command=get_pdf_command(note, pdf_commands)[1])
+
+
+def is_failed_note(note, failed_notes, pdf_commands):
+    failed_note = failed_notes.get(note, None)
+
+    return failed_note is not None and \
+        failed_note["signature"] == get_failed_note_signature(note,
+                                                              pdf_commands)
+
+
+def load_conversion_stats(build_dir=""):
+    try:
+        with open(os.path.join(build_dir, conversion_stats_filename)) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return dict()
+
+
+def update_conversion_stats(records, build_dir=""):
+    records = [record for record in records
+               if record["returncode"] == 0 and not record["cached"]]
+    if not records:
+        return
+
+    stats = load_conversion_stats(build_dir)
+    for record in records:
+        count, seconds = stats.get(record["extension"], (0, 0.))
+        if count >= conversion_stats_window:
+            seconds *= (conversion_stats_window - 1) / count
+            count = conversion_stats_window - 1
+        stats[record["extension"]] = (count + 1, seconds + record["seconds"])
+
+    filename = os.path.join(build_dir, conversion_stats_filename)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    stats_tmp_filename = filename + ".part"
+    with open(stats_tmp_filename, "w") as file:
+        json.dump(stats, file, indent=1)
+    os.replace(stats_tmp_filename, filename)
+
+
+def make_pdf_notes(note_dirs, pdf_commands, inplace_pdf_commands, jobs=1,
+                   cache_dir=None, batch_size=1, worker_commands=None,
+                   records=None, timeouts=None, negative_cache=False,
+                   build_dir="", concurrency=None):
     failed_processes = list()
 
+    failed_notes = load_failed_notes(build_dir) if negative_cache else dict()
+    pdf_jobs = list()
     for note_dir in note_dirs:
         notes = note_dirs[note_dir]["notes"]
         notes_tmp = note_dirs[note_dir]["pdfs"]
         for note, note_tmp in zip(notes, notes_tmp):
-            note_mtime = os.path.getmtime(note)
-            if os.path.exists(note_tmp):
-                note_tmp_mtime = os.path.getmtime(note_tmp)
-                create_pdf = note_tmp_mtime < note_mtime
+            if is_pdf_note_outdated(note, note_tmp):
+                # notes, which failed before, are skipped until they change
+                if is_failed_note(note, failed_notes, pdf_commands):
+                    failed_note = failed_notes[note]
+                    failed_processes.append(
+                        (2, f"Skipped note {note}, its conversion failed "
+                            f"with return code {failed_note['returncode']} "
+                            f"and the note did not change since"))
+                    continue
+                pdf_jobs.append((note, note_tmp))
             else:
-                create_pdf = True
-
-            if create_pdf:
-                completed_process = make_pdf_note(note,
-                                                  note_tmp,
-                                                  pdf_commands,
-                                                  inplace_pdf_commands)
-                if completed_process.returncode != 0:
-                    failed_processes.append((0, completed_process))
-                elif not os.path.isfile(note_tmp):
-                    failed_processes.append((1, completed_process))
+                failed_notes.pop(note, None)
+
+    if not pdf_jobs:
+        if negative_cache:
+            save_failed_notes(failed_notes, build_dir)
+        return failed_processes
+
+    batches = get_pdf_note_batches(pdf_jobs,
+                                   pdf_commands,
+                                   inplace_pdf_commands,
+                                   batch_size)
+
+    slots = get_converter_slots(pdf_commands,
+                                inplace_pdf_commands,
+                                concurrency,
+                                jobs,
+                                build_dir)
+
+    jobs = max(1, min(jobs, len(batches)))
+    # every job converts with a worker of its own
+    if worker_commands is None:
+        worker_commands = dict()
+    if concurrency is None:
+        concurrency = dict()
+    workers = {ending: ConverterWorkerPool(command,
+                                           concurrency.get(ending, jobs))
+               for ending, command in worker_commands.items()}
+    print_jmk(f"Convert {len(pdf_jobs)} notes with {jobs} parallel jobs")
+    session_processes.reset()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) \
+                as executor:
+            futures = [executor.submit(convert_pdf_notes_timed,
+                                       batch,
+                                       pdf_commands,
+                                       inplace_pdf_commands,
+                                       cache_dir,
+                                       jobs > 1,
+                                       workers,
+                                       timeouts,
+                                       slots)
+                       for batch in batches]
+
+            for batch, future in zip(batches, futures):
+                try:
+                    results, seconds = future.result()
+                except KeyboardInterrupt:
+                    for pending_future in futures:
+                        pending_future.cancel()
+                    session_processes.stop()
+                    raise
+                if records is not None:
+                    records.extend(get_conversion_records(batch,
+                                                          results,
+                                                          seconds,
+                                                          pdf_commands))
+                failed_batch_processes = list()
+                notes = {note_tmp: note for note, note_tmp in batch}
+                for note_tmp, completed_process in results:
+                    note = notes[note_tmp]
+                    # an invalid pdf would only fail the LaTeX run
+                    error = check_pdf(note_tmp) \
+                        if os.path.isfile(note_tmp) else None
+                    if error is not None:
+                        os.remove(note_tmp)
+                        failed_processes.append(
+                            (2, f"Removed the invalid pdf {note_tmp} of "
+                                f"note {note}: {error}"))
+
+                    if completed_process.returncode != 0:
+                        if completed_process not in failed_batch_processes:
+                            failed_batch_processes.append(completed_process)
+                            failed_processes.append((0, completed_process))
+                    elif not os.path.isfile(note_tmp) and error is None:
+                        failed_processes.append((1, completed_process))
+
+                    # in a failed batch, some notes may still be converted
+                    if not os.path.isfile(note_tmp) or \
+                            completed_process.returncode != 0 and \
+                            is_pdf_note_outdated(note, note_tmp):
+                        failed_notes[note] = dict(
+                            signature=get_failed_note_signature(note,
+                                                                pdf_commands),
+                            returncode=completed_process.returncode)
+                    else:
+                        failed_notes.pop(note, None)
+    finally:
+        for worker in workers.values():
+            worker.close()
+        if negative_cache:
+            save_failed_notes(failed_notes, build_dir)
+
+    return failed_processes
+
+
+class NoteEntry:
+    __slots__ = ("note", "pdf", "timestamp", "metadata", "label")
+
+    def __init__(self, note, pdf, timestamp, metadata=None, label=None):
+        self.note = note
+        self.pdf = pdf
+        self.timestamp = timestamp
+        self.metadata = metadata
+        self.label = label
+
+    def __repr__(self):
+        return f"NoteEntry({self.note!r}, {self.pdf!r}, {self.timestamp!r})"
+
+
+def get_optimized_pdf_path(pdf):
+    return os.path.splitext(pdf)[0] + ".opt.pdf"
+
+
+def get_pdf_optimizer_command(optimizer, pdf, optimized_pdf, resolution):
+    optimizer = pdf_optimizer_commands.get(optimizer, optimizer)
+
+    command = list()
+    for cmd_part in optimizer.split(" "):
+        cmd_part = cmd_part.replace("{optpdf}", optimized_pdf)
+        cmd_part = cmd_part.replace("{pdf}", pdf)
+        cmd_part = cmd_part.replace("{resolution}", str(resolution))
+        command.append(cmd_part)
+
+    return command
+
+
+def optimize_pdf_note(pdf, optimizer, resolution, capture_output=False):
+    optimized_pdf = get_optimized_pdf_path(pdf)
+    command = get_pdf_optimizer_command(optimizer,
+                                        pdf,
+                                        optimized_pdf,
+                                        resolution)
+
+    # the optimized pdf is outdated together with the raw pdf
+    fingerprint = get_fingerprint(" ".join(command), [pdf])
+    fingerprint_filename = optimized_pdf + ".fingerprint"
+    if not is_fingerprint_outdated(fingerprint_filename,
+                                   fingerprint,
+                                   optimized_pdf):
+        return None
+
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(fingerprint_filename)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(optimized_pdf)
+    process = run_command(command, capture_output)
+    if process.returncode != 0 or not os.path.isfile(optimized_pdf):
+        return process
+
+    # keep the raw pdf, if the optimizer could not make it smaller
+    if os.path.getsize(optimized_pdf) >= os.path.getsize(pdf):
+        os.remove(optimized_pdf)
+        link_file(pdf, optimized_pdf)
+    with open(fingerprint_filename, "w") as file:
+        file.write(fingerprint)
+
+    return process
+
+
+def optimize_pdf_notes(note_dirs, optimizer, resolution=150, jobs=1):
+    pdfs = [pdf for nd in note_dirs.values() for pdf in nd["pdfs"]
+            if os.path.isfile(pdf)]
+
+    failed_processes = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(optimize_pdf_note,
+                                   pdf,
+                                   optimizer,
+                                   resolution,
+                                   jobs > 1)
+                   for pdf in pdfs]
+        for future in futures:
+            process = future.result()
+            if process is not None and process.returncode != 0:
+                failed_processes.append((0, process))
+
+    # the notes use the optimized pdfs, where the optimization succeeded
+    optimized_pdfs = {
+        pdf: get_optimized_pdf_path(pdf) for pdf in pdfs
+        if os.path.isfile(get_optimized_pdf_path(pdf) + ".fingerprint")}
+    for nd in note_dirs.values():
+        nd["pdfs"] = [optimized_pdfs.get(pdf, pdf) for pdf in nd["pdfs"]]
 
     return failed_processes
 
@@ -261,220 +1935,1042 @@ def get_subsections(note_dirs, formats, metadata=False):
     if metadata:
         note_dirs = parse_metadata(note_dirs)
 
+    datetime_format = formats["datetime_journal_format"]
     subsections = list()
     for nd in note_dirs.values():
-        if "metadata" in nd:
-            md = nd["metadata"]
-        else:
-            md = None
+        md = nd.get("metadata", None)
 
         for note, pdf, ts in zip(nd["notes"], nd["pdfs"], nd["timestamps"]):
-            subsection = (note, pdf, ts, md)
-
             subsections.append(
-                (ts.strftime(formats["datetime_journal_format"]), subsection))
+                NoteEntry(note, pdf, ts, md, ts.strftime(datetime_format)))
 
-    subsections = sorted(subsections, key=lambda it: it[1][2], reverse=True)
+    subsections.sort(key=operator.attrgetter("timestamp"), reverse=True)
 
     return subsections
 
 
+def get_week_number(ts):
+    # the week number of strftime("%W"), without formatting a string
+    return (ts.timetuple().tm_yday + 6 - ts.weekday()) // 7
+
+
 def classify_chronological_entry(entry):
-    ts = entry[2]
-    part_name = ts.strftime("%Y")
-    chapter_name = ts.strftime("%B %Y")
-    section_name = ts.strftime("%W %Y")
+    ts = entry.timestamp
 
-    return part_name, chapter_name, section_name
+    return ts.year, (ts.year, ts.month), (ts.year, get_week_number(ts))
 
 
 def classify_topological_entry(entry):
+    md = entry.metadata
+    if md is None or md.get("part", None) is None:
+        ts = entry.timestamp
+        return None, ts.year, (ts.year, ts.month)
 
-    md = entry[3]
-    unsorted = False
-    if md is None:
-        unsorted = True
-    else:
-        if "part" in md:
-            part_name = md["part"]
-            chapter_name = md["chapter"] if "chapter" in md else None
-            section_name = md["section"] if "section" in md else None
-        else:
-            unsorted = True
+    return md["part"], md.get("chapter", None), md.get("section", None)
 
-    if unsorted:
-        ts = entry[2]
-        part_name = None
-        chapter_name = ts.strftime("%Y")
-        section_name = ts.strftime("%B %Y")
 
-    return part_name, chapter_name, section_name
+chronological_label_formats = ("year_journal_format",
+                               "month_year_journal_format",
+                               "week_number_format")
 
+unsorted_label_formats = (None,
+                          "year_journal_format",
+                          "month_year_journal_format")
 
-def format_chronological_document_limb(limb, limb_format, subsec_ts):
-    limb = [(subsec_ts(v).strftime(limb_format), v)
-            for v in sorted(limb.values(), key=subsec_ts, reverse=True)]
 
-    return limb
+def get_chronological_label(entry, keys, level, formats):
+    return entry.timestamp.strftime(formats[chronological_label_formats[level]])
 
 
-def format_chronological_document_tree(parts, formats):
-    for part, chapters in parts.items():
-        for chapter, sections in chapters.items():
-            parts[part][chapter] = format_chronological_document_limb(
-                sections,
-                formats["week_number_format"],
-                lambda it: it[0][1][2])
+def get_topological_label(entry, keys, level, formats):
+    if keys[0] is not None:
+        return keys[level]
 
-    for part, chapters in parts.items():
-        parts[part] = format_chronological_document_limb(
-            chapters,
-            formats["month_year_journal_format"],
-            lambda it: it[0][1][0][1][2])
+    if level == 0:
+        return None
 
-    parts = format_chronological_document_limb(
-        parts,
-        formats["year_journal_format"],
-        lambda it: it[0][1][0][1][0][1][2])
+    return entry.timestamp.strftime(formats[unsorted_label_formats[level]])
 
-    return parts
 
+def get_topological_sort_key(keys):
+    part, chapter, section = keys
+    if part is None:
+        # unsorted notes come last, newest first
+        return True, "", -chapter, -section[1]
 
-def sort_topological_document_limb(branches, none_index=0):
+    return False, part, chapter is not None, chapter or "", \
+        section is not None, section or ""
 
-    none_branch = False
-    if None in branches:
-        none_branch = branches.pop(None)
 
-    branches = [(b, entries) for b, entries in
-                sorted(branches.items(), key=operator.itemgetter(0))]
+def sort_topological_entries(entries):
+    # the entries are sorted by time, hence the notes of every section
+    # stay sorted by time and only the sections have to be sorted
+    sections = dict()
+    for entry in entries:
+        keys = classify_topological_entry(entry)
+        if keys not in sections:
+            sections[keys] = list()
+        sections[keys].append(entry)
 
-    if not none_branch == False:
-        branches.insert(none_index, (None, none_branch))
+    return [(keys, entry)
+            for keys in sorted(sections, key=get_topological_sort_key)
+            for entry in sections[keys]]
 
-    return branches
 
+def get_document_tree(note_dirs, journal_type, formats, user_formats):
 
-def sort_topological_document_tree(parts):
+    if journal_type == "topological":
+        note_dirs = parse_metadata(note_dirs)
 
-    for part, chapters in parts.items():
-        for chapter, sections in parts[part].items():
-            if part is None:
-                parts[part][chapter] = format_chronological_document_limb(
-                    sections,
-                    formats["month_year_journal_format"],
-                    lambda it: it[0][1][2])
-            else:
-                parts[part][chapter] = sort_topological_document_limb(sections)
-
-    for part, chapters in parts.items():
-        if part is None:
-            parts[part] = format_chronological_document_limb(
-                chapters,
-                formats["year_journal_format"],
-                lambda it: it[0][1][0][1][2])
-        else:
-            parts[part] = sort_topological_document_limb(chapters)
+    subsections = get_subsections(note_dirs, formats, metadata=True)
 
-    parts = sort_topological_document_limb(parts, none_index=len(parts)-1)
+    if journal_type == "chronological":
+        classified_entries = ((classify_chronological_entry(entry), entry)
+                              for entry in subsections)
+        get_label = get_chronological_label
+        label_formats = user_formats
+    elif journal_type == "topological":
+        classified_entries = sort_topological_entries(subsections)
+        get_label = get_topological_label
+        label_formats = formats
+    else:
+        raise NotImplementedError
 
-    return parts
+    # one pass over the sorted entries, a new part, chapter or section is
+    # opened whenever its key changes
+    document_tree = list()
+    limbs = [document_tree]
+    previous_keys = None
+    for keys, entry in classified_entries:
+        level = 0
+        if previous_keys is not None:
+            while level < len(keys) and keys[level] == previous_keys[level]:
+                level += 1
+        del limbs[level + 1:]
+        for lvl in range(level, len(keys)):
+            branches = list()
+            limbs[lvl].append(
+                (get_label(entry, keys, lvl, label_formats), branches))
+            limbs.append(branches)
+        limbs[-1].append(entry)
+        previous_keys = keys
+
+    return document_tree
+
+
+def get_preamble(build_dir=""):
+    try:
+        with open(os.path.join(build_dir, "journal_template.tex"), "r") \
+                as file:
+            return file.read()
+    except FileNotFoundError:
+        return document_preamble
+
+
+def get_journal_preamble(conf, build_dir=""):
+    preamble = get_preamble(build_dir)
+    if not conf.get("precompiled_preamble", False) or \
+            end_of_dump_str.strip() in preamble:
+        return preamble
+
+    match = hyperref_regex.search(preamble)
+    if match is None:
+        return preamble + end_of_dump_str
+
+    return preamble[:match.start()] + end_of_dump_str + \
+        preamble[match.start():]
+
+
+def get_tex_engine(conf):
+    tex_engine = conf.get("tex_engine", "pdflatex")
+    if tex_engine not in tex_engines:
+        raise ValueError(f"Unknown tex engine '{tex_engine}', available are "
+                         + ", ".join(tex_engines))
+
+    return tex_engine
+
+
+def get_preamble_format_command(tex_engine, format_name):
+    return [tex_engine,
+            "-ini",
+            "-interaction=nonstopmode",
+            "-jobname=" + format_name,
+            "&" + tex_engine,
+            "mylatexformat.ltx",
+            format_name + ".tex"]
+
+
+def make_preamble_format(preamble, tex_engine, capture_output=False,
+                         build_dir=""):
+    format_filename = os.path.abspath(os.path.join(build_dir,
+                                                   preamble_format_name))
+    format_name = os.path.basename(format_filename)
+    command = get_preamble_format_command(tex_engine, format_name)
+
+    # the format only fits the tex installation it was dumped with
+    tex_binary = shutil.which(tex_engine)
+    fingerprint = get_fingerprint(preamble + " ".join(command),
+                                  [tex_binary] if tex_binary else list())
+    if not is_fingerprint_outdated(format_filename + ".fingerprint",
+                                   fingerprint,
+                                   format_filename + ".fmt"):
+        return None
+
+    print_jmk(f"Precompile the preamble into {format_filename}.fmt")
+    os.makedirs(os.path.dirname(format_filename), exist_ok=True)
+    for ending in (".fingerprint", ".fmt"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(format_filename + ending)
+    with open(format_filename + ".tex", "w") as file:
+        file.write(preamble + "\\begin{document}\n\\end{document}\n")
+    process = run_command(command, capture_output,
+                          cwd=os.path.dirname(format_filename))
+    if process.returncode != 0 or \
+            not os.path.isfile(format_filename + ".fmt"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(format_filename + ".fmt")
+        return process
+
+    with open(format_filename + ".fingerprint", "w") as file:
+        file.write(fingerprint)
+
+    return process
+
+
+def get_latexmk_command(conf, build_dir=""):
+    tex_engine = get_tex_engine(conf)
+    command = ["latexmk", "-norc", tex_engines[tex_engine]]
+
+    # without a format, e.g. if it could not be dumped, the preamble is
+    # loaded as usual
+    format_filename = os.path.abspath(os.path.join(build_dir,
+                                                   preamble_format_name))
+    if conf.get("precompiled_preamble", False) and \
+            os.path.isfile(format_filename + ".fmt"):
+        command.append(f"-{tex_engine}={tex_engine} -fmt={format_filename} "
+                       f"%O %S")
+
+    return command + conf.get("latexmk_options", list())
+
+
+def get_part_tex(part, chapters, toc=None):
+    # a part document marks the first page of each heading and note in its
+    # .pages file, the marked entries are collected in toc
+    def mark(kind, title):
+        if toc is None:
+            return ""
+        toc.append((kind, title))
+        return part_document_mark_str.format(kind=kind)
+
+    part_name = part if part is not None else "Unsorted"
+    tex = mark("part", part_name) + part_str.format(part=part_name)
+    for chapter, sections in chapters:
+        if chapter is not None:
+            tex += mark("chapter", chapter)
+            tex += chapter_str.format(chapter=chapter)
+        for section, subsections in sections:
+            label = pathlib.Path(subsections[0].pdf).stem
+            if section is None:
+                add_to_toc = list()
+            else:
+                tex += mark("section", section)
+                add_to_toc = [sec_toc_str.format(
+                    section=section,
+                    label=label)]
+            for entry in subsections:
+                label = pathlib.Path(entry.pdf).stem
+                add_to_toc.append(subsec_toc_str.format(
+                    subsection=entry.label,
+                    label=label))
+                tex += mark("subsection", entry.label)
+                tex += subsection_str.format(
+                    section=entry.label,
+                    addtotoc=", ".join(add_to_toc),
+                    datetime=entry.label,
+                    path=entry.note,
+                    path_text=entry.note.replace("_", "\\_"),
+                    file=entry.pdf
+                )
+                add_to_toc = list()
+
+    return tex
+
+
+def write_tex_file(document_tree, filename="journal.tex", subtitle=None,
+                   build_dir="", preamble=None):
+
+    if preamble is None:
+        preamble = get_preamble(build_dir)
+
+    document = open(os.path.join(build_dir, filename), "w")
+
+    document.write(preamble)
+    if subtitle is not None:
+        document.write(volume_subtitle_str.format(subtitle=subtitle))
 
+    document.write(document_begin_str)
+    for part, chapters in document_tree:
+        document.write(get_part_tex(part, chapters))
 
-def get_document_tree(note_dirs, journal_type, formats, user_formats):
+    document.write(document_end_str)
+    document.close()
 
-    if journal_type == "topological":
-        note_dirs = parse_metadata(note_dirs)
 
-    subsections = get_subsections(note_dirs, formats, metadata=True)
+def get_part_pdfs(chapters):
+    return [entry.pdf
+            for chapter, sections in chapters
+            for section, subsections in sections
+            for entry in subsections]
 
-    parts = dict()
-    for s, entry in subsections:
 
-        if journal_type == "chronological":
-            pn, cn, sn = classify_chronological_entry(entry)
-        elif journal_type == "topological":
-            pn, cn, sn = classify_topological_entry(entry)
-        else:
-            raise NotImplementedError
+def get_fingerprint(text, files):
+    fingerprint = hashlib.sha224(text.encode())
+    for file in files:
+        try:
+            stat_result = os.stat(file)
+            fingerprint.update(
+                f"{file} {stat_result.st_size} {stat_result.st_mtime_ns} "
+                f"{stat_result.st_ino}\n".encode())
+        except FileNotFoundError:
+            fingerprint.update(f"{file} missing\n".encode())
 
-        if pn not in parts:
-            parts.update({pn: dict()})
+    return fingerprint.hexdigest()
 
-        if cn not in parts[pn]:
-            parts[pn].update({cn: dict()})
 
-        if sn not in parts[pn][cn]:
-            parts[pn][cn].update({sn: list()})
+def is_fingerprint_outdated(fingerprint_filename, fingerprint, pdf):
+    try:
+        with open(fingerprint_filename) as file:
+            is_outdated = file.read() != fingerprint
+    except FileNotFoundError:
+        is_outdated = True
+
+    return is_outdated or not os.path.isfile(pdf)
+
+
+def get_journal_pdfs(document_tree):
+    return [pdf
+            for part, chapters in document_tree
+            for pdf in get_part_pdfs(chapters)]
+
+
+def read_part_pages(pages_filename, kinds):
+    with open(pages_filename) as file:
+        lines = file.read().split()
+
+    # one "<kind> <first page>" entry per heading and note, followed by the
+    # page count
+    if lines[:-1:2] != kinds:
+        raise ValueError(f"Unexpected headings or notes in {pages_filename}")
+
+    return [int(page) for page in lines[1:-1:2]], int(lines[-1])
+
+
+def make_parts_directory_document(filename, tex, pdfs, description,
+                                  capture_output=False, latexmk_command=None):
+    if latexmk_command is None:
+        latexmk_command = ["latexmk", "-norc", "-pdf"]
+
+    fingerprint = get_fingerprint(tex + " ".join(latexmk_command), pdfs)
+    if not is_fingerprint_outdated(filename + ".fingerprint",
+                                   fingerprint,
+                                   filename + ".pdf"):
+        print_jmk(f"The {description} is up to date")
+        return None
+
+    print_jmk(f"Compile the {description}")
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(filename + ".fingerprint")
+    with open(filename + ".tex", "w") as file:
+        file.write(tex)
+    process = run_command(latexmk_command +
+                          [os.path.basename(filename) + ".tex"],
+                          capture_output,
+                          cwd=os.path.dirname(filename))
+    if process.returncode == 0:
+        with open(filename + ".fingerprint", "w") as file:
+            file.write(fingerprint)
+
+    return process
+
+
+def make_part_document(name, part, chapters, preamble, capture_output=False,
+                       build_dir="", latexmk_command=None):
+    part_name = part if part is not None else "Unsorted"
+    # a part split into several volumes has a part document per volume
+    part_hash = hashlib.sha224(f"{name} {part_name}".encode()).hexdigest()[:30]
+    part_filename = os.path.abspath(os.path.join(build_dir,
+                                                 parts_directory,
+                                                 "part-" + part_hash))
+
+    toc = list()
+    part_tex = preamble + part_document_begin_str + \
+        get_part_tex(part, chapters, toc) + part_document_end_str
+    process = make_parts_directory_document(part_filename,
+                                            part_tex,
+                                            get_part_pdfs(chapters),
+                                            f"part document of part "
+                                            f"{part_name}",
+                                            capture_output,
+                                            latexmk_command)
+    if process is not None and process.returncode != 0:
+        return process, None
+
+    first_pages, page_count = read_part_pages(part_filename + ".pages",
+                                              [kind for kind, title in toc])
+    toc_pages = [(kind, title, page)
+                 for (kind, title), page in zip(toc, first_pages)]
+
+    return process, (part_filename + ".pdf", toc_pages, page_count)
+
+
+def make_part_documents(volumes, jobs=1, build_dir="", preamble=None,
+                        latexmk_command=None):
+    if pypdf is None:
+        raise ImportError("Part documents require the python package pypdf, "
+                          "install it with 'pip install pypdf'")
+
+    os.makedirs(os.path.join(build_dir, parts_directory), exist_ok=True)
+    if preamble is None:
+        preamble = get_preamble(build_dir)
+
+    parts = [(name, part, chapters)
+             for name, subtitle, volume_tree in volumes
+             for part, chapters in volume_tree]
+    err_processes = list()
+    part_documents = dict()
+    jobs = max(1, min(jobs, len(parts)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(make_part_document,
+                                   name,
+                                   part,
+                                   chapters,
+                                   preamble,
+                                   jobs > 1,
+                                   build_dir,
+                                   latexmk_command)
+                   for name, part, chapters in parts]
+
+        for (name, part, chapters), future in zip(parts, futures):
+            process, part_document = future.result()
+            if process is not None and process.returncode != 0:
+                err_processes.append((0, process))
+            part_documents[(name, part)] = part_document
+
+    return err_processes, part_documents
+
+
+def rename_destinations(page, prefix):
+    if "/Annots" not in page:
+        return
+
+    for annotation in page["/Annots"]:
+        annotation = annotation.get_object()
+        if "/Dest" in annotation:
+            owner, key = annotation, "/Dest"
+        elif "/A" in annotation and annotation["/A"].get("/S") == "/GoTo":
+            owner, key = annotation["/A"], "/D"
+        else:
+            continue
+        # only named destinations, explicit ones refer to the page objects
+        if isinstance(owner[key], pypdf.generic.TextStringObject):
+            owner[pypdf.generic.NameObject(key)] = \
+                pypdf.generic.TextStringObject(prefix + owner[key])
+
+
+def merge_part_documents(front_pdf, part_pdfs, toc, filename="journal.pdf"):
+    writer = pypdf.PdfWriter()
+    writer.add_metadata({"/Title": "Notebook",
+                         "/Creator": "journalmk"})
+
+    for page in pypdf.PdfReader(front_pdf).pages:
+        writer.add_page(page)
+    front_pages = len(writer.pages)
+    # the table of contents follows the title page
+    writer.add_outline_item("Contents", min(1, front_pages - 1))
+
+    for part_pdf in part_pdfs:
+        reader = pypdf.PdfReader(part_pdf)
+        page_index = len(writer.pages)
+        for page in reader.pages:
+            writer.add_page(page)
+
+        # the anchors of hyperref, e.g. of the part and mini tables of
+        # contents, are only unique within a part document
+        prefix = pathlib.Path(part_pdf).stem + "."
+        for page in writer.pages[page_index:]:
+            rename_destinations(page, prefix)
+        for title, destination in reader.named_destinations.items():
+            writer.add_named_destination(
+                prefix + title,
+                page_index + reader.get_destination_page_number(destination))
+
+    # the table of contents of the front document links to the anchors
+    # jmk.<entry>, its page numbers count the pages after the front document
+    parents = list()
+    for i, (kind, title, page) in enumerate(toc):
+        page_index = front_pages + page - 1
+        writer.add_named_destination(f"jmk.{i}", page_index)
+        level = toc_kinds.index(kind)
+        while parents and parents[-1][0] >= level:
+            parents.pop()
+        item = writer.add_outline_item(
+            title, page_index, parent=parents[-1][1] if parents else None)
+        parents.append((level, item))
+
+    writer.set_page_label(0, front_pages - 1, style="/r", start=1)
+    if len(writer.pages) > front_pages:
+        writer.set_page_label(front_pages, len(writer.pages) - 1,
+                              style="/D", start=1)
+
+    filename_tmp = filename + ".part"
+    with open(filename_tmp, "wb") as file:
+        writer.write(file)
+    os.replace(filename_tmp, filename)
+
+
+def make_merged_document(name, subtitle, document_tree, part_documents,
+                         preamble, capture_output=False, build_dir="",
+                         latexmk_command=None):
+    toc = list()
+    part_pdfs = list()
+    page_count = 0
+    for part, chapters in document_tree:
+        part_document = part_documents[(name, part)]
+        # the error of a failed part document is already reported
+        if part_document is None:
+            return None, False
+        part_pdf, part_toc, part_page_count = part_document
+        part_pdfs.append(part_pdf)
+        toc.extend((kind, title, page_count + page)
+                   for kind, title, page in part_toc)
+        page_count += part_page_count
+
+    front_tex = preamble
+    if subtitle is not None:
+        front_tex += volume_subtitle_str.format(subtitle=subtitle)
+    front_tex += front_document_begin_str
+    for i, (kind, title, page) in enumerate(toc):
+        front_tex += front_document_toc_str.format(kind=kind,
+                                                   title=title,
+                                                   page=page,
+                                                   anchor=f"jmk.{i}")
+    front_tex += document_end_str
+
+    front_filename = os.path.abspath(os.path.join(build_dir,
+                                                  parts_directory,
+                                                  name + "-front"))
+    process = make_parts_directory_document(front_filename,
+                                            front_tex,
+                                            list(),
+                                            f"front document of {name}.pdf",
+                                            capture_output,
+                                            latexmk_command)
+    if process is not None and process.returncode != 0:
+        return process, False
+
+    # only the pages of the part documents are copied, without LaTeX
+    filename = os.path.join(build_dir, name + ".pdf")
+    fingerprint = get_fingerprint(front_tex, [front_filename + ".pdf"] +
+                                  part_pdfs)
+    fingerprint_filename = os.path.join(build_dir, "tmp",
+                                        name + ".fingerprint")
+    if not is_fingerprint_outdated(fingerprint_filename,
+                                   fingerprint,
+                                   filename):
+        print_jmk(f"{name}.pdf is up to date")
+        return process, False
+
+    print_jmk(f"Merge the part documents into {name}.pdf")
+    merge_part_documents(front_filename + ".pdf", part_pdfs, toc, filename)
+    with open(fingerprint_filename, "w") as file:
+        file.write(fingerprint)
+
+    return process, True
+
+
+def make_merged_documents(volumes, part_documents, jobs=1, build_dir="",
+                          preamble=None, latexmk_command=None):
+    if preamble is None:
+        preamble = get_preamble(build_dir)
+
+    err_processes = list()
+    updated_names = list()
+    jobs = max(1, min(jobs, len(volumes)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(make_merged_document,
+                                   name,
+                                   subtitle,
+                                   volume_tree,
+                                   part_documents,
+                                   preamble,
+                                   jobs > 1,
+                                   build_dir,
+                                   latexmk_command)
+                   for name, subtitle, volume_tree in volumes]
+
+        for (name, subtitle, volume_tree), future in zip(volumes, futures):
+            process, is_updated = future.result()
+            if process is not None and process.returncode != 0:
+                err_processes.append((0, process))
+            if is_updated:
+                updated_names.append(name)
+
+    return err_processes, updated_names
+
+
+def count_pdf_pages_stdlib(pdf):
+    with open(pdf, "rb") as file:
+        data = file.read()
+
+    # page tree nodes may be hidden in compressed object streams
+    chunks = [data]
+    for match in re.finditer(rb"/Type\s*/ObjStm\b", data):
+        start = data.find(b"stream", match.end())
+        end = data.find(b"endstream", start)
+        if start < 0 or end < 0:
+            continue
+        start += len(b"stream")
+        with contextlib.suppress(zlib.error):
+            chunks.append(zlib.decompress(data[start:end].lstrip(b"\r\n")))
 
-        parts[pn][cn][sn].append((s, entry))
+    counts = list()
+    for chunk in chunks:
+        for match in re.finditer(rb"/Type\s*/Pages\b", chunk):
+            start = chunk.rfind(b"<<", 0, match.start())
+            end = chunk.find(b">>", match.end())
+            counts += [int(count) for count in re.findall(
+                rb"/Count\s+(\d+)", chunk[start:end])]
+    if counts:
+        return max(counts)
 
-    if journal_type == "chronological":
-        parts = format_chronological_document_tree(parts, user_formats)
-    elif journal_type == "topological":
-        parts = sort_topological_document_tree(parts)
-    else:
-        raise NotImplementedError
+    return sum(len(re.findall(rb"/Type\s*/Page\b", chunk))
+               for chunk in chunks)
 
-    return parts
 
+def count_pdf_pages(pdf):
+    if pypdf is None:
+        return count_pdf_pages_stdlib(pdf)
 
-def write_tex_file(document_tree):
+    try:
+        return len(pypdf.PdfReader(pdf).pages)
+    except pypdf.errors.PdfReadError:
+        return count_pdf_pages_stdlib(pdf)
 
-    document = open("journal.tex", "w")
 
+def get_page_counts(pdfs, build_dir=""):
+    filename = os.path.join(build_dir, page_counts_filename)
     try:
-        with open("journal_template.tex", "r") as file:
-            document.write(file.read())
-    except FileNotFoundError:
-        document.write(document_preamble)
+        with open(filename) as file:
+            old_page_counts = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        old_page_counts = dict()
 
-    document.write(document_begin_str)
-    for part, chapters in document_tree:
-        if part is not None:
-            document.write(part_str.format(part=part))
+    page_counts = dict()
+    for pdf in pdfs:
+        try:
+            stat_result = os.stat(pdf)
+        except FileNotFoundError:
+            continue
+        signature = [stat_result.st_size, stat_result.st_mtime_ns]
+        if pdf in old_page_counts and old_page_counts[pdf][0] == signature:
+            page_counts[pdf] = old_page_counts[pdf]
         else:
-            document.write(part_str.format(part="Unsorted"))
+            page_counts[pdf] = [signature, count_pdf_pages(pdf)]
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as file:
+        json.dump(page_counts, file)
+
+    return {pdf: pages for pdf, (signature, pages) in page_counts.items()}
+
+
+def split_document_tree(document_tree, max_pages, build_dir=""):
+    chapters = [(p, c) for p, (part, chs) in enumerate(document_tree)
+                for c in range(len(chs))]
+    page_counts = get_page_counts(get_journal_pdfs(document_tree), build_dir)
+
+    # the chapters are packed from the end of the journal, hence new notes
+    # of a chronological journal only change the first volume
+    volumes = list()
+    volume, volume_pages = list(), 0
+    for p, c in reversed(chapters):
+        pages = sum(page_counts.get(entry.pdf, 0)
+                    for section, subsections in document_tree[p][1][c][1]
+                    for entry in subsections)
+        if volume and volume_pages + pages > max_pages:
+            volumes.append(volume)
+            volume, volume_pages = list(), 0
+        volume.append((p, c))
+        volume_pages += pages
+    if volume:
+        volumes.append(volume)
+
+    volume_trees = list()
+    for volume in reversed(volumes):
+        volume_tree = list()
+        last_part = None
+        for p, c in reversed(volume):
+            if p != last_part:
+                volume_tree.append((document_tree[p][0], list()))
+                last_part = p
+            volume_tree[-1][1].append(document_tree[p][1][c])
+        volume_trees.append(volume_tree)
+
+    return volume_trees
+
+
+def get_volumes(document_tree, volumes, build_dir=""):
+    # bool is a subclass of int, but no number of pages
+    if volumes == "part":
+        volume_trees = [[part] for part in document_tree]
+    elif isinstance(volumes, int) and not isinstance(volumes, bool) and \
+            volumes > 0:
+        volume_trees = split_document_tree(document_tree, volumes, build_dir)
+    else:
+        raise ValueError(f"Unknown value {volumes!r} of volumes, use 'part' "
+                         f"or a positive number of pages")
+
+    # the volumes are numbered from the end, to keep their names stable
+    return [(f"journal-{len(volume_trees) - i}",
+             f"Volume {len(volume_trees) - i}",
+             volume_tree)
+            for i, volume_tree in enumerate(volume_trees)]
+
+
+def write_index_file(volumes, filename="journal.tex", build_dir="",
+                     preamble=None):
+    if preamble is None:
+        preamble = get_preamble(build_dir)
+
+    with open(os.path.join(build_dir, filename), "w") as document:
+        document.write(preamble)
+        document.write(index_document_begin_str)
+        for name, subtitle, volume_tree in volumes:
+            parts = [part if part is not None else "Unsorted"
+                     for part, chapters in volume_tree]
+            document.write(index_volume_str.format(
+                file=name + ".pdf",
+                volume=subtitle,
+                parts=", ".join(parts)))
+        document.write(document_end_str)
+
+
+def make_tex_document(name, pdfs, capture_output=False, build_dir="",
+                      latexmk_command=None):
+    if latexmk_command is None:
+        latexmk_command = ["latexmk", "-norc", "-pdf"]
+
+    # skip latexmk, if neither the tex file, the command nor the included
+    # pdfs changed
+    with open(os.path.join(build_dir, name + ".tex")) as file:
+        fingerprint = get_fingerprint(file.read() + " ".join(latexmk_command),
+                                      pdfs)
+    fingerprint_filename = os.path.join(build_dir, "tmp",
+                                        name + ".fingerprint")
+    if not is_fingerprint_outdated(fingerprint_filename,
+                                   fingerprint,
+                                   os.path.join(build_dir, name + ".pdf")):
+        print_jmk(f"{name}.pdf is up to date")
+        return None
+
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(fingerprint_filename)
+    process = run_command(latexmk_command + [name + ".tex"],
+                          capture_output,
+                          cwd=build_dir or None)
+    if process.returncode == 0:
+        os.makedirs(os.path.dirname(fingerprint_filename), exist_ok=True)
+        with open(fingerprint_filename, "w") as file:
+            file.write(fingerprint)
+
+    return process
+
+
+def make_tex_documents(documents, jobs=1, build_dir="", latexmk_command=None):
+    jobs = max(1, min(jobs, len(documents)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(make_tex_document,
+                                   name,
+                                   pdfs,
+                                   jobs > 1,
+                                   build_dir,
+                                   latexmk_command)
+                   for name, pdfs in documents]
+
+        return [future.result() for future in futures]
+
+
+def get_pdf_string(text):
+    text = text.encode("cp1252", errors="replace")
+    text = text.replace(b"\\", b"\\\\")
+    text = text.replace(b"(", b"\\(").replace(b")", b"\\)")
+
+    return b"(" + text + b")"
+
+
+def add_note_link(writer, page, datetime_str, path, font_size=8):
+    # same position as the picturecommand of subsection_str
+    text = f"{datetime_str} -- {path}"
+    content = b" ".join([b"q BT /F1", str(font_size).encode(), b"Tf",
+                         b"10 10 Td", get_pdf_string(text), b"Tj ET Q"])
+
+    overlay = pypdf.PageObject.create_blank_page(
+        width=page.mediabox.width, height=page.mediabox.height)
+    font = pypdf.generic.DictionaryObject({
+        pypdf.generic.NameObject("/Type"): pypdf.generic.NameObject("/Font"),
+        pypdf.generic.NameObject("/Subtype"):
+            pypdf.generic.NameObject("/Type1"),
+        pypdf.generic.NameObject("/BaseFont"):
+            pypdf.generic.NameObject("/Helvetica"),
+        pypdf.generic.NameObject("/Encoding"):
+            pypdf.generic.NameObject("/WinAnsiEncoding")})
+    overlay[pypdf.generic.NameObject("/Resources")] = \
+        pypdf.generic.DictionaryObject({
+            pypdf.generic.NameObject("/Font"):
+                pypdf.generic.DictionaryObject({
+                    pypdf.generic.NameObject("/F1"): font})})
+    contents = pypdf.generic.DecodedStreamObject()
+    contents.set_data(content)
+    overlay[pypdf.generic.NameObject("/Contents")] = contents
+    page.merge_page(overlay)
+
+    # rough width estimate of the helvetica text
+    width = 0.5 * font_size * len(text)
+    link = pypdf.generic.DictionaryObject({
+        pypdf.generic.NameObject("/Type"): pypdf.generic.NameObject("/Annot"),
+        pypdf.generic.NameObject("/Subtype"):
+            pypdf.generic.NameObject("/Link"),
+        pypdf.generic.NameObject("/Rect"): pypdf.generic.ArrayObject([
+            pypdf.generic.FloatObject(10),
+            pypdf.generic.FloatObject(8),
+            pypdf.generic.FloatObject(10 + width),
+            pypdf.generic.FloatObject(10 + font_size)]),
+        pypdf.generic.NameObject("/Border"): pypdf.generic.ArrayObject([
+            pypdf.generic.NumberObject(0),
+            pypdf.generic.NumberObject(0),
+            pypdf.generic.NumberObject(0)]),
+        pypdf.generic.NameObject("/A"): pypdf.generic.DictionaryObject({
+            pypdf.generic.NameObject("/S"):
+                pypdf.generic.NameObject("/Launch"),
+            pypdf.generic.NameObject("/F"):
+                pypdf.generic.TextStringObject(path)})})
+    writer.add_annotation(page, link)
+
+
+def write_pdf_file(document_tree, filename="journal.pdf"):
+
+    if pypdf is None:
+        raise ImportError("The native backend requires the python package "
+                          "pypdf, install it with 'pip install pypdf'")
+
+    err_processes = list()
+    writer = pypdf.PdfWriter()
+    writer.add_metadata({"/Title": "Notebook",
+                         "/Creator": "journalmk"})
+
+    for part, chapters in document_tree:
+        part_name = part if part is not None else "Unsorted"
+        part_item = None
         for chapter, sections in chapters:
-            if chapter is not None:
-                document.write(chapter_str.format(chapter=chapter))
+            chapter_item = None
             for section, subsections in sections:
-                label = pathlib.Path(subsections[0][1][1]).stem
-                if section is None:
-                    add_to_toc = list()
-                else:
-                    add_to_toc = [sec_toc_str.format(
-                        section=section,
-                        label=label)]
-                for subsection in subsections:
-                    label = pathlib.Path(subsection[1][1]).stem
-                    add_to_toc.append(subsec_toc_str.format(
-                        subsection=subsection[0],
-                        label=label))
-                    document.write(subsection_str.format(
-                        section=subsection[0],
-                        addtotoc=", ".join(add_to_toc),
-                        datetime=subsection[0],
-                        path=subsection[1][0],
-                        path_text=subsection[1][0].replace("_", "\\_"),
-                        file=subsection[1][1]
-                    ))
-                    add_to_toc = list()
+                section_item = None
+                for entry in subsections:
+                    try:
+                        reader = pypdf.PdfReader(entry.pdf)
+                        pages = list(reader.pages)
+                    except (OSError, pypdf.errors.PdfReadError) as e:
+                        err_processes.append(
+                            (2, f"Could not include the pdf {entry.pdf} "
+                                f"of note {entry.note}: {e}"))
+                        continue
+                    if not pages:
+                        continue
+
+                    # every page links to the note, like the picturecommand*
+                    # of the latex backend
+                    page_index = len(writer.pages)
+                    for page in pages:
+                        writer.add_page(page)
+                    for page in writer.pages[page_index:]:
+                        add_note_link(writer, page, entry.label, entry.note)
+
+                    # the outline items are created with the first note
+                    if part_item is None:
+                        part_item = writer.add_outline_item(part_name,
+                                                            page_index)
+                    parent = part_item
+                    if chapter is not None:
+                        if chapter_item is None:
+                            chapter_item = writer.add_outline_item(
+                                chapter, page_index, parent=parent)
+                        parent = chapter_item
+                    if section is not None:
+                        if section_item is None:
+                            section_item = writer.add_outline_item(
+                                section, page_index, parent=parent)
+                        parent = section_item
+                    writer.add_outline_item(entry.label,
+                                            page_index,
+                                            parent=parent)
+
+    filename_tmp = filename + ".part"
+    with open(filename_tmp, "wb") as file:
+        writer.write(file)
+    os.replace(filename_tmp, filename)
+
+    return err_processes
+
+
+def is_watched_file(name, note_endings, exclude_note_endings):
+    if any(name.endswith(ene) for ene in exclude_note_endings):
+        return False
+
+    return any(name.endswith(ne) for ne in note_endings)
+
+
+class InotifyWatcher:
+
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, note_dirs, note_endings, exclude_note_endings):
+        self.note_endings = note_endings
+        self.exclude_note_endings = exclude_note_endings
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | \
+            self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | \
+            self.IN_DELETE
+        self.watches = dict()
+        for note_dir in note_dirs:
+            wd = self.libc.inotify_add_watch(self.fd,
+                                             os.fsencode(note_dir),
+                                             mask)
+            if wd < 0:
+                print_jmk(f"Could not watch notes directory {note_dir}")
+            else:
+                self.watches[wd] = note_dir
 
-    document.write(document_end_str)
-    document.close()
+    def wait_for_changes(self, timeout):
+        changed_dirs = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed_dirs
+
+        try:
+            buffer = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed_dirs
+
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = self.event_header.unpack_from(buffer,
+                                                                     offset)
+            offset += self.event_header.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if wd == -1:
+                # the event queue overflowed
+                changed_dirs.update(self.watches.values())
+            elif wd in self.watches and is_watched_file(
+                    name, self.note_endings, self.exclude_note_endings):
+                changed_dirs.add(self.watches[wd])
+
+        return changed_dirs
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+
+    def __init__(self, note_dirs, note_endings, exclude_note_endings,
+                 interval):
+        self.note_dirs = note_dirs
+        self.note_endings = note_endings
+        self.exclude_note_endings = exclude_note_endings
+        self.interval = interval
+        self.snapshots = {nd: self.snapshot(nd) for nd in note_dirs}
+
+    def snapshot(self, note_dir):
+        files = dict()
+        try:
+            with os.scandir(note_dir) as it:
+                for dir_entry in it:
+                    if is_watched_file(dir_entry.name,
+                                       self.note_endings,
+                                       self.exclude_note_endings):
+                        stat_result = dir_entry.stat()
+                        files[dir_entry.name] = (stat_result.st_mtime_ns,
+                                                 stat_result.st_size)
+        except FileNotFoundError:
+            pass
+
+        return files
+
+    def wait_for_changes(self, timeout):
+        changed_dirs = set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not changed_dirs:
+            if deadline is None:
+                time.sleep(self.interval)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(self.interval, remaining))
+
+            for note_dir in self.note_dirs:
+                snapshot = self.snapshot(note_dir)
+                if snapshot != self.snapshots[note_dir]:
+                    self.snapshots[note_dir] = snapshot
+                    changed_dirs.add(note_dir)
+
+        return changed_dirs
+
+    def close(self):
+        pass
+
+
+def get_watcher(note_dirs, note_endings, exclude_note_endings,
+                poll_interval):
+    if platform.system() == "Linux":
+        try:
+            return InotifyWatcher(note_dirs,
+                                  note_endings,
+                                  exclude_note_endings)
+        except (OSError, AttributeError):
+            print_jmk("Inotify not available, poll notes directories")
 
+    return PollingWatcher(note_dirs,
+                          note_endings,
+                          exclude_note_endings,
+                          poll_interval)
 
-def open_journal():
+
+def open_journal(filename="journal.pdf"):
 
     if platform.system() == "Darwin":
-        subprocess.run(["open", "journal.pdf"])
+        subprocess.run(["open", filename])
 
     elif platform.system() == "Windows":
-        os.startfile("journal.pdf")
+        os.startfile(filename)
 
     elif platform.system() == "Linux":
-        subprocess.run(["xdg-open", "journal.pdf"])
+        subprocess.run(["xdg-open", filename])
 
     else:
         raise NotImplementedError
@@ -531,10 +3027,8 @@ def load_user_journalmkrc(test_filename=None, test_userdir=None):
     if test_userdir:
         userdir = test_userdir
 
-    cwd = os.getcwd()
-    os.chdir(userdir)
     try:
-        with open(filename) as file:
+        with open(os.path.join(userdir, filename)) as file:
             jmkrc = json.load(file)
         if "root_directory" in jmkrc:
             raise ValueError(
@@ -551,25 +3045,25 @@ def load_user_journalmkrc(test_filename=None, test_userdir=None):
            f" directory {userdir}"
 
     print_jmk(msg1, msg2)
-    os.chdir(cwd)
     return jmkrc
 
 
-def update_user_journalmkrc(conf, test_filename=None):
+def update_user_journalmkrc(conf, test_filename=None, build_dir=""):
     filename = "journalmkrc.json"
     if test_filename:
         filename = test_filename
 
-    with open(filename) as file:
+    with open(os.path.join(build_dir, filename)) as file:
         jmkrc = json.load(file)
     print_jmk(f"Load journal-specific configuration file {filename}",
-              f"from build directory {os.getcwd()}")
+              f"from build directory {os.path.abspath(build_dir)}")
 
     ignore_key = "ignore_user_home_journalmkrc"
     if ignore_key in jmkrc and jmkrc[ignore_key]:
         return jmkrc
 
-    dicts = ("notes_pdf_export_commands", "notes_pdf_inplace_export_commands")
+    dicts = ("notes_pdf_export_commands", "notes_pdf_inplace_export_commands",
+             "notes_pdf_export_workers")
     lists = ("notes_directory_names", "datetime_filename_formats",
              "exclude_note_endings")
     unhashable_lists = ("exclude_directories", )
@@ -593,58 +3087,540 @@ def update_user_journalmkrc(conf, test_filename=None):
     return conf
 
 
-def make():
-    print_jmk("This is Journalmk, Marcus Riesmeier, version: 2022.3")
+def get_jobs(conf, jobs=None):
+    if jobs is None:
+        jobs = conf.get("jobs", None)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs < 1:
+        raise ValueError(f"The number of jobs must be positive, got {jobs}")
+
+    return jobs
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="journalmk",
+        description="Creates a pdf notebook/journal out of your digital "
+                    "notes, using latex + python")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of notes converted in parallel "
+                             "(default: 'jobs' from journalmkrc.json or "
+                             "the number of CPUs)")
+    parser.add_argument("--rescan", action="store_true",
+                        help="ignore the scan index and walk the whole "
+                             "root directory")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="convert the notes which failed to convert in "
+                             "earlier builds again")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and rebuild the journal when "
+                             "notes change")
+    parser.add_argument("--profile", nargs="?", const=profile_filename,
+                        default=None, metavar="FILE",
+                        help="print the time and memory used by the phases "
+                             "and conversions of the build and append them "
+                             "as JSON lines to FILE (default: "
+                             f"{profile_filename})")
+    parser.add_argument("--plan", action="store_true",
+                        help="only print the notes to be converted and the "
+                             "estimated conversion time, without running "
+                             "any converter or LaTeX")
+    parser.add_argument("--json", default=None, metavar="FILE",
+                        help="with --plan, also write the plan as JSON to "
+                             "FILE")
+
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.add_parser("make",
+                          help="convert the notes and compile the journal "
+                               "(default)")
+    subparsers.add_parser("gc",
+                          help="remove converted notes of deleted notes from "
+                               "the tmp directory and limit its size")
+    build_all_parser = subparsers.add_parser(
+        "build-all",
+        help="build the journals of several build directories with a "
+             "single scan of their root directories")
+    build_all_parser.add_argument("build_dirs", nargs="+", metavar="dir",
+                                  help="build directory of a journal")
+
+    return parser.parse_args(argv)
+
+
+class Profiler:
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.enabled = filename is not None
+        self.run = datetime.datetime.now().isoformat()
+        self.records = list()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            self.records.append(dict(type="phase",
+                                     name=name,
+                                     seconds=seconds,
+                                     peak_memory=peak,
+                                     max_rss=self.get_max_rss()))
+
+    @staticmethod
+    def get_max_rss():
+        if resource is None:
+            return None
+
+        return get_max_rss(resource.getrusage(resource.RUSAGE_SELF))
+
+    def add_command(self, process):
+        if not self.enabled:
+            return
+
+        self.records.append(dict(type="command",
+                                 name=" ".join(process.args),
+                                 seconds=getattr(process, "seconds", None),
+                                 max_rss=getattr(process, "max_rss", None),
+                                 returncode=process.returncode))
+
+    def add_conversions(self, records):
+        if not self.enabled:
+            return
+
+        for record in records:
+            self.records.append(dict(type="conversion",
+                                     name=record["note"],
+                                     **record))
+
+    def report(self, number_of_notes=10):
+        if not self.enabled:
+            return
+
+        print_jmk("Profile of the build")
+        for record in self.records:
+            if record["type"] == "phase":
+                print_jmk(f"Phase {record['name']}:",
+                          f"{record['seconds']:.3f} s,",
+                          f"peak python memory "
+                          f"{record['peak_memory'] / 2 ** 20:.1f} MiB")
+            elif record["type"] == "command":
+                print_jmk(f"Command {record['name']}:",
+                          f"{record['seconds']:.3f} s")
+
+        conversions = [r for r in self.records if r["type"] == "conversion"]
+        conversions = sorted(conversions, key=lambda r: r["seconds"],
+                             reverse=True)
+        for record in conversions[:number_of_notes]:
+            print_jmk(f"Slow note {record['note']}:",
+                      f"{record['seconds']:.3f} s")
+
+        extensions = dict()
+        for record in conversions:
+            count, seconds = extensions.get(record["extension"], (0, 0.))
+            extensions[record["extension"]] = (count + 1,
+                                               seconds + record["seconds"])
+        for extension, (count, seconds) in sorted(extensions.items()):
+            print_jmk(f"Notes of type {extension}: {count} notes,",
+                      f"{seconds:.3f} s in total,",
+                      f"{seconds / count:.3f} s per note")
+
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(self.filename, "a") as file:
+            for record in self.records:
+                file.write(json.dumps(dict(run=self.run, **record)) + "\n")
+        print_jmk(f"Profile written to {self.filename}")
+
+
+def get_batch_size(conf):
+    batch_size = conf.get("notes_pdf_inplace_batch_size", 1)
+    if batch_size == 0:
+        return None
+    if batch_size < 0:
+        raise ValueError(f"The batch size must not be negative, "
+                         f"got {batch_size}")
+
+    return batch_size
+
+
+def convert_notes(note_dirs, conf, pdf_export_commands, jobs=1,
+                  profiler=None, build_dir="", optimize=True):
+    if profiler is None:
+        profiler = Profiler()
+
+    records = list()
+    with profiler.phase("make_pdf_notes"):
+        err_processes = make_pdf_notes(note_dirs,
+                                       pdf_export_commands,
+                                       conf["notes_pdf_inplace_export_commands"],
+                                       jobs,
+                                       get_cache_directory(conf, build_dir),
+                                       get_batch_size(conf),
+                                       conf["notes_pdf_export_workers"],
+                                       records,
+                                       conf.get("notes_pdf_export_timeouts",
+                                                None),
+                                       negative_cache=True,
+                                       build_dir=build_dir,
+                                       concurrency=conf.get(
+                                           "notes_pdf_export_concurrency",
+                                           None))
+    profiler.add_conversions(records)
+    update_conversion_stats(records, build_dir)
+
+    if optimize:
+        err_processes += optimize_notes(note_dirs, conf, jobs, profiler)
+
+    return err_processes
+
+
+def get_plan(note_dirs, pdf_export_commands, jobs=1, build_dir=""):
+    failed_notes = load_failed_notes(build_dir)
+    stats = load_conversion_stats(build_dir)
+
+    number_of_notes = 0
+    stale_notes = list()
+    skipped_notes = list()
+    for note_dir in note_dirs:
+        for note, pdf in zip(note_dirs[note_dir]["notes"],
+                             note_dirs[note_dir]["pdfs"]):
+            number_of_notes += 1
+            if not is_pdf_note_outdated(note, pdf):
+                continue
+            if is_failed_note(note, failed_notes, pdf_export_commands):
+                skipped_notes.append(note)
+            else:
+                stale_notes.append(note)
+
+    extensions = dict()
+    for note in stale_notes:
+        extension = get_pdf_command(note, pdf_export_commands)[0]
+        extensions.setdefault(extension, dict(notes=list()))
+        extensions[extension]["notes"].append(note)
+
+    # notes of extensions without statistics are not part of the estimate
+    seconds = 0.
+    for extension, plan in sorted(extensions.items()):
+        count, stats_seconds = stats.get(extension, (0, 0.))
+        plan.update(stale=len(plan["notes"]),
+                    seconds_per_note=stats_seconds / count if count else None)
+        if count:
+            plan.update(seconds=plan["seconds_per_note"] * plan["stale"])
+            seconds += plan["seconds"]
+        else:
+            plan.update(seconds=None)
+
+    return dict(notes=number_of_notes,
+                stale=len(stale_notes),
+                skipped=skipped_notes,
+                jobs=jobs,
+                seconds=seconds,
+                wall_seconds=seconds / max(1, min(jobs, len(stale_notes))),
+                extensions=extensions)
+
+
+def print_plan(plan):
+    print_jmk(f"{plan['stale']} of {plan['notes']} notes are converted")
+    for extension, ext_plan in sorted(plan["extensions"].items()):
+        if ext_plan["seconds"] is None:
+            estimate = "no previous conversions"
+        else:
+            estimate = f"{ext_plan['seconds']:.1f} s " \
+                       f"({ext_plan['seconds_per_note']:.3f} s per note)"
+        print_jmk(f"Notes of type {extension}: {ext_plan['stale']} notes,",
+                  estimate)
+        # the paths are not wrapped, to keep them usable
+        for note in ext_plan["notes"]:
+            print(11 * " " + note, flush=True)
+    for note in plan["skipped"]:
+        print_jmk(f"Skip note {note}, its conversion failed before")
+    print_jmk(f"Estimated conversion time: {plan['seconds']:.1f} s,",
+              f"{plan['wall_seconds']:.1f} s with {plan['jobs']} jobs")
+
+
+def optimize_notes(note_dirs, conf, jobs=1, profiler=None):
+    if profiler is None:
+        profiler = Profiler()
+
+    optimizer = conf.get("notes_pdf_optimizer", None)
+    if optimizer is None:
+        return list()
+
+    with profiler.phase("optimize_pdf_notes"):
+        return optimize_pdf_notes(
+            note_dirs,
+            optimizer,
+            conf.get("notes_pdf_optimizer_resolution", 150),
+            jobs)
+
+
+def get_conversion_signature(note, conf, pdf_export_commands):
+    notes_ending, pdf_command = get_pdf_command(note, pdf_export_commands)
+    if notes_ending in conf["notes_pdf_export_workers"]:
+        kind = "worker"
+    elif notes_ending in conf["notes_pdf_inplace_export_commands"]:
+        kind = "inplace"
+    else:
+        kind = "direct"
+
+    return note, notes_ending, pdf_command, kind
+
+
+def convert_journals(builders):
+    # notes, which are part of several journals and are converted by the
+    # same command, are converted for the first journal only and linked
+    # into the build directories of the other journals
+    converted_pdfs = dict()
+    shared_notes = list()
+    err_processes = list()
+    for builder in builders:
+        note_dirs = dict()
+        for note_dir, nd in builder.note_dirs.items():
+            notes = list()
+            pdfs = list()
+            for note, pdf in zip(nd["notes"], nd["pdfs"]):
+                signature = get_conversion_signature(
+                    note, builder.conf, builder.pdf_export_commands)
+                if signature in converted_pdfs:
+                    shared_notes.append((note, converted_pdfs[signature], pdf))
+                    continue
+                converted_pdfs[signature] = pdf
+                notes.append(note)
+                pdfs.append(pdf)
+            note_dirs[note_dir] = dict(notes=notes, pdfs=pdfs)
+        err_processes += builder.convert(note_dirs, optimize=False)
+
+    for note, converted_pdf, pdf in shared_notes:
+        if is_pdf_note_outdated(note, pdf) and \
+                not is_pdf_note_outdated(note, converted_pdf):
+            link_file(converted_pdf, pdf)
+
+    for builder in builders:
+        err_processes += builder.optimize()
+
+    return err_processes
+
+
+def get_preflight_note_dirs(note_dirs, placeholder=None):
+    # notes without pdf, e.g. because their conversion failed, are left out
+    # or replaced by the placeholder, as they would fail the LaTeX run
+    preflight_note_dirs = dict()
+    for note_dir, nd in note_dirs.items():
+        is_valid = [os.path.isfile(pdf) for pdf in nd["pdfs"]]
+        if all(is_valid):
+            preflight_note_dirs[note_dir] = nd
+            continue
 
-    conf = load_user_journalmkrc()
-    conf = update_user_journalmkrc(conf)
+        nd = dict(nd)
+        for note, valid in zip(nd["notes"], is_valid):
+            if not valid and placeholder is None:
+                print_jmk(f"Exclude note {note}, it has no valid pdf")
+            elif not valid:
+                print_jmk(f"Use a placeholder for note {note}, it has no "
+                          f"valid pdf")
+        if placeholder is None:
+            for key in ("notes", "pdfs", "timestamps"):
+                nd[key] = [value for value, valid in zip(nd[key], is_valid)
+                           if valid]
+        else:
+            nd["pdfs"] = [pdf if valid else placeholder
+                          for pdf, valid in zip(nd["pdfs"], is_valid)]
+        preflight_note_dirs[note_dir] = nd
 
-    if "journal_period" not in conf:
-        conf.update(journal_period=[None, None])
+    return preflight_note_dirs
+
+
+def get_placeholder_pdf(conf, build_dir=""):
+    invalid_notes = conf.get("invalid_notes", "exclude")
+    if invalid_notes == "exclude":
+        return None
+    elif invalid_notes != "placeholder":
+        raise ValueError(f"Unknown value '{invalid_notes}' of invalid_notes, "
+                         f"use 'exclude' or 'placeholder'")
+
+    placeholder = os.path.abspath(os.path.join(build_dir,
+                                               placeholder_filename))
+    if not os.path.isfile(placeholder):
+        os.makedirs(os.path.dirname(placeholder), exist_ok=True)
+        write_placeholder_pdf(placeholder)
+
+    return placeholder
+
+
+def get_journal_document_tree(note_dirs, conf, build_dir=""):
+    user_formats = update_formats(conf)
+    note_dirs = get_preflight_note_dirs(note_dirs,
+                                        get_placeholder_pdf(conf, build_dir))
+
+    return get_document_tree(note_dirs,
+                             conf["journal_type"],
+                             formats,
+                             user_formats)
+
+
+def render_part_documents(document_tree, conf, jobs=1, profiler=None,
+                          build_dir="", preamble=None):
+    if profiler is None:
+        profiler = Profiler()
+
+    if conf.get("volumes", None) is None:
+        volumes = [("journal", None, document_tree)]
     else:
-        conf["journal_period"] = parse_period_dates(conf["journal_period"])
+        with profiler.phase("volumes"):
+            volumes = get_volumes(document_tree, conf["volumes"], build_dir)
+
+    latexmk_command = get_latexmk_command(conf, build_dir)
+    with profiler.phase("part_documents"):
+        err_processes, part_documents = make_part_documents(volumes,
+                                                            jobs,
+                                                            build_dir,
+                                                            preamble,
+                                                            latexmk_command)
+
+    with profiler.phase("merge_part_documents"):
+        merge_err_processes, updated_names = make_merged_documents(
+            volumes,
+            part_documents,
+            jobs,
+            build_dir,
+            preamble,
+            latexmk_command)
+    err_processes += merge_err_processes
+
+    # the merged documents are not compiled by latexmk, hence the journal is
+    # only opened if one of them was merged again
+    if conf.get("volumes", None) is not None and \
+            conf.get("volume_index", True):
+        write_index_file(volumes, build_dir=build_dir, preamble=preamble)
+        documents = [("journal", [os.path.join(build_dir, name + ".pdf")
+                                  for name, subtitle, volume_tree in volumes])]
+        return err_processes, documents, "journal"
+
+    journal = volumes[0][0] if updated_names and volumes else None
+    return err_processes, list(), journal
+
+
+def render_journal(document_tree, conf, jobs=1, profiler=None, build_dir=""):
+    err_processes = list()
+    if profiler is None:
+        profiler = Profiler()
+
+    backend = conf.get("backend", "latex")
+    if backend == "native":
+        print_jmk("Write journal.pdf with the native backend")
+        with profiler.phase("write_pdf_file"):
+            err_processes = write_pdf_file(
+                document_tree, os.path.join(build_dir, "journal.pdf"))
+        return err_processes, list(), "journal"
+    elif backend != "latex":
+        raise NotImplementedError
 
-    root_directory = os.path.abspath(os.path.join(*conf["root_directory"]))
+    preamble = get_journal_preamble(conf, build_dir)
+    if conf.get("precompiled_preamble", False):
+        with profiler.phase("preamble_format"):
+            process = make_preamble_format(preamble,
+                                           get_tex_engine(conf),
+                                           build_dir=build_dir)
+        if process is not None:
+            profiler.add_command(process)
+            if process.returncode != 0:
+                err_processes.append((0, process))
+
+    if conf.get("part_documents", False):
+        part_err_processes, documents, journal = render_part_documents(
+            document_tree, conf, jobs, profiler, build_dir, preamble)
+        return err_processes + part_err_processes, documents, journal
+
+    if conf.get("volumes", None) is None:
+        with profiler.phase("write_tex_file"):
+            write_tex_file(document_tree, build_dir=build_dir,
+                           preamble=preamble)
+        documents = [("journal", get_journal_pdfs(document_tree))]
+        return err_processes, documents, "journal"
+
+    with profiler.phase("volumes"):
+        volumes = get_volumes(document_tree, conf["volumes"], build_dir)
+
+    with profiler.phase("write_tex_file"):
+        documents = list()
+        for name, subtitle, volume_tree in volumes:
+            write_tex_file(volume_tree, name + ".tex", subtitle, build_dir,
+                           preamble)
+            documents.append((name, get_journal_pdfs(volume_tree)))
+        if conf.get("volume_index", True):
+            write_index_file(volumes, build_dir=build_dir,
+                             preamble=preamble)
+            documents.append(("journal", list()))
+            journal = "journal"
+        else:
+            journal = volumes[0][0] if volumes else None
 
-    exclude_directories = [os.path.abspath(os.path.join(*path))
-                           for path in conf["exclude_directories"]]
+    return err_processes, documents, journal
 
-    note_dirs = find_directories(root_directory,
-                                 conf["notes_directory_names"],
-                                 exclude_directories)
 
-    if "exclude_note_endings" not in conf:
-        conf.update({"exclude_note_endings": list()})
-    if "notes_pdf_inplace_export_commands" not in  conf:
-        conf.update({"notes_pdf_inplace_export_commands": list()})
+def compile_documents(documents, journal, jobs=1, profiler=None,
+                      build_dir="", latexmk_command=None):
+    err_processes = list()
+    if profiler is None:
+        profiler = Profiler()
 
-    pdf_export_commands = dict()
-    pdf_export_commands.update(conf["notes_pdf_export_commands"])
-    pdf_export_commands.update(conf["notes_pdf_inplace_export_commands"])
-    note_dirs = find_notes(note_dirs,
-                           pdf_export_commands,
-                           conf["exclude_note_endings"],
-                           conf["journal_period"],
-                           conf["datetime_filename_formats"])
+    with profiler.phase("latexmk"):
+        processes = make_tex_documents(documents, jobs, build_dir,
+                                       latexmk_command)
+
+    # without tex documents, the journal was written by the native backend
+    is_updated = not documents
+    for process in processes:
+        if process is None:
+            continue
+        profiler.add_command(process)
+        if process.returncode != 0:
+            err_processes.append((0, process))
+        is_updated = True
 
-    err_processes = make_pdf_notes(note_dirs,
-                                   pdf_export_commands,
-                                   conf["notes_pdf_inplace_export_commands"])
+    if journal is None or not is_updated:
+        return err_processes, None
 
-    user_formats = update_formats(conf)
-    document_tree = get_document_tree(note_dirs,
-                                      conf["journal_type"],
-                                      formats,
-                                      user_formats)
+    return err_processes, os.path.join(build_dir, journal + ".pdf")
 
-    write_tex_file(document_tree)
 
-    process = subprocess.run(["latexmk", "-norc", "-pdf", "journal.tex"])
-    if process.returncode != 0:
-        err_processes.append((0, process))
+def compile_journal(note_dirs, conf, jobs=1, profiler=None, build_dir=""):
+    if profiler is None:
+        profiler = Profiler()
 
-    open_journal()
+    with profiler.phase("document_tree"):
+        document_tree = get_journal_document_tree(note_dirs, conf, build_dir)
 
+    err_processes, documents, journal = render_journal(document_tree,
+                                                       conf,
+                                                       jobs,
+                                                       profiler,
+                                                       build_dir)
+
+    compile_err_processes, journal = compile_documents(
+        documents,
+        journal,
+        jobs,
+        profiler,
+        build_dir,
+        get_latexmk_command(conf, build_dir))
+
+    return err_processes + compile_err_processes, journal
+
+
+def print_errors(err_processes):
     if err_processes:
         print_jmk("Finished with errors")
         for p in err_processes:
@@ -653,11 +3629,577 @@ def make():
             elif p[0] == 1:
                 print_jmk("Process succeeded but no pdf note generated "
                           "from " + str(p))
+            elif p[0] == 2:
+                print_jmk(p[1])
             else:
                 raise NotImplementedError
     else:
         print_jmk("Finished")
 
 
+def watch_journal(builder):
+    conf = builder.conf
+    note_dirs = builder.note_dirs
+    debounce = conf.get("watch_debounce", 1.0)
+    note_endings = list(builder.pdf_export_commands) + [metadata_filename]
+
+    watcher = get_watcher(list(note_dirs),
+                          note_endings,
+                          conf["exclude_note_endings"],
+                          conf.get("watch_poll_interval", 2.0))
+    print_jmk(f"Watch {len(note_dirs)} notes directories for changes,",
+              "press Ctrl+C to stop")
+    try:
+        while True:
+            changed_dirs = watcher.wait_for_changes(None)
+            while True:
+                more_changed_dirs = watcher.wait_for_changes(debounce)
+                if not more_changed_dirs:
+                    break
+                changed_dirs |= more_changed_dirs
+
+            print_jmk("Changes in", ", ".join(sorted(changed_dirs)))
+            changed_note_dirs = {nd: dict() for nd in changed_dirs}
+            changed_note_dirs = find_notes(changed_note_dirs,
+                                           builder.pdf_export_commands,
+                                           conf["exclude_note_endings"],
+                                           conf["journal_period"],
+                                           conf["datetime_filename_formats"],
+                                           build_dir=builder.build_dir)
+            note_dirs.update(changed_note_dirs)
+
+            err_processes = builder.convert(changed_note_dirs)
+            builder.tree()
+            err_processes += builder.render()
+            err_processes += builder.compile()[0]
+
+            print_errors(err_processes)
+
+    except KeyboardInterrupt:
+        print_jmk("Stop watching")
+
+    finally:
+        watcher.close()
+
+
+def get_tmp_entry_name(pdf):
+    return os.path.basename(pdf).split(".")[0]
+
+
+def load_usage(build_dir=""):
+    try:
+        with open(os.path.join(build_dir, usage_filename)) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return dict()
+
+
+def save_usage(usage, build_dir=""):
+    filename = os.path.join(build_dir, usage_filename)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    usage_tmp_filename = filename + ".part"
+    with open(usage_tmp_filename, "w") as file:
+        json.dump(usage, file, separators=(",", ":"))
+    os.replace(usage_tmp_filename, filename)
+
+
+def get_tmp_entries(build_dir=""):
+    entries = dict()
+    try:
+        with os.scandir(os.path.join(build_dir, "tmp")) as dir_entries:
+            for dir_entry in dir_entries:
+                match = tmp_entry_regex.fullmatch(dir_entry.name)
+                if match and dir_entry.is_file(follow_symlinks=False):
+                    entries.setdefault(match.group(1), list()).append(
+                        (dir_entry.path, dir_entry.stat(follow_symlinks=False)))
+    except FileNotFoundError:
+        pass
+
+    return entries
+
+
+def get_tmp_size_limit(conf):
+    size_limit = conf.get("tmp_size_limit", None)
+    if size_limit is None:
+        return None
+
+    return size_limit * 2 ** 20
+
+
+def get_cache_size_limit(conf):
+    size_limit = conf.get("cache_size_limit", default_cache_size_limit)
+    if size_limit is None:
+        return None
+
+    return size_limit * 2 ** 20
+
+
+def collect_cache_garbage(cache_dir, size_limit=None):
+    if cache_dir is None or size_limit is None or \
+            not os.path.isdir(cache_dir):
+        return list()
+
+    evicted_pdfs = list()
+    with cache_lock(cache_dir):
+        size = 0
+        unused_pdfs = list()
+        for dir_path, dir_names, file_names in os.walk(
+                os.path.join(cache_dir, "pdfs")):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat_result = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                size += stat_result.st_size
+                # the pdfs linked into a build directory take no extra space,
+                # the ctime of the others is the time they were unlinked
+                if stat_result.st_nlink == 1:
+                    unused_pdfs.append((stat_result.st_ctime,
+                                        stat_result.st_size,
+                                        path))
+
+        unused_pdfs.sort()
+        for ctime, pdf_size, path in unused_pdfs:
+            if size <= size_limit:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            size -= pdf_size
+            evicted_pdfs.append(path)
+
+    if evicted_pdfs:
+        print_jmk(f"Removed {len(evicted_pdfs)} converted notes from the "
+                  f"cache {cache_dir}")
+
+    return evicted_pdfs
+
+
+def collect_garbage(note_dirs, size_limit=None, build_dir=""):
+    now = time.time()
+    usage = load_usage(build_dir)
+    used_names = set()
+    for nd in note_dirs.values():
+        for note, pdf in zip(nd["notes"], nd["pdfs"]):
+            name = get_tmp_entry_name(pdf)
+            usage[name] = dict(note=note, used=now)
+            used_names.add(name)
+
+    entries = get_tmp_entries(build_dir)
+
+    # converted notes of deleted or renamed notes are removed right away
+    evicted_names = list()
+    unused_names = list()
+    for name in entries:
+        if name in used_names:
+            continue
+        if name not in usage or not os.path.exists(usage[name]["note"]):
+            evicted_names.append(name)
+        else:
+            unused_names.append(name)
+
+    def get_size(names):
+        # the optimized pdf may be a hard link to the converted note
+        files = {(stat_result.st_dev, stat_result.st_ino): stat_result.st_size
+                 for name in names for path, stat_result in entries[name]}
+        return sum(files.values())
+
+    # the converted notes which are not part of this journal, e.g. out of
+    # the journal period, are removed least recently used first
+    if size_limit is not None:
+        size = get_size(set(entries) - set(evicted_names))
+        unused_names.sort(key=lambda name: usage[name]["used"])
+        for name in unused_names:
+            if size <= size_limit:
+                break
+            size -= get_size([name])
+            evicted_names.append(name)
+
+    evicted_size = get_size(evicted_names)
+    for name in evicted_names:
+        for path, stat_result in entries[name]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        usage.pop(name, None)
+    for name in list(usage):
+        if name not in entries:
+            del usage[name]
+    save_usage(usage, build_dir)
+
+    if evicted_names:
+        print_jmk(f"Removed {len(evicted_names)} converted notes "
+                  f"({evicted_size / 2 ** 20:.1f} MiB) from the tmp directory")
+
+    return evicted_names
+
+
+def load_conf(build_dir=""):
+    conf = load_user_journalmkrc()
+    conf = update_user_journalmkrc(conf, build_dir=build_dir)
+
+    return prepare_conf(conf)
+
+
+def prepare_conf(conf):
+    conf = copy.deepcopy(conf)
+
+    if "journal_period" not in conf:
+        conf.update(journal_period=[None, None])
+    else:
+        conf["journal_period"] = parse_period_dates(conf["journal_period"])
+
+    if "exclude_note_endings" not in conf:
+        conf.update({"exclude_note_endings": list()})
+    if "notes_pdf_inplace_export_commands" not in  conf:
+        conf.update({"notes_pdf_inplace_export_commands": list()})
+    if "notes_pdf_export_workers" not in conf:
+        conf.update({"notes_pdf_export_workers": dict()})
+
+    return conf
+
+
+def get_pdf_export_commands(conf):
+    pdf_export_commands = dict()
+    pdf_export_commands.update(conf["notes_pdf_export_commands"])
+    pdf_export_commands.update(conf["notes_pdf_inplace_export_commands"])
+    pdf_export_commands.update(conf["notes_pdf_export_workers"])
+
+    for pdf_command in pdf_export_commands.values():
+        get_builtin_converter(pdf_command)
+
+    return pdf_export_commands
+
+
+def get_scan_settings(conf, pdf_export_commands, rescan=False, build_dir=""):
+    root_directory = os.path.abspath(os.path.join(build_dir,
+                                                  *conf["root_directory"]))
+
+    exclude_directories = [os.path.abspath(os.path.join(build_dir, *path))
+                           for path in conf["exclude_directories"]
+                           if not isinstance(path, str)]
+    exclude_patterns = [path for path in conf["exclude_directories"]
+                        if isinstance(path, str)]
+
+    if conf.get("scan_index", True) and not rescan:
+        scan_index = load_scan_index(
+            get_scan_index_signature(conf,
+                                     root_directory,
+                                     exclude_directories + exclude_patterns,
+                                     pdf_export_commands),
+            build_dir)
+    else:
+        scan_index = None
+
+    return root_directory, exclude_directories, exclude_patterns, scan_index
+
+
+def scan_journal(conf, pdf_export_commands, rescan=False, profiler=None,
+                 build_dir=""):
+    if profiler is None:
+        profiler = Profiler()
+
+    root_directory, exclude_directories, exclude_patterns, scan_index = \
+        get_scan_settings(conf, pdf_export_commands, rescan, build_dir)
+
+    with profiler.phase("find_directories"):
+        note_dirs = find_directories(root_directory,
+                                     conf["notes_directory_names"],
+                                     exclude_directories,
+                                     scan_index,
+                                     exclude_patterns)
+
+    with profiler.phase("find_notes"):
+        note_dirs = find_notes(note_dirs,
+                               pdf_export_commands,
+                               conf["exclude_note_endings"],
+                               conf["journal_period"],
+                               conf["datetime_filename_formats"],
+                               scan_index,
+                               build_dir)
+
+    if scan_index is not None:
+        save_scan_index(scan_index, build_dir)
+
+    return note_dirs
+
+
+def is_subdirectory(path, directory):
+    return os.path.commonpath([path, directory]) == directory
+
+
+def get_scan_roots(root_directories):
+    scan_roots = list()
+    for root in sorted(set(root_directories)):
+        if not any(is_subdirectory(root, scan_root)
+                   for scan_root in scan_roots):
+            scan_roots.append(root)
+
+    return scan_roots
+
+
+def scan_journals(builders, rescan=False, profiler=None):
+    if profiler is None:
+        profiler = Profiler()
+
+    settings = [get_scan_settings(builder.conf,
+                                  builder.pdf_export_commands,
+                                  rescan,
+                                  builder.build_dir)
+                for builder in builders]
+
+    # the directories are shared by the scan indices of all journals, as
+    # they do not depend on the configuration
+    directories = dict()
+    for root, exclude_dirs, exclude_patterns, scan_index in settings:
+        if scan_index is not None:
+            directories.update(scan_index["directories"])
+
+    # only directories excluded by all journals are pruned from the walk,
+    # without directory names all directories are notes directories
+    notes_dir_names = set()
+    exclude_directories = None
+    exclude_patterns = None
+    for builder, (root, exclude_dirs, patterns, scan_index) in \
+            zip(builders, settings):
+        dir_names = builder.conf["notes_directory_names"]
+        if dir_names is None or notes_dir_names is None:
+            notes_dir_names = None
+        else:
+            notes_dir_names.update(dir_names)
+        if exclude_directories is None:
+            exclude_directories = set(exclude_dirs)
+            exclude_patterns = set(patterns)
+        else:
+            exclude_directories.intersection_update(exclude_dirs)
+            exclude_patterns.intersection_update(patterns)
+
+    found_note_dirs = dict()
+    with profiler.phase("find_directories"):
+        for root in get_scan_roots([root for root, *_ in settings]):
+            shared_index = new_scan_index(None)
+            shared_index["directories"] = directories
+            found_note_dirs.update(find_directories(root,
+                                                    notes_dir_names,
+                                                    sorted(exclude_directories),
+                                                    shared_index,
+                                                    sorted(exclude_patterns)))
+            directories.update(shared_index["directories"])
+
+    with profiler.phase("find_notes"):
+        for builder, (root, exclude_dirs, patterns, scan_index) in \
+                zip(builders, settings):
+            matcher = compile_exclude_matcher(exclude_dirs, patterns)
+            dir_names = builder.conf["notes_directory_names"]
+            note_dirs = {
+                note_dir: dict(entry)
+                for note_dir, entry in found_note_dirs.items()
+                if note_dir != root and is_subdirectory(note_dir, root) and
+                (dir_names is None or
+                 os.path.basename(note_dir) in dir_names) and
+                not is_excluded_directory(matcher, note_dir)}
+
+            if scan_index is not None:
+                scan_index["directories"] = {
+                    path: entry for path, entry in directories.items()
+                    if is_subdirectory(path, root)}
+
+            builder.note_dirs = find_notes(note_dirs,
+                                           builder.pdf_export_commands,
+                                           builder.conf["exclude_note_endings"],
+                                           builder.conf["journal_period"],
+                                           builder.conf[
+                                               "datetime_filename_formats"],
+                                           scan_index,
+                                           builder.build_dir)
+
+            if scan_index is not None:
+                save_scan_index(scan_index, builder.build_dir)
+
+    return [builder.note_dirs for builder in builders]
+
+
+class JournalBuilder:
+
+    def __init__(self, build_dir, conf=None, jobs=None, profiler=None):
+        self.build_dir = os.path.abspath(build_dir)
+        self.profiler = Profiler() if profiler is None else profiler
+
+        with self.profiler.phase("configuration"):
+            if conf is None:
+                self.conf = load_conf(self.build_dir)
+            else:
+                self.conf = prepare_conf(conf)
+        self.jobs = get_jobs(self.conf, jobs)
+        self.pdf_export_commands = get_pdf_export_commands(self.conf)
+
+        self.note_dirs = None
+        self.document_tree = None
+        self.documents = None
+        self.journal = None
+
+    def scan(self, rescan=False):
+        self.note_dirs = scan_journal(self.conf,
+                                      self.pdf_export_commands,
+                                      rescan,
+                                      self.profiler,
+                                      self.build_dir)
+
+        return self.note_dirs
+
+    def convert(self, note_dirs=None, optimize=True):
+        if note_dirs is None:
+            note_dirs = self.note_dirs
+
+        return convert_notes(note_dirs,
+                             self.conf,
+                             self.pdf_export_commands,
+                             self.jobs,
+                             self.profiler,
+                             self.build_dir,
+                             optimize)
+
+    def optimize(self, note_dirs=None):
+        if note_dirs is None:
+            note_dirs = self.note_dirs
+
+        return optimize_notes(note_dirs, self.conf, self.jobs, self.profiler)
+
+    def tree(self):
+        with self.profiler.phase("document_tree"):
+            self.document_tree = get_journal_document_tree(self.note_dirs,
+                                                           self.conf,
+                                                           self.build_dir)
+
+        return self.document_tree
+
+    def render(self):
+        err_processes, self.documents, self.journal = render_journal(
+            self.document_tree,
+            self.conf,
+            self.jobs,
+            self.profiler,
+            self.build_dir)
+
+        return err_processes
+
+    def compile(self):
+        return compile_documents(self.documents,
+                                 self.journal,
+                                 self.jobs,
+                                 self.profiler,
+                                 self.build_dir,
+                                 get_latexmk_command(self.conf,
+                                                     self.build_dir))
+
+    def plan(self):
+        return get_plan(self.note_dirs,
+                        self.pdf_export_commands,
+                        self.jobs,
+                        self.build_dir)
+
+    def collect_garbage(self):
+        with self.profiler.phase("collect_garbage"):
+            evicted_names = collect_garbage(self.note_dirs,
+                                            get_tmp_size_limit(self.conf),
+                                            self.build_dir)
+            collect_cache_garbage(get_cache_directory(self.conf,
+                                                      self.build_dir),
+                                  get_cache_size_limit(self.conf))
+
+        return evicted_names
+
+    def build(self, rescan=False):
+        self.scan(rescan)
+        err_processes = self.convert()
+        self.tree()
+        err_processes += self.render()
+        compile_err_processes, journal = self.compile()
+        err_processes += compile_err_processes
+        self.collect_garbage()
+
+        return err_processes, journal
+
+
+def make(jobs=None, rescan=False, watch=False, profile=None,
+         retry_failed=False):
+    print_jmk("This is Journalmk, Marcus Riesmeier, version: 2022.3")
+
+    builder = JournalBuilder(os.getcwd(), jobs=jobs,
+                             profiler=Profiler(profile))
+    if retry_failed:
+        clear_failed_notes(builder.build_dir)
+    err_processes, journal = builder.build(rescan)
+
+    if journal is not None:
+        open_journal(journal)
+
+    builder.profiler.report()
+    print_errors(err_processes)
+
+    if watch:
+        watch_journal(builder)
+
+
+def build_all(build_dirs, jobs=None, rescan=False, profile=None,
+              retry_failed=False):
+    print_jmk("This is Journalmk, Marcus Riesmeier, version: 2022.3")
+
+    profiler = Profiler(profile)
+    builders = [JournalBuilder(build_dir, jobs=jobs, profiler=profiler)
+                for build_dir in build_dirs]
+    if retry_failed:
+        for builder in builders:
+            clear_failed_notes(builder.build_dir)
+
+    scan_journals(builders, rescan, profiler)
+    err_processes = convert_journals(builders)
+
+    for builder in builders:
+        print_jmk(f"Compile the journal in {builder.build_dir}")
+        builder.tree()
+        err_processes += builder.render()
+        err_processes += builder.compile()[0]
+        builder.collect_garbage()
+
+    profiler.report()
+    print_errors(err_processes)
+
+
+def plan(jobs=None, rescan=False, json_filename=None):
+    print_jmk("This is Journalmk, Marcus Riesmeier, version: 2022.3")
+
+    builder = JournalBuilder(os.getcwd(), jobs=jobs)
+    builder.scan(rescan)
+    journal_plan = builder.plan()
+    print_plan(journal_plan)
+
+    if json_filename is not None:
+        with open(json_filename, "w") as file:
+            json.dump(journal_plan, file, indent=1)
+        print_jmk(f"Plan written to {json_filename}")
+
+
+def gc(rescan=False):
+    print_jmk("This is Journalmk, Marcus Riesmeier, version: 2022.3")
+
+    builder = JournalBuilder(os.getcwd())
+    builder.scan(rescan)
+    builder.collect_garbage()
+
+
+def run(argv=None):
+    arguments = parse_arguments(argv)
+    if arguments.command == "gc":
+        gc(arguments.rescan)
+    elif arguments.plan:
+        plan(arguments.jobs, arguments.rescan, arguments.json)
+    elif arguments.command == "build-all":
+        build_all(arguments.build_dirs, arguments.jobs, arguments.rescan,
+                  arguments.profile, arguments.retry_failed)
+    else:
+        make(arguments.jobs, arguments.rescan, arguments.watch,
+             arguments.profile, arguments.retry_failed)
+
+
 if __name__ == "__main__":
-    make()
\ No newline at end of file
+    run()
\ No newline at end of file
@@ -1,4 +1,7 @@
+import io
+import time
 import unittest
+import unittest.mock
 from journalmk.__main__ import main
 from journalmk.journalmk import *
 
@@ -11,27 +14,100 @@ for key, path in paths.items():
     paths[key] = os.path.abspath(os.path.join(*path))
 
 
+def get_pdf_data(text):
+    # a pdf, which passes the structural check of the converted notes
+    data = f"%PDF-1.4\n% {text}\n".encode()
+    return data + f"xref\n0 1\n0000000000 65535 f \n" \
+                  f"trailer\n<< /Size 1 >>\n" \
+                  f"startxref\n{len(data)}\n%%EOF\n".encode()
+
+
+# a latexmk, which writes a page per heading and note of a part document
+# (sections are on the page of their first note) and two pages otherwise
+part_latexmk_stub = r"""#!{python}
+import re
+import sys
+import pypdf
+
+with open({calls!r}, "a") as file:
+    file.write(" ".join(sys.argv[1:]) + "\n")
+name = sys.argv[-1][:-len(".tex")]
+with open(name + ".tex") as file:
+    kinds = re.findall(r"\\jmkpages{{(\w+) ", file.read())
+
+lines = list()
+page = 0
+previous_kind = None
+for kind in kinds:
+    if previous_kind != "section":
+        page += 1
+    lines.append(f"{{kind}} {{page}}")
+    previous_kind = kind
+if name.startswith("part-"):
+    with open(name + ".pages", "w") as file:
+        file.write("\n".join(lines + [str(page)]) + "\n")
+
+writer = pypdf.PdfWriter()
+for _ in range(page if name.startswith("part-") else 2):
+    writer.add_blank_page(595, 842)
+writer.write(name + ".pdf")
+"""
+
+
+class TmpDirTestCase(unittest.TestCase):
+    # every test runs in a temporary directory, stub commands are written to
+    # its bin directory, which is put in front of the PATH
+    change_directory = True
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        if self.change_directory:
+            os.chdir(self.tmp_dir.name)
+            self.addCleanup(os.chdir, self.cwd)
+        self.calls = os.path.join(self.tmp_dir.name, "calls")
+
+    def add_command(self, name, script):
+        bin_dir = os.path.join(self.tmp_dir.name, "bin")
+        if not os.path.isdir(bin_dir):
+            os.mkdir(bin_dir)
+            self.addCleanup(os.environ.update, PATH=os.environ["PATH"])
+            os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+        command = os.path.join(bin_dir, name)
+        with open(command, "w") as file:
+            file.write(textwrap.dedent(script))
+        os.chmod(command, 0o755)
+
+        return command
+
+    def get_calls(self):
+        with open(self.calls) as file:
+            return len(file.readlines())
+
+
 class TestMain(unittest.TestCase):
 
     def test_chronological(self):
         os.chdir(paths["chrono"])
         subprocess.run(["latexmk", "-c"])
-        main()
+        main([])
 
     def test_topological(self):
         os.chdir(paths["topo"])
         subprocess.run(["latexmk", "-c"])
-        main()
+        main([])
 
     def test_chronological_matplotlib(self):
         os.chdir(paths["chrono_mpl"])
         subprocess.run(["latexmk", "-c"])
-        main()
+        main([])
 
     def test_topological_libreoffice(self):
         os.chdir(paths["topo_libre"])
         subprocess.run(["latexmk", "-c"])
-        main()
+        main([])
 
 
 class TestFileUpdates(unittest.TestCase):
@@ -63,3 +139,1206 @@ class TestFileUpdates(unittest.TestCase):
         self.assertEqual(jmkrc, self.jmkrcs["ignore"])
 
 
+class TestPdfNotes(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.note_dir = os.path.join(self.tmp_dir.name, "_notes")
+        os.mkdir(self.note_dir)
+        notes = [os.path.join(self.note_dir, f"note{i}.pdfnote")
+                 for i in range(8)]
+        for note in notes:
+            with open(note, "wb") as file:
+                file.write(get_pdf_data(note))
+        pdfs = [os.path.abspath(os.path.join("tmp", f"{i}.pdf"))
+                for i in range(8)]
+        self.note_dirs = {self.note_dir: dict(notes=notes, pdfs=pdfs)}
+
+    def test_parallel(self):
+        failed = make_pdf_notes(self.note_dirs,
+                                {"pdfnote": "cp {pdfnote} {pdf}"},
+                                dict(), jobs=4)
+        self.assertEqual(failed, list())
+        for pdf in self.note_dirs[self.note_dir]["pdfs"]:
+            self.assertTrue(os.path.isfile(pdf))
+
+        failed = make_pdf_notes(self.note_dirs,
+                                {"pdfnote": "false"},
+                                dict(), jobs=4)
+        self.assertEqual(failed, list())
+
+    def test_failure(self):
+        failed = make_pdf_notes(self.note_dirs,
+                                {"pdfnote": "false"},
+                                dict(), jobs=4)
+        self.assertEqual(len(failed), 8)
+        self.assertTrue(all(f[0] == 0 for f in failed))
+
+        failed = make_pdf_notes(self.note_dirs,
+                                {"pdfnote": "true"},
+                                dict(), jobs=4)
+        self.assertEqual(len(failed), 8)
+        self.assertTrue(all(f[0] == 1 for f in failed))
+
+    def test_cache(self):
+        cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        failed = make_pdf_notes(self.note_dirs,
+                                {"pdfnote": "cp {pdfnote} {pdf}"},
+                                dict(), jobs=4, cache_dir=cache_dir)
+        self.assertEqual(failed, list())
+
+        other_pdfs = [os.path.join(self.tmp_dir.name, "other", f"{i}.pdf")
+                      for i in range(8)]
+        other_note_dirs = {self.note_dir: dict(
+            notes=self.note_dirs[self.note_dir]["notes"], pdfs=other_pdfs)}
+        failed = make_pdf_notes(other_note_dirs,
+                                {"pdfnote": "cp {pdfnote} {pdf}"},
+                                dict(), jobs=4, cache_dir=cache_dir)
+        self.assertEqual(failed, list())
+        for note, pdf in zip(self.note_dirs[self.note_dir]["notes"],
+                             other_pdfs):
+            with open(note) as note_file, open(pdf) as pdf_file:
+                self.assertEqual(note_file.read(), pdf_file.read())
+            self.assertGreater(os.stat(pdf).st_nlink, 2)
+
+        # only the cached pdfs, which are not linked anymore, are removed
+        pdfs = self.note_dirs[self.note_dir]["pdfs"]
+        for pdf in pdfs[:4] + other_pdfs[:4]:
+            os.remove(pdf)
+        evicted_pdfs = collect_cache_garbage(cache_dir, 0)
+        self.assertEqual(len(evicted_pdfs), 4)
+        self.assertEqual(collect_cache_garbage(cache_dir, 0), list())
+        for pdf in pdfs[4:]:
+            self.assertEqual(os.stat(pdf).st_nlink, 3)
+        self.assertEqual(collect_cache_garbage(cache_dir, None), list())
+
+    def test_timeout(self):
+        start = time.perf_counter()
+        failed = make_pdf_notes(self.note_dirs, {"pdfnote": "sleep 10"},
+                                dict(), jobs=8, timeouts={"pdfnote": 0.5},
+                                negative_cache=True)
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(len(failed), 8)
+        self.assertTrue(all(f[1].timed_out for f in failed))
+
+        # the failed notes are skipped until they change
+        failed = make_pdf_notes(self.note_dirs, {"pdfnote": "sleep 10"},
+                                dict(), jobs=8, negative_cache=True)
+        self.assertEqual(len(failed), 8)
+        self.assertTrue(all(f[0] == 2 for f in failed))
+
+        # unless they are tried again
+        clear_failed_notes()
+        failed = make_pdf_notes(self.note_dirs, {"pdfnote": "sleep 10"},
+                                dict(), jobs=8, timeouts={"pdfnote": 0.5},
+                                negative_cache=True)
+        self.assertEqual(len(failed), 8)
+        self.assertTrue(all(f[0] == 0 for f in failed))
+
+        os.utime(self.note_dirs[self.note_dir]["notes"][0], ns=(0, 0))
+        failed = make_pdf_notes(self.note_dirs, {"pdfnote": "sleep 10"},
+                                dict(), jobs=8, timeouts={"pdfnote": 0.5},
+                                negative_cache=True)
+        self.assertEqual(sorted(f[0] for f in failed), [0] + 7 * [2])
+
+        # a changed conversion command is tried again
+        failed = make_pdf_notes(self.note_dirs,
+                                {"pdfnote": "cp {pdfnote} {pdf}"},
+                                dict(), jobs=8, negative_cache=True)
+        self.assertEqual(failed, list())
+        self.assertEqual(load_failed_notes(), dict())
+
+    def test_interrupt(self):
+        # the commands run in sessions of their own, hence the interrupt
+        # does not reach them and they have to be killed by journalmk
+        self.add_command("convert", f"""\
+            #!/bin/sh
+            sleep 10 &
+            echo $! >> {self.calls}
+            wait
+            """)
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT))
+        start = time.perf_counter()
+        timer.start()
+        with self.assertRaises(KeyboardInterrupt):
+            make_pdf_notes(self.note_dirs, {"pdfnote": "convert"},
+                           dict(), jobs=2, timeouts={"pdfnote": 60})
+        timer.join()
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(session_processes.processes, set())
+
+        # the children of the commands are killed as well
+        self.assertEqual(self.get_calls(), 2)
+        with open(self.calls) as file:
+            for pid in file.read().split():
+                try:
+                    with open(f"/proc/{pid}/stat") as stat_file:
+                        state = stat_file.read().rsplit(")", 1)[1].split()[0]
+                except FileNotFoundError:
+                    state = "X"
+                self.assertIn(state, ("X", "Z"))
+
+    def test_optimize(self):
+        failed = make_pdf_notes(self.note_dirs,
+                                {"pdfnote": "cp {pdfnote} {pdf}"},
+                                dict(), jobs=4)
+        self.assertEqual(failed, list())
+        raw_pdfs = self.note_dirs[self.note_dir]["pdfs"]
+
+        failed = optimize_pdf_notes(self.note_dirs, "false", jobs=4)
+        self.assertEqual(len(failed), 8)
+        self.assertEqual(self.note_dirs[self.note_dir]["pdfs"], raw_pdfs)
+
+        failed = optimize_pdf_notes(self.note_dirs, "cp {pdf} {optpdf}",
+                                    jobs=4)
+        self.assertEqual(failed, list())
+        pdfs = self.note_dirs[self.note_dir]["pdfs"]
+        self.assertEqual(pdfs, [get_optimized_pdf_path(pdf)
+                                for pdf in raw_pdfs])
+        # the optimized pdf is not smaller, hence the raw pdf is used
+        self.assertTrue(os.path.samefile(pdfs[0], raw_pdfs[0]))
+
+        fingerprint = pdfs[0] + ".fingerprint"
+        mtime = os.stat(fingerprint).st_mtime_ns
+        self.note_dirs[self.note_dir]["pdfs"] = raw_pdfs
+        failed = optimize_pdf_notes(self.note_dirs, "cp {pdf} {optpdf}",
+                                    jobs=4)
+        self.assertEqual(failed, list())
+        self.assertEqual(self.note_dirs[self.note_dir]["pdfs"], pdfs)
+        self.assertEqual(os.stat(fingerprint).st_mtime_ns, mtime)
+
+    def test_preflight(self):
+        pdf = os.path.join(self.tmp_dir.name, "a.pdf")
+        data = get_pdf_data("a")
+        for content, is_valid in ((data, True),
+                                  (b"", False),
+                                  (data[:-20], False),
+                                  (data.replace(b"\nxref", b"\nxfer"), False),
+                                  (b"<html>" + data[8:], False)):
+            with open(pdf, "wb") as file:
+                file.write(content)
+            self.assertEqual(check_pdf(pdf) is None, is_valid)
+
+        failed = make_pdf_notes(self.note_dirs, {"pdfnote": "touch {pdf}"},
+                                dict(), jobs=4, negative_cache=True)
+        self.assertEqual(len(failed), 8)
+        self.assertTrue(all(f[0] == 2 and "no pdf header" in f[1]
+                            for f in failed))
+        pdfs = self.note_dirs[self.note_dir]["pdfs"]
+        self.assertFalse(any(os.path.exists(pdf) for pdf in pdfs))
+        self.assertEqual(len(load_failed_notes()), 8)
+
+        shutil.copyfile(self.note_dirs[self.note_dir]["notes"][0], pdfs[0])
+        self.note_dirs[self.note_dir]["timestamps"] = [
+            datetime.datetime(2020, 5, 21, 20, i) for i in range(8)]
+        note_dirs = get_preflight_note_dirs(self.note_dirs)
+        self.assertEqual(note_dirs[self.note_dir]["pdfs"], pdfs[:1])
+        self.assertEqual(len(note_dirs[self.note_dir]["timestamps"]), 1)
+        self.assertEqual(len(self.note_dirs[self.note_dir]["pdfs"]), 8)
+
+        placeholder = get_placeholder_pdf(dict(invalid_notes="placeholder"))
+        self.assertIsNone(check_pdf(placeholder))
+        note_dirs = get_preflight_note_dirs(self.note_dirs, placeholder)
+        self.assertEqual(note_dirs[self.note_dir]["pdfs"],
+                         pdfs[:1] + 7 * [placeholder])
+        if pypdf is not None:
+            self.assertEqual(len(pypdf.PdfReader(placeholder).pages), 1)
+
+    def test_profile(self):
+        profile = os.path.join("tmp", "profile.jsonl")
+        profiler = Profiler(profile)
+        records = list()
+        with profiler.phase("make_pdf_notes"):
+            failed = make_pdf_notes(self.note_dirs,
+                                    {"pdfnote": "cp {pdfnote} {pdf}"},
+                                    dict(), jobs=4, records=records)
+        self.assertEqual(failed, list())
+        self.assertEqual(len(records), 8)
+        self.assertTrue(all(r["extension"] == "pdfnote" for r in records))
+        profiler.add_conversions(records)
+        profiler.report()
+
+        with open(profile) as file:
+            lines = [json.loads(line) for line in file]
+        self.assertEqual([line["type"] for line in lines],
+                         ["phase"] + 8 * ["conversion"])
+
+
+class TestScanIndex(TmpDirTestCase):
+    change_directory = False
+
+    def setUp(self):
+        super().setUp()
+        self.root = self.tmp_dir.name
+        self.note_dir = os.path.join(self.root, "a", "_notes")
+        os.makedirs(self.note_dir)
+        self.add_note("2020-05-21-Note-20-20.xopp")
+        for path in (self.root, os.path.dirname(self.note_dir)):
+            os.utime(path, (0, 0))
+
+    def add_note(self, name):
+        open(os.path.join(self.note_dir, name), "w").close()
+        os.utime(self.note_dir, (0, 0))
+
+    def scan(self, index, period=(None, None)):
+        note_dirs = find_directories(self.root, ["_notes"], [], index)
+        return find_notes(note_dirs, ["xopp"], [], period,
+                          ["%Y-%m-%d-Note-%H-%M"], index)
+
+    def test_index(self):
+        index = new_scan_index("test")
+        note_dirs = self.scan(index)
+        self.assertEqual(len(note_dirs[self.note_dir]["notes"]), 1)
+
+        # unchanged directory mtime, the cached catalog is used
+        self.add_note("2021-05-21-Note-20-20.xopp")
+        note_dirs = self.scan(index)
+        self.assertEqual(len(note_dirs[self.note_dir]["notes"]), 1)
+
+        os.utime(self.note_dir, (1, 1))
+        note_dirs = self.scan(index)
+        self.assertEqual(len(note_dirs[self.note_dir]["notes"]), 2)
+
+        period = (datetime.datetime(2021, 1, 1), None)
+        note_dirs = self.scan(index, period)
+        self.assertEqual(note_dirs[self.note_dir]["timestamps"],
+                         [datetime.datetime(2021, 5, 21, 20, 20)])
+
+    def test_exclude_patterns(self):
+        excluded_dir = os.path.join(self.root, "b", ".git", "_notes")
+        os.makedirs(excluded_dir)
+        note_dirs = find_directories(self.root, ["_notes"], [], None,
+                                     ["**/.git"])
+        self.assertEqual(list(note_dirs), [self.note_dir])
+
+        note_dirs = find_directories(self.root, ["_notes"],
+                                     [os.path.join(self.root, "a")])
+        self.assertEqual(list(note_dirs), [excluded_dir])
+
+    def test_unreadable_directory(self):
+        unreadable_dir = os.path.join(self.root, "b")
+        os.makedirs(os.path.join(unreadable_dir, "_notes"))
+        scandir = os.scandir
+
+        def scandir_mock(path):
+            if path.startswith(unreadable_dir):
+                raise PermissionError(13, "Permission denied", path)
+            return scandir(path)
+
+        index = new_scan_index("test")
+        with unittest.mock.patch("os.scandir", scandir_mock):
+            note_dirs = self.scan(index)
+        self.assertEqual(list(note_dirs), [self.note_dir])
+        self.assertNotIn(unreadable_dir, index["directories"])
+
+    def test_vanished_directory(self):
+        vanished_dir = os.path.join(self.root, "b", "_notes")
+        os.makedirs(vanished_dir)
+        for path in (self.root, os.path.dirname(vanished_dir)):
+            os.utime(path, (0, 0))
+        stat = os.stat
+
+        def stat_mock(path, *args, **kwargs):
+            if path == vanished_dir:
+                raise FileNotFoundError(2, "No such file or directory", path)
+            return stat(path, *args, **kwargs)
+
+        # the cached subdirectories of the parent are used, hence the
+        # directory is only noticed to be missing by its stat
+        index = new_scan_index("test")
+        self.scan(index)
+        with unittest.mock.patch("os.stat", stat_mock):
+            note_dirs = find_directories(self.root, ["_notes"], [], index)
+        self.assertEqual(list(note_dirs), [self.note_dir])
+
+
+class TestTimestamps(unittest.TestCase):
+
+    def test_parse_datetime(self):
+        formats = ["%Y-%m-%d-Note-%H-%M", "%Y_%m_%d %H_%M Office Lens",
+                   "%y%m%d", "%d %B %Y"]
+        stems = ["2020-05-21-Note-20-20", "2020-0521-Note-20-21",
+                 "2020-02-30-Note-20-20", "2020_05_21  20_20 office lens",
+                 "200521", "1212", "21 May 2020", "some_note"]
+        for fo in formats:
+            for stem in stems:
+                try:
+                    ts = datetime.datetime.strptime(stem, fo)
+                except ValueError:
+                    ts = None
+                self.assertEqual(parse_datetime(stem, fo), ts)
+
+    def test_format_hint(self):
+        formats = ["%Y%m%d", "%Y%d%m", "%Y-%m-%d"]
+        self.assertEqual(parse_filename_timestamp("2020-05-21", formats, 2),
+                         (datetime.datetime(2020, 5, 21), 2))
+        self.assertEqual(parse_filename_timestamp("20200102", formats, 1),
+                         (datetime.datetime(2020, 1, 2), 0))
+        self.assertEqual(parse_filename_timestamp("note", formats, 1),
+                         (None, None))
+
+
+class TestDocumentTree(unittest.TestCase):
+
+    def setUp(self):
+        timestamps = [datetime.datetime(2020, 5, 21, 20, 20),
+                      datetime.datetime(2021, 1, 3, 8, 0),
+                      datetime.datetime(2021, 1, 4, 8, 0),
+                      datetime.datetime(2020, 5, 22, 9, 0)]
+        metadata = [dict(part="B"), dict(part="A", chapter="C"), None]
+        self.note_dirs = {
+            f"/n{i}": dict(notes=[f"/n{i}/note{j}" for j in range(4)],
+                           pdfs=[f"/tmp/{i}{j}.pdf" for j in range(4)],
+                           timestamps=timestamps,
+                           metadata=md)
+            for i, md in enumerate(metadata)}
+
+    def get_labels(self, document_tree):
+        return [(part, [(chapter, [(section, [entry.pdf for entry in entries])
+                                   for section, entries in sections])
+                        for chapter, sections in chapters])
+                for part, chapters in document_tree]
+
+    def test_chronological(self):
+        document_tree = get_document_tree(self.note_dirs, "chronological",
+                                          formats, formats)
+        self.assertEqual([part for part, chapters in document_tree],
+                         ["2021", "2020"])
+        self.assertEqual(self.get_labels(document_tree)[0][1],
+                         [("January",
+                           [("Week 01", ["/tmp/02.pdf", "/tmp/12.pdf",
+                                         "/tmp/22.pdf"]),
+                            ("Week 00", ["/tmp/01.pdf", "/tmp/11.pdf",
+                                         "/tmp/21.pdf"])])])
+
+    def test_topological(self):
+        document_tree = get_document_tree(self.note_dirs, "topological",
+                                          formats, formats)
+        labels = self.get_labels(document_tree)
+        self.assertEqual([part for part, chapters in labels], ["A", "B", None])
+        self.assertEqual(labels[0], ("A", [("C", [(None, [
+            "/tmp/12.pdf", "/tmp/11.pdf", "/tmp/13.pdf", "/tmp/10.pdf"])])]))
+        self.assertEqual(labels[2][1][1],
+                         ("2020", [("May", ["/tmp/23.pdf", "/tmp/20.pdf"])]))
+
+
+class TestWatch(TmpDirTestCase):
+    change_directory = False
+
+    def test_watchers(self):
+        note_dir = self.tmp_dir.name
+        watchers = [lambda: PollingWatcher([note_dir], ["xopp"],
+                                           ["autosave.xopp"], 0.05)]
+        if platform.system() == "Linux":
+            watchers.append(lambda: InotifyWatcher([note_dir], ["xopp"],
+                                                   ["autosave.xopp"]))
+        for get_watcher in watchers:
+            watcher = get_watcher()
+            note = os.path.join(note_dir, "note.xopp")
+            open(note + ".autosave.xopp", "w").close()
+            self.assertEqual(watcher.wait_for_changes(0.2), set())
+            with open(note, "w") as file:
+                file.write(str(watcher))
+            self.assertEqual(watcher.wait_for_changes(0.2), {note_dir})
+            os.remove(note)
+            os.remove(note + ".autosave.xopp")
+            self.assertEqual(watcher.wait_for_changes(0.2), {note_dir})
+            watcher.close()
+
+
+class TestPartDocuments(TmpDirTestCase):
+
+    def test_read_part_pages(self):
+        pages_filename = os.path.join(self.tmp_dir.name, "part.pages")
+        with open(pages_filename, "w") as file:
+            file.write("part 1\nchapter 2\nsubsection 3\nsubsection 5\n7\n")
+        kinds = ["part", "chapter", "subsection", "subsection"]
+        self.assertEqual(read_part_pages(pages_filename, kinds),
+                         ([1, 2, 3, 5], 7))
+        with self.assertRaises(ValueError):
+            read_part_pages(pages_filename, kinds[1:])
+
+    def test_part_tex(self):
+        entries = [NoteEntry("/notes/a.xopp", "/tmp/a.pdf", None, None, "a"),
+                   NoteEntry("/notes/b.xopp", "/tmp/b.pdf", None, None, "b")]
+        chapters = [("Chapter", [("Section", entries)])]
+        toc = list()
+        tex = get_part_tex("Part", chapters, toc)
+        self.assertEqual(toc, [("part", "Part"),
+                               ("chapter", "Chapter"),
+                               ("section", "Section"),
+                               ("subsection", "a"),
+                               ("subsection", "b")])
+        self.assertEqual(tex.count(r"\write\jmkpages"), 5)
+        self.assertNotIn("jmkpages", get_part_tex("Part", chapters))
+
+    def write_pdf(self, name, pages, links=()):
+        writer = pypdf.PdfWriter()
+        for _ in range(pages):
+            writer.add_blank_page(595, 842)
+        # links to named destinations on the first page, like hyperref
+        for destination, page_number in links:
+            writer.add_named_destination(destination, page_number)
+            writer.add_annotation(0, pypdf.generic.DictionaryObject({
+                pypdf.generic.NameObject("/Type"):
+                    pypdf.generic.NameObject("/Annot"),
+                pypdf.generic.NameObject("/Subtype"):
+                    pypdf.generic.NameObject("/Link"),
+                pypdf.generic.NameObject("/Rect"):
+                    pypdf.generic.ArrayObject(
+                        [pypdf.generic.NumberObject(0)] * 4),
+                pypdf.generic.NameObject("/A"):
+                    pypdf.generic.DictionaryObject({
+                        pypdf.generic.NameObject("/S"):
+                            pypdf.generic.NameObject("/GoTo"),
+                        pypdf.generic.NameObject("/D"):
+                            pypdf.generic.TextStringObject(destination)})}))
+        filename = os.path.join(self.tmp_dir.name, name + ".pdf")
+        writer.write(filename)
+        return filename
+
+    @unittest.skipIf(pypdf is None, "pypdf is not installed")
+    def test_merge_part_documents(self):
+        # pdfTeX replaces the missing destinations of the front document by
+        # destinations to its first page
+        front_pdf = self.write_pdf("front", 2, [("jmk.3", 0)])
+        part_pdfs = [self.write_pdf("part-a", 3, [("page.2", 1)]),
+                     self.write_pdf("part-b", 2, [("page.2", 1)])]
+        toc = [("part", "A", 1),
+               ("chapter", "Chapter", 2),
+               ("subsection", "a", 3),
+               ("part", "B", 4),
+               ("subsection", "b", 5)]
+        journal = os.path.join(self.tmp_dir.name, "journal.pdf")
+        merge_part_documents(front_pdf, part_pdfs, toc, journal)
+
+        reader = pypdf.PdfReader(journal)
+        self.assertEqual(reader.page_labels,
+                         ["i", "ii", "1", "2", "3", "4", "5"])
+        contents, part_a, (chapter, (note_a,)), part_b, (note_b,) = \
+            reader.outline
+        self.assertEqual([item.title for item in (contents, part_a, chapter,
+                                                  note_a, part_b, note_b)],
+                         ["Contents", "A", "Chapter", "a", "B", "b"])
+        self.assertEqual([reader.get_destination_page_number(item)
+                          for item in (contents, part_a, note_a, part_b)],
+                         [1, 2, 4, 5])
+
+        # the links of the parts and of the table of contents are kept
+        destinations = {name: reader.get_destination_page_number(destination)
+                        for name, destination
+                        in reader.named_destinations.items()}
+        for page_index, destination, page_number in (
+                (0, "jmk.3", 5),
+                (2, "part-a.page.2", 3),
+                (5, "part-b.page.2", 6)):
+            link, = reader.pages[page_index]["/Annots"]
+            self.assertEqual(link.get_object()["/A"]["/D"], destination)
+            self.assertEqual(destinations[destination], page_number)
+
+
+@unittest.skipIf(pypdf is None, "pypdf is not installed")
+class TestNativeBackend(TmpDirTestCase):
+
+    def test_write_pdf_file(self):
+        tmp_dir = self.tmp_dir.name
+        pdfs = list()
+        for i in range(3):
+            writer = pypdf.PdfWriter()
+            for _ in range(i + 1):
+                writer.add_blank_page(595, 842)
+            pdfs.append(os.path.join(tmp_dir, f"{i}.pdf"))
+            writer.write(pdfs[-1])
+
+        entries = [NoteEntry("/notes/a.xopp", pdfs[0], None, None, "a"),
+                   NoteEntry("/notes/b.xopp", pdfs[1], None, None, "b"),
+                   NoteEntry("/notes/c.xopp", pdfs[2], None, None, "c")]
+        document_tree = [
+            ("Part", [("Chapter", [("Section", entries[:2])]),
+                      (None, [(None, entries[2:])])])]
+        journal = os.path.join(tmp_dir, "journal.pdf")
+        self.assertEqual(write_pdf_file(document_tree, journal), list())
+
+        reader = pypdf.PdfReader(journal)
+        self.assertEqual(len(reader.pages), 6)
+        part, items = reader.outline
+        self.assertEqual(part.title, "Part")
+        self.assertEqual([it.title for it in items
+                          if not isinstance(it, list)],
+                         ["Chapter", "c"])
+        self.assertEqual(reader.get_destination_page_number(items[-1]), 3)
+        link = reader.pages[1 + 2]["/Annots"][0].get_object()
+        self.assertEqual(link["/A"]["/F"], "/notes/c.xopp")
+
+        # the two pages of note b link to it
+        for page in reader.pages[1:3]:
+            link, = page["/Annots"]
+            self.assertEqual(link.get_object()["/A"]["/F"], "/notes/b.xopp")
+            self.assertIn("/notes/b.xopp", page.extract_text())
+
+
+class TestBatches(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.profiles = os.path.join(self.tmp_dir.name, "profiles")
+        self.converter = self.add_command("convert.sh", f"""\
+                #!/bin/sh
+                echo call >> {self.calls}
+                while [ $# -gt 0 ]; do
+                    case "$1" in
+                        --outdir) outdir="$2"; shift 2;;
+                        --profile) echo "$2" >> {self.profiles}; shift 2;;
+                        *) files="$files $1"; shift;;
+                    esac
+                done
+                for f in $files; do
+                    cp "$f" "$outdir/$(basename "$f" .odt).pdf"
+                done
+                """)
+
+        self.note_dirs = dict()
+        for note_dir in ("a", "b"):
+            note_dir = os.path.join(self.tmp_dir.name, note_dir)
+            os.mkdir(note_dir)
+            notes = [os.path.join(note_dir, f"note{i}.odt") for i in range(3)]
+            for note in notes:
+                with open(note, "wb") as file:
+                    file.write(get_pdf_data(note))
+            pdfs = [os.path.abspath(os.path.join("tmp", f"{i}.pdf"))
+                    for i in range(len(self.note_dirs) * 3,
+                                   len(self.note_dirs) * 3 + 3)]
+            self.note_dirs[note_dir] = dict(notes=notes, pdfs=pdfs)
+
+    def test_batches(self):
+        commands = {"odt": self.converter + " {odt} --outdir {outdir}"}
+        failed = make_pdf_notes(self.note_dirs, commands, commands,
+                                jobs=2, batch_size=None)
+        self.assertEqual(failed, list())
+        self.assertEqual(self.get_calls(), 2)
+        for note_dir in self.note_dirs.values():
+            for note, pdf in zip(note_dir["notes"], note_dir["pdfs"]):
+                with open(note) as note_file, open(pdf) as pdf_file:
+                    self.assertEqual(note_file.read(), pdf_file.read())
+        self.assertEqual(sorted(os.listdir("tmp")),
+                         [f"{i}.pdf" for i in range(6)])
+
+    def test_concurrent_jobs(self):
+        # notes with the same name from both directories convert at once
+        commands = {"odt": self.converter
+                    + " {odt} --outdir {outdir} --profile {profiledir}"}
+        failed = make_pdf_notes(self.note_dirs, commands, commands, jobs=4,
+                                concurrency={"odt": 2})
+        self.assertEqual(failed, list())
+        self.assertEqual(self.get_calls(), 6)
+        for note_dir in self.note_dirs.values():
+            for note, pdf in zip(note_dir["notes"], note_dir["pdfs"]):
+                with open(note) as note_file, open(pdf) as pdf_file:
+                    self.assertEqual(note_file.read(), pdf_file.read())
+        self.assertEqual(sorted(os.listdir("tmp")),
+                         [f"{i}.pdf" for i in range(6)] + ["profiles"])
+        profiles_dir = os.path.abspath(os.path.join("tmp", "profiles", "odt"))
+        with open(self.profiles) as file:
+            profiles = set(file.read().split())
+        self.assertTrue(profiles <= {os.path.join(profiles_dir, "0"),
+                                     os.path.join(profiles_dir, "1")})
+        self.assertTrue(all(os.path.isdir(profile) for profile in profiles))
+
+    def test_invalid_concurrency(self):
+        commands = {"odt": self.converter + " {odt} --outdir {outdir}"}
+        with self.assertRaises(ValueError):
+            make_pdf_notes(self.note_dirs, commands, commands,
+                           concurrency={"odt": 0})
+
+
+class TestConverterWorker(TmpDirTestCase):
+    change_directory = False
+
+    def setUp(self):
+        super().setUp()
+        self.worker = os.path.join(self.tmp_dir.name, "worker.py")
+        with open(self.worker, "w") as file:
+            file.write(textwrap.dedent("""\
+                import os, shutil, sys, time
+                from journalmk import serve_converter_worker
+
+                def convert(note, pdf):
+                    print("pid", os.getpid())
+                    if note.endswith("slow.txt"):
+                        time.sleep(0.5)
+                    if note.endswith("bad.txt"):
+                        raise ValueError("bad note")
+                    shutil.copy(note, pdf)
+                    return 0, "converted " + note
+
+                serve_converter_worker(convert)
+                """))
+
+        package_dir = os.path.abspath(os.path.join(
+            os.path.dirname(__file__), "..", ".."))
+        python_path = os.environ.get("PYTHONPATH", None)
+        os.environ["PYTHONPATH"] = package_dir
+        if python_path is None:
+            self.addCleanup(os.environ.pop, "PYTHONPATH")
+        else:
+            self.addCleanup(os.environ.update, PYTHONPATH=python_path)
+
+    def write_note(self, name):
+        note = os.path.join(self.tmp_dir.name, name)
+        with open(note, "w") as file:
+            file.write(name)
+        return note
+
+    def test_worker(self):
+        worker = ConverterWorker(sys.executable + " " + self.worker)
+        try:
+            for name in ("a.txt", "b.txt", "bad.txt"):
+                note = self.write_note(name)
+                process = worker.convert(note, note + ".pdf")
+                if name == "bad.txt":
+                    self.assertEqual(process.returncode, 1)
+                    self.assertIn("bad note", process.stdout)
+                else:
+                    self.assertEqual(process.returncode, 0)
+                    self.assertTrue(os.path.isfile(note + ".pdf"))
+            pid = worker.process.pid
+        finally:
+            worker.close()
+        self.assertEqual(process.stdout.count(f"pid {pid}"), 1)
+
+    def test_worker_pool(self):
+        pool = ConverterWorkerPool(sys.executable + " " + self.worker, 2)
+        notes = [self.write_note(name)
+                 for name in ("a-slow.txt", "b-slow.txt", "c.txt")]
+        try:
+            # concurrent notes are converted by different workers
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) \
+                    as executor:
+                processes = list(executor.map(
+                    lambda note: pool.convert(note, note + ".pdf"),
+                    notes[:2]))
+            # the workers are kept for the following notes
+            processes.append(pool.convert(notes[2], notes[2] + ".pdf"))
+            pids = {worker.process.pid for worker in pool.workers}
+        finally:
+            pool.close()
+
+        self.assertEqual(len(pids), 2)
+        for note, process in zip(notes, processes):
+            self.assertEqual(process.returncode, 0)
+            self.assertTrue(os.path.isfile(note + ".pdf"))
+        self.assertEqual(
+            {re.search(r"pid (\d+)", process.stdout).group(1)
+             for process in processes},
+            {str(pid) for pid in pids})
+        with self.assertRaises(ValueError):
+            ConverterWorkerPool("worker", 0)
+
+
+class TestBuiltinConverters(TmpDirTestCase):
+    change_directory = False
+
+    def write_note(self, name, data):
+        note = os.path.join(self.tmp_dir.name, name)
+        with open(note, "wb") as file:
+            file.write(data)
+        return note
+
+    def test_copy(self):
+        note = self.write_note("a.pdfnote", get_pdf_data("note"))
+        os.utime(note, (1e9, 1e9))
+        pdf = os.path.join(self.tmp_dir.name, "tmp", "a.pdf")
+        pdf_commands = {"pdfnote": "builtin:copy"}
+        cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        note_dirs = {self.tmp_dir.name: dict(notes=[note], pdfs=[pdf])}
+
+        self.assertEqual(make_pdf_notes(note_dirs, pdf_commands, dict(),
+                                        cache_dir=cache_dir), list())
+        with open(pdf, "rb") as file:
+            self.assertEqual(file.read(), get_pdf_data("note"))
+        self.assertFalse(is_pdf_note_outdated(note, pdf))
+        self.assertEqual(os.path.getmtime(note), 1e9)
+        self.assertFalse(os.path.exists(cache_dir))
+
+        # a conversion command must not write into a linked note
+        pdf_commands = {"pdfnote": "cp /dev/null {pdf}"}
+        make_pdf_note(note, pdf, pdf_commands, dict())
+        with open(note, "rb") as file:
+            self.assertEqual(file.read(), get_pdf_data("note"))
+
+    def test_image(self):
+        jpeg = b"\xff\xd8\xff\xe0\x00\x04JF" \
+               b"\xff\xc0\x00\x0b\x08\x00\x02\x00\x03\x01\x00\x11\x00" \
+               b"\xff\xd9"
+        rows = b"".join(b"\x00" + 3 * b"\x10\x20\x30" for _ in range(2))
+        png = b"\x89PNG\r\n\x1a\n"
+        for chunk_type, chunk in ((b"IHDR", struct.pack(">IIBBBBB", 3, 2, 8,
+                                                        2, 0, 0, 0)),
+                                  (b"IDAT", zlib.compress(rows)),
+                                  (b"IEND", b"")):
+            png += struct.pack(">I", len(chunk)) + chunk_type + chunk + \
+                struct.pack(">I", zlib.crc32(chunk_type + chunk))
+
+        pdf_commands = {"jpg": "builtin:image", "png": "builtin:image"}
+        for name, data, color_space in (("a.jpg", jpeg, "/DeviceGray"),
+                                        ("a.png", png, "/DeviceRGB")):
+            note = self.write_note(name, data)
+            pdf = note + ".pdf"
+            process = make_pdf_note(note, pdf, pdf_commands, dict())
+            self.assertEqual(process.returncode, 0)
+            self.assertEqual(count_pdf_pages_stdlib(pdf), 1)
+            if pypdf is not None:
+                page, = pypdf.PdfReader(pdf).pages
+                self.assertEqual([float(x) for x in page.mediabox],
+                                 [0, 0, 842, 561.33])
+                image = page["/Resources"]["/XObject"]["/Im0"].get_object()
+                self.assertEqual((image["/Width"], image["/Height"]), (3, 2))
+                self.assertEqual(image["/ColorSpace"], color_space)
+
+        note = self.write_note("b.png", b"no image")
+        process = make_pdf_note(note, note + ".pdf", pdf_commands, dict())
+        self.assertEqual(process.returncode, 1)
+        self.assertFalse(os.path.exists(note + ".pdf"))
+
+        with self.assertRaises(ValueError):
+            get_pdf_export_commands(dict(
+                notes_pdf_export_commands={"jpg": "builtin:unknown"},
+                notes_pdf_inplace_export_commands=dict(),
+                notes_pdf_export_workers=dict()))
+
+    def test_note_endings(self):
+        pdf_commands = {"pdf": "builtin:copy", "note.pdf": "builtin:image"}
+        self.assertEqual(get_pdf_command("a.note.pdf", pdf_commands),
+                         ("note.pdf", "builtin:image"))
+        self.assertEqual(get_pdf_command("a.pdf", pdf_commands),
+                         ("pdf", "builtin:copy"))
+
+
+class TestGarbageCollection(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir("tmp")
+        self.note_dirs = dict()
+        for name in ("a", "b", "c"):
+            note = os.path.join(self.tmp_dir.name, name + ".txt")
+            pdf = os.path.abspath(os.path.join(
+                "tmp", hashlib.sha224(note.encode()).hexdigest()[:30] +
+                ".pdf"))
+            for file_name in (note, pdf):
+                with open(file_name, "w") as file:
+                    file.write(name)
+            self.note_dirs[name] = dict(notes=[note], pdfs=[pdf])
+
+    def test_collect_garbage(self):
+        self.assertEqual(collect_garbage(self.note_dirs), list())
+
+        unknown_pdf = os.path.join("tmp", 30 * "0" + ".pdf")
+        with open(unknown_pdf, "w") as file:
+            file.write("unknown")
+        os.remove(self.note_dirs["c"]["notes"][0])
+        note_dirs = {"a": self.note_dirs["a"]}
+        self.assertEqual(
+            sorted(collect_garbage(note_dirs)),
+            sorted(get_tmp_entry_name(pdf) for pdf in
+                   [unknown_pdf] + self.note_dirs["c"]["pdfs"]))
+        self.assertTrue(os.path.isfile(self.note_dirs["b"]["pdfs"][0]))
+
+        self.assertEqual(collect_garbage(note_dirs, 1),
+                         [get_tmp_entry_name(self.note_dirs["b"]["pdfs"][0])])
+        self.assertEqual(sorted(os.listdir("tmp")),
+                         sorted([os.path.basename(pdf) for pdf in
+                                 self.note_dirs["a"]["pdfs"]] +
+                                ["usage.json"]))
+
+    def test_arguments(self):
+        self.assertEqual(parse_arguments(["gc"]).command, "gc")
+        self.assertEqual(parse_arguments(["-j", "2"]).command, None)
+        self.assertTrue(parse_arguments(["--retry-failed"]).retry_failed)
+
+
+class TestJournalBuilder(TmpDirTestCase):
+    # the builders must not depend on the working directory
+    change_directory = False
+
+    def setUp(self):
+        super().setUp()
+        self.add_command("latexmk", """\
+                #!/bin/sh
+                touch "$(basename "$3" .tex).pdf"
+                """)
+        self.add_command("convert-note", f"""\
+                #!/bin/sh
+                echo "$1" >> {self.calls}
+                cp "$1" "$2"
+                """)
+
+    def make_build_dir(self, name, journal_type):
+        build_dir = os.path.join(self.tmp_dir.name, name)
+        note_dir = os.path.join(build_dir, "_notes")
+        os.makedirs(note_dir)
+        with open(os.path.join(note_dir, "2020-05-21-Note-20-20.txt"),
+                  "wb") as file:
+            file.write(get_pdf_data(name))
+        conf = dict(root_directory=["."],
+                    notes_directory_names=["_notes"],
+                    notes_pdf_export_commands={"txt": "cp {txt} {pdf}"},
+                    journal_type=journal_type,
+                    exclude_directories=[],
+                    datetime_filename_formats=["%Y-%m-%d-Note-%H-%M"],
+                    cache_directory=None,
+                    ignore_user_home_journalmkrc=True)
+
+        return build_dir, conf
+
+    def test_concurrent_builds(self):
+        builders = [JournalBuilder(*self.make_build_dir(name, journal_type),
+                                   jobs=1)
+                    for name, journal_type in (("a", "chronological"),
+                                               ("b", "topological"))]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(JournalBuilder.build, builders))
+
+        self.assertEqual(os.getcwd(), self.cwd)
+        for builder, (err_processes, journal) in zip(builders, results):
+            self.assertEqual(err_processes, list())
+            self.assertEqual(journal,
+                             os.path.join(builder.build_dir, "journal.pdf"))
+            self.assertTrue(os.path.isfile(journal))
+            note_dir, = builder.note_dirs
+            pdf, = builder.note_dirs[note_dir]["pdfs"]
+            self.assertTrue(pdf.startswith(builder.build_dir))
+            with open(os.path.join(builder.build_dir, "journal.tex")) as file:
+                self.assertIn(pdf, file.read())
+
+        self.assertEqual(builders[0].compile(), (list(), None))
+
+    def test_build_all(self):
+        home = os.path.join(self.tmp_dir.name, "home")
+        for note_dir in ("_notes", os.path.join("sub", "_notes"),
+                         os.path.join("other", "_notes")):
+            os.makedirs(os.path.join(home, note_dir))
+            with open(os.path.join(home, note_dir,
+                                   "2020-05-21-Note-20-20.txt"), "wb") as file:
+                file.write(get_pdf_data(note_dir))
+
+        build_dirs = list()
+        for name, root, exclude in (("a", ["..", "home"], [["..", "home",
+                                                            "other"]]),
+                                    ("b", ["..", "home", "sub"], []),
+                                    ("c", ["..", "home", "other"], [])):
+            build_dir, conf = self.make_build_dir(name, "topological")
+            os.remove(os.path.join(build_dir, "_notes",
+                                   "2020-05-21-Note-20-20.txt"))
+            conf.update(root_directory=root,
+                        exclude_directories=exclude,
+                        notes_pdf_export_commands={
+                            "txt": "convert-note {txt} {pdf}"})
+            with open(os.path.join(build_dir, "journalmkrc.json"),
+                      "w") as file:
+                json.dump(conf, file)
+            build_dirs.append(build_dir)
+
+        builders = [JournalBuilder(build_dir, jobs=1)
+                    for build_dir in build_dirs]
+        note_dirs = [builder.scan() for builder in builders]
+        scan_journals(builders)
+        self.assertEqual([builder.note_dirs for builder in builders],
+                         note_dirs)
+        self.assertEqual([sorted(nd) for nd in note_dirs],
+                         [[os.path.join(home, "_notes"),
+                           os.path.join(home, "sub", "_notes")],
+                          [os.path.join(home, "sub", "_notes")],
+                          [os.path.join(home, "other", "_notes")]])
+
+        self.assertEqual(convert_journals(builders), list())
+        self.assertEqual(self.get_calls(), 3)
+        for builder in builders:
+            for nd in builder.note_dirs.values():
+                pdf, = nd["pdfs"]
+                self.assertTrue(pdf.startswith(builder.build_dir))
+                self.assertTrue(os.path.isfile(pdf))
+
+        build_all(build_dirs, jobs=1)
+        self.assertEqual(self.get_calls(), 3)
+        for build_dir in build_dirs:
+            self.assertTrue(os.path.isfile(os.path.join(build_dir,
+                                                        "journal.pdf")))
+        self.assertEqual(parse_arguments(["build-all", "a", "b"]).build_dirs,
+                         ["a", "b"])
+
+    def test_build_all_without_directory_names(self):
+        build_dir, conf = self.make_build_dir("a", "chronological")
+        conf.update(notes_directory_names=None)
+        with open(os.path.join(build_dir, "journalmkrc.json"), "w") as file:
+            json.dump(conf, file)
+        # the scan index is saved in the tmp directory after the first scan
+        os.mkdir(os.path.join(build_dir, "tmp"))
+
+        builder = JournalBuilder(build_dir, jobs=1)
+        note_dirs = builder.scan()
+        self.assertIn(os.path.join(build_dir, "_notes"), note_dirs)
+        scan_journals([builder])
+        self.assertEqual(builder.note_dirs, note_dirs)
+
+        build_all([build_dir], jobs=1)
+        self.assertTrue(os.path.isfile(os.path.join(build_dir,
+                                                    "journal.pdf")))
+
+    def test_plan(self):
+        builder = JournalBuilder(*self.make_build_dir("a", "chronological"),
+                                 jobs=2)
+        note_dir, = builder.scan()
+        note, = builder.note_dirs[note_dir]["notes"]
+        plan = builder.plan()
+        self.assertEqual((plan["notes"], plan["stale"]), (1, 1))
+        self.assertEqual(plan["extensions"]["txt"]["notes"], [note])
+        self.assertIsNone(plan["extensions"]["txt"]["seconds"])
+        self.assertEqual(plan["seconds"], 0.)
+
+        self.assertEqual(builder.convert(), list())
+        self.assertEqual(builder.plan()["stale"], 0)
+
+        mtime = os.path.getmtime(builder.note_dirs[note_dir]["pdfs"][0])
+        os.utime(note, (mtime + 10, mtime + 10))
+        plan = builder.plan()
+        self.assertEqual(plan["stale"], 1)
+        self.assertGreater(plan["extensions"]["txt"]["seconds_per_note"], 0)
+        self.assertEqual(plan["wall_seconds"], plan["seconds"])
+        json.dumps(plan)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            print_plan(plan)
+        lines = output.getvalue().splitlines()
+        self.assertIn("Notes of type txt: 1 notes", lines[1])
+        self.assertEqual(lines[2].strip(), note)
+
+        arguments = parse_arguments(["--plan", "--json", "plan.json"])
+        self.assertEqual((arguments.plan, arguments.json),
+                         (True, "plan.json"))
+
+    def test_phases(self):
+        build_dir, conf = self.make_build_dir("a", "chronological")
+        with open(os.path.join(build_dir, "journalmkrc.json"), "w") as file:
+            json.dump(conf, file)
+
+        builder = JournalBuilder(build_dir, jobs=1)
+        self.assertEqual(len(builder.scan()), 1)
+        self.assertEqual(builder.convert(), list())
+        (part, chapters), = builder.tree()
+        self.assertEqual(part, "2020")
+        self.assertEqual(builder.render(), list())
+        self.assertEqual(builder.documents[0][0], "journal")
+        self.assertFalse(os.path.isfile(os.path.join(self.cwd,
+                                                     "journal.tex")))
+
+
+class TestNoopBuild(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_command("latexmk", f"""\
+                #!/bin/sh
+                echo "$@" >> {self.calls}
+                for tex; do :; done
+                name="$(basename "$tex" .tex)"
+                touch "$name.pdf"
+                case "$name" in
+                    part-*) awk '/includepdf/ {{n++; print "note " n}}
+                                 END {{print n}}' "$tex" > "$name.pages";;
+                esac
+                """)
+
+        note_dir = os.path.join(self.tmp_dir.name, "_notes")
+        os.mkdir(note_dir)
+        self.pdf = os.path.abspath(os.path.join("tmp", "0.pdf"))
+        os.mkdir("tmp")
+        with open(self.pdf, "w") as file:
+            file.write("pdf")
+        self.note_dirs = {note_dir: dict(
+            notes=[os.path.join(note_dir, "note.txt")],
+            pdfs=[self.pdf],
+            timestamps=[datetime.datetime(2020, 5, 21, 20, 20)])}
+        self.conf = dict(journal_type="chronological")
+
+    def test_noop_build(self):
+        self.assertEqual(compile_journal(self.note_dirs, self.conf),
+                         (list(), "journal.pdf"))
+        self.assertEqual(compile_journal(self.note_dirs, self.conf),
+                         (list(), None))
+        self.assertEqual(self.get_calls(), 1)
+
+        with open(self.pdf, "w") as file:
+            file.write("changed pdf")
+        self.assertEqual(compile_journal(self.note_dirs, self.conf),
+                         (list(), "journal.pdf"))
+        self.assertEqual(self.get_calls(), 2)
+
+        os.remove("journal.pdf")
+        self.assertEqual(compile_journal(self.note_dirs, self.conf),
+                         (list(), "journal.pdf"))
+        self.assertEqual(self.get_calls(), 3)
+
+    def get_compiled_documents(self, calls):
+        with open(self.calls) as file:
+            lines = file.readlines()[calls:]
+        return sorted(line.split()[-1] for line in lines)
+
+    @unittest.skipIf(pypdf is None, "pypdf is not installed")
+    def test_part_documents(self):
+        self.add_command("latexmk", part_latexmk_stub.format(
+            python=sys.executable, calls=self.calls))
+        other_pdf = os.path.abspath(os.path.join("tmp", "1.pdf"))
+        with open(other_pdf, "w") as file:
+            file.write("other pdf")
+        self.note_dirs["/other"] = dict(
+            notes=["/other/note.txt"],
+            pdfs=[other_pdf],
+            timestamps=[datetime.datetime(2021, 5, 21, 20, 20)],
+            metadata=None)
+        self.conf.update(part_documents=True)
+        self.assertEqual(compile_journal(self.note_dirs, self.conf, jobs=2),
+                         (list(), "journal.pdf"))
+
+        def get_part_document(name, part):
+            part_hash = hashlib.sha224(f"{name} {part}".encode()).hexdigest()
+            return "part-" + part_hash[:30] + ".tex"
+
+        part_2021 = get_part_document("journal", 2021)
+        self.assertEqual(self.get_compiled_documents(0),
+                         sorted(["journal-front.tex",
+                                 get_part_document("journal", 2020),
+                                 part_2021]))
+        self.assertFalse(os.path.exists("journal.tex"))
+        reader = pypdf.PdfReader("journal.pdf")
+        self.assertEqual([item.title for item in reader.outline
+                          if not isinstance(item, list)],
+                         ["Contents", "2021", "2020"])
+        self.assertEqual(reader.page_labels[:3], ["i", "ii", "1"])
+
+        # a changed note compiles only its part, the journal is merged again
+        with open(other_pdf, "w") as file:
+            file.write("changed pdf")
+        calls = self.get_calls()
+        self.assertEqual(compile_journal(self.note_dirs, self.conf, jobs=2),
+                         (list(), "journal.pdf"))
+        self.assertEqual(self.get_compiled_documents(calls), [part_2021])
+        self.assertEqual(compile_journal(self.note_dirs, self.conf, jobs=2),
+                         (list(), None))
+        self.assertEqual(self.get_calls(), calls + 1)
+
+        # with a volume per part, only the part and the index are compiled
+        self.conf.update(volumes="part")
+        self.assertEqual(compile_journal(self.note_dirs, self.conf, jobs=2),
+                         (list(), "journal.pdf"))
+        with open(other_pdf, "w") as file:
+            file.write("changed pdf again")
+        calls = self.get_calls()
+        self.assertEqual(compile_journal(self.note_dirs, self.conf, jobs=2),
+                         (list(), "journal.pdf"))
+        self.assertEqual(self.get_compiled_documents(calls),
+                         ["journal.tex", get_part_document("journal-2", 2021)])
+        self.assertTrue(os.path.isfile("journal-2.pdf"))
+
+    def test_tex_engine(self):
+        self.assertEqual(compile_journal(self.note_dirs, self.conf),
+                         (list(), "journal.pdf"))
+        self.conf.update(tex_engine="lualatex",
+                         latexmk_options=["-interaction=batchmode"])
+        self.assertEqual(compile_journal(self.note_dirs, self.conf),
+                         (list(), "journal.pdf"))
+        with open(self.calls) as file:
+            self.assertEqual(file.readlines()[-1].split(),
+                             ["-norc", "-pdflua", "-interaction=batchmode",
+                              "journal.tex"])
+
+        self.conf.update(tex_engine="luatex")
+        with self.assertRaises(ValueError):
+            compile_journal(self.note_dirs, self.conf)
+
+    def test_precompiled_preamble(self):
+        self.add_command("pdflatex", f"""\
+                #!/bin/sh
+                echo pdflatex "$@" >> {self.calls}
+                touch preamble.fmt
+                """)
+
+        self.conf.update(precompiled_preamble=True)
+        preamble = get_journal_preamble(self.conf)
+        self.assertLess(preamble.index(end_of_dump_str),
+                        preamble.index(r"\usepackage{hyperref}"))
+        self.assertEqual(compile_journal(self.note_dirs, self.conf),
+                         (list(), "journal.pdf"))
+        self.assertEqual(compile_journal(self.note_dirs, self.conf),
+                         (list(), None))
+        format_filename = os.path.abspath(preamble_format_name)
+        with open(self.calls) as file:
+            calls = [line.split() for line in file]
+        self.assertEqual(calls, [
+            ["pdflatex", "-ini", "-interaction=nonstopmode",
+             "-jobname=preamble", "&pdflatex", "mylatexformat.ltx",
+             "preamble.tex"],
+            ["-norc", "-pdf", "-pdflatex=pdflatex",
+             "-fmt=" + format_filename, "%O", "%S", "journal.tex"]])
+        with open(format_filename + ".tex") as file:
+            self.assertTrue(file.read().startswith(preamble))
+
+    def test_volumes(self):
+        note_dir, = self.note_dirs
+        self.note_dirs[note_dir]["timestamps"] = [
+            datetime.datetime(2020, 5, 21, 20, 20)]
+        self.note_dirs["/other"] = dict(
+            notes=["/other/note.txt"],
+            pdfs=[self.pdf],
+            timestamps=[datetime.datetime(2021, 5, 21, 20, 20)],
+            metadata=None)
+        self.conf.update(volumes="part")
+        self.assertEqual(compile_journal(self.note_dirs, self.conf, jobs=2),
+                         (list(), "journal.pdf"))
+        self.assertEqual(self.get_calls(), 3)
+        for name in ("journal", "journal-1", "journal-2"):
+            self.assertTrue(os.path.isfile(name + ".pdf"))
+        with open("journal-2.tex") as file:
+            self.assertIn(r"\addpart{2021}", file.read())
+
+        self.conf.update(volume_index=False)
+        self.assertEqual(compile_journal(self.note_dirs, self.conf, jobs=2),
+                         (list(), None))
+        self.assertEqual(self.get_calls(), 3)
+
+        for volumes in (True, 0, "chapter"):
+            with self.assertRaisesRegex(ValueError, repr(volumes)):
+                get_volumes(list(), volumes)
+
+    def test_split_document_tree(self):
+        pdfs = list()
+        for pages in (3, 1, 2, 2):
+            pdfs.append(os.path.abspath(os.path.join("tmp",
+                                                     f"{len(pdfs)}.pdf")))
+            with open(pdfs[-1], "wb") as file:
+                file.write(b"%PDF-1.4\n1 0 obj << /Type /Pages /Kids [] "
+                           b"/Count " + str(pages).encode() + b" >> endobj")
+        self.assertEqual(count_pdf_pages_stdlib(pdfs[0]), 3)
+
+        entries = [NoteEntry(f"/notes/{i}", pdf, None, None, str(i))
+                   for i, pdf in enumerate(pdfs)]
+        document_tree = [
+            ("2021", [("May", [("Week 1", entries[:1])]),
+                      ("April", [("Week 2", entries[1:2])])]),
+            ("2020", [("May", [("Week 3", entries[2:])])])]
+        # the test pdfs are not complete enough for pypdf
+        with unittest.mock.patch("journalmk.journalmk.count_pdf_pages",
+                                 count_pdf_pages_stdlib):
+            volumes = split_document_tree(document_tree, 3)
+            self.assertEqual(volumes, [[("2021", [document_tree[0][1][0]])],
+                                       [("2021", [document_tree[0][1][1]])],
+                                       [document_tree[1]]])
+            os.remove(page_counts_filename)
+            volumes = split_document_tree(document_tree, 5)
+            self.assertEqual(volumes, [[("2021", [document_tree[0][1][0]])],
+                                       [("2021", [document_tree[0][1][1]]),
+                                        document_tree[1]]])
+            self.assertEqual([name for name, subtitle, volume_tree in
+                              get_volumes(document_tree, 4)],
+                             ["journal-2", "journal-1"])
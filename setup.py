@@ -18,6 +18,9 @@ setuptools.setup(
     long_description=read_file('readme.md'),
     long_description_content_type='text/markdown',
     packages=setuptools.find_packages(),
+    extras_require={
+        "native": ["pypdf>=3.0"],
+    },
     classifiers=(
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: BSD License",